@@ -1,7 +1,33 @@
 from django.contrib import admin
 from django.contrib.auth.admin import UserAdmin
 from django.contrib.auth.models import User
-from .models import Shop, Category, Good, Sale, Worker , Expense , Debt , DebtItem ,StockReceipt
+from django.db import transaction
+from .models import Shop, Category, Good, Sale, Worker , Expense , Customer, Debt , DebtItem ,StockReceipt, DailyShopSummary, HourlyShopSummary, DailyGoodSummary, WorkerShiftSummary, CostLayer, GoodStockSummary
+from .rollups import record_expense
+from .exports import (
+    SALE_EXPORT_COLUMNS, DEBT_EXPORT_COLUMNS, STOCK_RECEIPT_EXPORT_COLUMNS, queryset_rows, xlsx_response
+)
+
+
+def xlsx_export_action(columns, filename, sheet_name):
+    """Admin action streaming the selected rows as an XLSX file"""
+    @admin.action(description="Seçilənləri Excel-ə ixrac et")
+    def export_xlsx(modeladmin, request, queryset):
+        return xlsx_response(queryset_rows(queryset, columns), filename, sheet_name)
+    return export_xlsx
+
+
+class ReadOnlyAdmin(admin.ModelAdmin):
+    """Rows kept consistent by the views (stock, cost layers, summaries, customer balances):
+    listed and exported here, never added, edited or deleted"""
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    def has_delete_permission(self, request, obj=None):
+        return False
 
 
 class WorkerInline(admin.StackedInline):
@@ -47,7 +73,7 @@ class WorkerAdmin(admin.ModelAdmin):
 
 @admin.register(Shop)
 class ShopAdmin(admin.ModelAdmin):
-    list_display = ['name', 'get_worker_count']
+    list_display = ['name', 'timezone', 'get_worker_count']
     search_fields = ['name']
     
     def get_worker_count(self, obj):
@@ -63,19 +89,21 @@ class CategoryAdmin(admin.ModelAdmin):
 
 @admin.register(Good)
 class GoodAdmin(admin.ModelAdmin):
-    list_display = ['name', 'barcode', 'price', 'buy_price', 'stock_count', 'category', 'shop']
+    list_display = ['name', 'barcode', 'price', 'buy_price', 'avg_cost', 'stock_count', 'category', 'shop']
     list_filter = ['shop', 'category']
     search_fields = ['name', 'barcode']
     list_editable = ['price', 'buy_price', 'stock_count']
+    readonly_fields = ['avg_cost']
 
 
 @admin.register(Sale)
-class SaleAdmin(admin.ModelAdmin):
-    list_display = ['good', 'quantity', 'total_price', 'shop', 'timestamp']
-    list_filter = ['shop', 'timestamp', 'good__category']
-    search_fields = ['good__name', 'good__barcode']
-    readonly_fields = ['timestamp']
+class SaleAdmin(ReadOnlyAdmin):
+    list_display = ['good', 'quantity', 'total_price', 'shop', 'worker', 'timestamp', 'transaction_id']
+    list_filter = ['shop', 'worker', 'timestamp', 'good__category']
+    search_fields = ['good__name', 'good__barcode', 'transaction_id']
+    readonly_fields = ['timestamp', 'transaction_id', 'voided_sale', 'worker', 'cost']
     date_hierarchy = 'timestamp'
+    actions = [xlsx_export_action(SALE_EXPORT_COLUMNS, 'satislar.xlsx', 'Satışlar')]
 
 @admin.register(Expense)
 class ExpenseAdmin(admin.ModelAdmin):
@@ -103,18 +131,44 @@ class ExpenseAdmin(admin.ModelAdmin):
     def save_model(self, request, obj, form, change):
         if not obj.pk:  # If this is a new object (not editing existing)
             obj.created_by = request.user
-        super().save_model(request, obj, form, change)
+        with transaction.atomic():
+            if change:
+                # Take the old values out of the daily summary, then add the new ones
+                old = Expense.objects.select_for_update().get(pk=obj.pk)
+                record_expense(old, amount=-old.amount)
+            super().save_model(request, obj, form, change)
+            record_expense(obj)
+
+    def delete_model(self, request, obj):
+        with transaction.atomic():
+            record_expense(obj, amount=-obj.amount)
+            super().delete_model(request, obj)
+
+    def delete_queryset(self, request, queryset):
+        with transaction.atomic():
+            for expense in queryset:
+                record_expense(expense, amount=-expense.amount)
+            super().delete_queryset(request, queryset)
+
+@admin.register(Customer)
+class CustomerAdmin(admin.ModelAdmin):
+    list_display = ('name', 'phone', 'balance', 'created_at')
+    search_fields = ('name', 'phone')
+    # Kept by the debt views; manage.py backfill_customers recomputes it
+    readonly_fields = ('balance', 'created_at')
 
 @admin.register(Debt)
-class DebtAdmin(admin.ModelAdmin):
+class DebtAdmin(ReadOnlyAdmin):
     list_display = ('customer_name', 'customer_phone', 'shop', 'total_amount', 'paid_amount', 'remaining_amount', 'status', 'due_date', 'created_by')
     list_filter = ('shop', 'status', 'due_date', 'created_at')
     search_fields = ('customer_name', 'customer_phone', 'description')
-    readonly_fields = ('remaining_amount', 'created_at', 'updated_at')
+    readonly_fields = ('remaining_amount', 'profit', 'items_quantity', 'created_at', 'updated_at')
+    raw_id_fields = ('customer',)
     date_hierarchy = 'created_at'
+    actions = [xlsx_export_action(DEBT_EXPORT_COLUMNS, 'borclar.xlsx', 'Borclar')]
 
 @admin.register(DebtItem)
-class DebtItemAdmin(admin.ModelAdmin):
+class DebtItemAdmin(ReadOnlyAdmin):
     list_display = ('debt', 'good', 'quantity', 'unit_price', 'total_price')
     list_filter = ('debt__shop',)
 
@@ -124,12 +178,53 @@ class StockReceiptAdmin(admin.ModelAdmin):
     list_filter = ['receipt_type', 'shop', 'created_at']
     search_fields = ['good__name', 'supplier']
     readonly_fields = ['total_cost', 'created_at']
+    actions = [xlsx_export_action(STOCK_RECEIPT_EXPORT_COLUMNS, 'stok_qebulu.xlsx', 'Stok qəbulu')]
     
     def save_model(self, request, obj, form, change):
         if not obj.created_by:
             obj.created_by = request.user
         super().save_model(request, obj, form, change)
 
+@admin.register(DailyShopSummary)
+class DailyShopSummaryAdmin(ReadOnlyAdmin):
+    # Maintained by the sale/debt/expense write paths (or `manage.py rebuild_summaries`)
+    list_display = ['date', 'shop', 'category', 'sales_revenue', 'sales_quantity', 'debts_revenue', 'expenses_total']
+    list_filter = ['shop', 'date']
+    date_hierarchy = 'date'
+
+@admin.register(HourlyShopSummary)
+class HourlyShopSummaryAdmin(ReadOnlyAdmin):
+    list_display = ['date', 'hour', 'shop', 'category', 'sales_revenue', 'sales_quantity', 'debts_revenue']
+    list_filter = ['shop', 'date']
+    date_hierarchy = 'date'
+
+@admin.register(DailyGoodSummary)
+class DailyGoodSummaryAdmin(ReadOnlyAdmin):
+    list_display = ['date', 'shop', 'good', 'quantity', 'revenue', 'profit']
+    list_filter = ['shop', 'date']
+    search_fields = ['good__name', 'good__barcode']
+    date_hierarchy = 'date'
+
+@admin.register(WorkerShiftSummary)
+class WorkerShiftSummaryAdmin(ReadOnlyAdmin):
+    list_display = ['date', 'shift', 'shop', 'worker', 'revenue', 'items', 'transactions', 'profit']
+    list_filter = ['shop', 'shift', 'worker', 'date']
+    date_hierarchy = 'date'
+
+@admin.register(CostLayer)
+class CostLayerAdmin(ReadOnlyAdmin):
+    list_display = ['good', 'received_at', 'quantity', 'remaining', 'unit_cost', 'receipt']
+    list_filter = ['good__shop', 'received_at']
+    search_fields = ['good__name', 'good__barcode']
+    date_hierarchy = 'received_at'
+
+@admin.register(GoodStockSummary)
+class GoodStockSummaryAdmin(ReadOnlyAdmin):
+    # Rebuilt nightly by `manage.py rebuild_inventory_report`
+    list_display = ['good', 'shop', 'abc_class', 'stock_count', 'daily_velocity', 'days_of_cover', 'turnover', 'revenue', 'computed_on']
+    list_filter = ['shop', 'abc_class']
+    search_fields = ['good__name', 'good__barcode']
+
 # Re-register UserAdmin
 admin.site.unregister(User)
-admin.site.register(User, CustomUserAdmin)
\ No newline at end of file
+admin.site.register(User, CustomUserAdmin)
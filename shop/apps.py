@@ -4,3 +4,12 @@ from django.apps import AppConfig
 class ShopConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'shop'
+
+    def ready(self):
+        from django.contrib.auth.models import User
+        from django.db.models.signals import pre_delete
+
+        from . import checks  # noqa: F401 (registers the deploy checks)
+        from .rollups import fold_deleted_worker
+
+        pre_delete.connect(fold_deleted_worker, sender=User, dispatch_uid='shop.fold_deleted_worker')
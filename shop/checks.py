@@ -0,0 +1,23 @@
+"""System checks of the production settings (`manage.py check --deploy`)"""
+from django.conf import settings
+from django.core.checks import Tags, Warning, register
+
+# Backends keeping their entries inside one process
+PROCESS_LOCAL_CACHES = (
+    'django.core.cache.backends.locmem.LocMemCache',
+    'django.core.cache.backends.dummy.DummyCache',
+)
+
+
+@register(Tags.caches, deploy=True)
+def check_shared_cache(app_configs, **kwargs):
+    """The finance caches only work when every worker process sees the same cache"""
+    backend = settings.CACHES['default']['BACKEND']
+    if backend not in PROCESS_LOCAL_CACHES:
+        return []
+    return [Warning(
+        f'The default cache ({backend}) is local to each process.',
+        hint='Report generations, stale sections and their refresh locks would differ between '
+             'gunicorn workers: set REDIS_URL to share one cache.',
+        id='shop.W001',
+    )]
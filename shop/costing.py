@@ -0,0 +1,261 @@
+"""Cost of goods sold from StockReceipt cost layers.
+
+Every receipt opens a CostLayer (see StockReceipt.save). Sales and debt items
+take their units out of the open layers of the good when they are written and
+store the resulting cost on the line (Sale.cost, DebtItem.cost), so profit is
+always total_price - cost and reports only sum. Voids and cancelled debts put
+the units back as a new layer at the cost they left with.
+
+settings.COST_METHOD picks how a line is priced:
+
+* 'fifo' (default): the oldest layers first,
+* 'average': the weighted average unit cost of the open layers.
+
+Units that no layer covers (stock that predates the receipts, manual stock
+edits, opened cigarette packs) are costed at Good.buy_price.
+
+rebuild_costs() replays the whole history in one pass and rewrites every
+layer and line cost, and Good.avg_cost (see the rebuild_costs command).
+"""
+import heapq
+from collections import defaultdict, deque
+from decimal import Decimal
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import transaction
+from django.db.models import Sum
+
+from .models import Good, Sale, DebtItem, StockReceipt, CostLayer, moving_average_cost
+
+COST_METHODS = ('fifo', 'average')
+
+REBUILD_BATCH_SIZE = 2000
+
+CENT = Decimal('0.01')
+UNIT_COST_PLACES = Decimal('0.0001')
+
+
+def cost_method():
+    method = getattr(settings, 'COST_METHOD', 'fifo')
+    if method not in COST_METHODS:
+        raise ImproperlyConfigured(f'COST_METHOD must be one of {", ".join(COST_METHODS)}')
+    return method
+
+
+def _take(layers, quantity, fallback_unit_cost, average):
+    """Remove quantity units from the open layers (oldest first) and return their cost.
+
+    Layers are updated in place and emptied ones are dropped from the deque. Returns the
+    cost and the layers that changed.
+    """
+    cost = Decimal('0')
+    if average:
+        units = sum(layer.remaining for layer in layers)
+        if units:
+            cost = sum(layer.remaining * layer.unit_cost for layer in layers) / units * min(quantity, units)
+        cost += fallback_unit_cost * max(quantity - units, 0)
+
+    changed = []
+    needed = quantity
+    while needed and layers:
+        layer = layers[0]
+        taken = min(needed, layer.remaining)
+        layer.remaining -= taken
+        needed -= taken
+        if not average:
+            cost += taken * layer.unit_cost
+        changed.append(layer)
+        if not layer.remaining:
+            layers.popleft()
+    if not average:
+        cost += needed * fallback_unit_cost
+    return cost.quantize(CENT), changed
+
+
+def _open_layers(good_ids):
+    layers = defaultdict(deque)
+    open_layers = (
+        CostLayer.objects.select_for_update()
+        .filter(good_id__in=good_ids, remaining__gt=0)
+        .order_by('received_at', 'id')
+    )
+    for layer in open_layers:
+        layers[layer.good_id].append(layer)
+    return layers
+
+
+def consume(lines):
+    """Take the units of (good, quantity) lines out of stock; returns the cost of each line.
+
+    Must run inside the writing transaction: the open layers stay locked until it ends.
+    """
+    average = cost_method() == 'average'
+    layers = _open_layers({good.id for good, quantity in lines})
+    costs, changed = [], {}
+    for good, quantity in lines:
+        cost, touched = _take(layers[good.id], quantity, good.buy_price, average)
+        costs.append(cost)
+        changed.update((layer.pk, layer) for layer in touched)
+    CostLayer.objects.bulk_update(changed.values(), ['remaining'])
+    return costs
+
+
+def _returned_layer(good_id, quantity, cost, received_at):
+    return CostLayer(
+        good_id=good_id, received_at=received_at, quantity=quantity, remaining=quantity,
+        unit_cost=(cost / quantity).quantize(UNIT_COST_PLACES)
+    )
+
+
+def return_to_stock(lines, received_at):
+    """Put (good_id, quantity, cost) lines back into stock as new layers, e.g. on a void"""
+    CostLayer.objects.bulk_create(
+        _returned_layer(good_id, quantity, cost, received_at)
+        for good_id, quantity, cost in lines if quantity > 0
+    )
+
+
+def void_cost(sale, quantity, previous_quantity, previous_cost):
+    """Cost reversed by voiding quantity units of sale, given the earlier voids' (negative) sums.
+
+    The last units reverse exactly what is left, so a fully voided line nets to zero.
+    """
+    if quantity == sale.quantity + previous_quantity:
+        return sale.cost + previous_cost
+    return (sale.cost * quantity / sale.quantity).quantize(CENT)
+
+
+def _history():
+    """Every stock movement with a cost, ordered by time: receipts, sales (and voids), debt items
+    and the return of the cancelled ones"""
+    receipts = (
+        StockReceipt.objects.order_by('created_at', 'id')
+        .values_list('created_at', 'id', 'good_id', 'quantity', 'unit_cost')
+        .iterator(chunk_size=REBUILD_BATCH_SIZE)
+    )
+    sales = (
+        Sale.objects.order_by('timestamp', 'id')
+        .values_list('timestamp', 'id', 'good_id', 'quantity', 'voided_sale_id')
+        .iterator(chunk_size=REBUILD_BATCH_SIZE)
+    )
+    debt_items = (
+        DebtItem.objects.order_by('debt__created_at', 'id')
+        .values_list('debt__created_at', 'id', 'good_id', 'quantity', 'debt__status')
+        .iterator(chunk_size=REBUILD_BATCH_SIZE)
+    )
+    # A cancelled debt gave its units back when it was cancelled, its last update (see cancel_debt)
+    debt_returns = (
+        DebtItem.objects.filter(debt__status='cancelled')
+        .order_by('debt__updated_at', 'id')
+        .values_list('debt__updated_at', 'id', 'good_id', 'quantity')
+        .iterator(chunk_size=REBUILD_BATCH_SIZE)
+    )
+    return heapq.merge(
+        (('receipt',) + row for row in receipts),
+        (('sale',) + row for row in sales),
+        (('debt_item',) + row for row in debt_items),
+        (('debt_return',) + row for row in debt_returns),
+        key=lambda event: event[1]
+    )
+
+
+def _opening_stock():
+    """Stock of every good before its first recorded movement: today's count with the history undone"""
+    stock = dict(Good.objects.values_list('id', 'stock_count'))
+    movements = (
+        (StockReceipt.objects.all(), -1),
+        (Sale.objects.all(), 1),
+        # Cancelled debt items were taken out and returned: no net movement
+        (DebtItem.objects.exclude(debt__status='cancelled'), 1),
+    )
+    for queryset, sign in movements:
+        for good_id, quantity in queryset.values('good_id').annotate(total=Sum('quantity')).values_list('good_id', 'total'):
+            stock[good_id] += sign * quantity
+    return {good_id: max(quantity, 0) for good_id, quantity in stock.items()}
+
+
+@transaction.atomic
+def rebuild_costs():
+    """Replay the whole stock history and rewrite every cost layer, Sale.cost, DebtItem.cost and Good.avg_cost.
+
+    Open layers and stock levels are kept in memory per good; line costs are written in batches.
+    Returns (layers, sales, debt items).
+    """
+    average = cost_method() == 'average'
+    buy_prices = dict(Good.objects.values_list('id', 'buy_price'))
+    stock = _opening_stock()
+    avg_costs = dict(buy_prices)
+    open_layers = defaultdict(deque)
+    all_layers = []
+    originals = {}  # sale id -> [quantity, cost, voided quantity, voided cost]
+    cancelled = {}  # cancelled debt item id -> cost, until it is returned
+    sale_costs, item_costs = [], []
+    sales_written = items_written = 0
+
+    def flush(model, costs):
+        model.objects.bulk_update(costs, ['cost'], batch_size=REBUILD_BATCH_SIZE)
+        costs.clear()
+
+    for kind, when, row_id, good_id, quantity, *extra in _history():
+        if kind == 'receipt':
+            layer = CostLayer(
+                good_id=good_id, receipt_id=row_id, received_at=when,
+                quantity=quantity, remaining=quantity, unit_cost=extra[0]
+            )
+            all_layers.append(layer)
+            open_layers[good_id].append(layer)
+            avg_costs[good_id] = moving_average_cost(stock[good_id], avg_costs[good_id], quantity, extra[0])
+            stock[good_id] += quantity
+            continue
+        if kind == 'debt_return':
+            layer = _returned_layer(good_id, quantity, cancelled.pop(row_id), when)
+            all_layers.append(layer)
+            open_layers[good_id].append(layer)
+            stock[good_id] += quantity
+            continue
+
+        stock[good_id] -= quantity  # Void rows have negative quantities
+
+        voided_sale_id = extra[0] if kind == 'sale' else None
+        if voided_sale_id:
+            original = originals.get(voided_sale_id)
+            returned = -quantity
+            if original:
+                sale = Sale(quantity=original[0], cost=original[1])
+                cost = void_cost(sale, returned, original[2], original[3])
+                original[2] -= returned
+                original[3] -= cost
+            else:
+                cost = (returned * buy_prices[good_id]).quantize(CENT)
+            layer = _returned_layer(good_id, returned, cost, when)
+            all_layers.append(layer)
+            open_layers[good_id].append(layer)
+            cost = -cost
+        else:
+            cost, _ = _take(open_layers[good_id], quantity, buy_prices[good_id], average)
+            if kind == 'sale':
+                originals[row_id] = [quantity, cost, 0, Decimal('0')]
+            elif extra[0] == 'cancelled':
+                cancelled[row_id] = cost
+
+        if kind == 'sale':
+            sale_costs.append(Sale(id=row_id, cost=cost))
+            sales_written += 1
+            if len(sale_costs) >= REBUILD_BATCH_SIZE:
+                flush(Sale, sale_costs)
+        else:
+            item_costs.append(DebtItem(id=row_id, cost=cost))
+            items_written += 1
+            if len(item_costs) >= REBUILD_BATCH_SIZE:
+                flush(DebtItem, item_costs)
+
+    flush(Sale, sale_costs)
+    flush(DebtItem, item_costs)
+    CostLayer.objects.all().delete()
+    CostLayer.objects.bulk_create(all_layers, batch_size=REBUILD_BATCH_SIZE)
+    Good.objects.bulk_update(
+        [Good(id=good_id, avg_cost=avg_cost) for good_id, avg_cost in avg_costs.items()],
+        ['avg_cost'], batch_size=REBUILD_BATCH_SIZE
+    )
+    return len(all_layers), sales_written, items_written
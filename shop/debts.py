@@ -0,0 +1,119 @@
+"""Debt list page, and the customers behind the debts.
+
+debt_stats() reads the four totals and the overdue count of the filtered debts
+with one conditional aggregate. debt_page() lists them by due date, latest
+first, `limit` rows at a time: the cursor is the (due_date, id) of the last row
+shown, so every page is the same bounded read of the (shop, status, due_date)
+index however far back the user goes.
+
+Every debt links to a Customer whose balance (remaining amount of their pending
+debts) the debt views keep up to date; search_customers() looks customers up by
+phone or name prefix. backfill_customers() links the debts created before.
+"""
+import base64
+from collections import defaultdict
+from datetime import date
+
+from django.db import transaction
+from django.db.models import Sum, Count, Q, OuterRef, Subquery, Value, DecimalField
+from django.db.models.functions import Coalesce
+
+from .models import Customer, Debt, normalize_customer_name, normalize_phone
+
+DEBT_PAGE_SIZE = 50
+
+
+def debt_stats(debts, today):
+    """Totals of the debts queryset; overdue = pending and due before today"""
+    overdue = Q(status='pending', due_date__lt=today)
+    return debts.aggregate(
+        total_debts=Sum('total_amount'),
+        total_paid=Sum('paid_amount'),
+        total_remaining=Sum('remaining_amount'),
+        total_overdue=Sum('remaining_amount', filter=overdue),
+        overdue_count=Count('id', filter=overdue),
+    )
+
+
+def encode_cursor(due_date, debt_id):
+    return base64.urlsafe_b64encode(f'{due_date.isoformat()}|{debt_id}'.encode()).decode()
+
+
+def decode_cursor(cursor):
+    """(due_date, id) of a cursor; raises ValueError for anything else"""
+    try:
+        due_date, debt_id = base64.urlsafe_b64decode(cursor.encode()).decode().split('|')
+        return date.fromisoformat(due_date), int(debt_id)
+    except (TypeError, UnicodeError, ValueError) as exc:
+        raise ValueError('cursor') from exc
+
+
+def debt_page(debts, cursor=None, limit=DEBT_PAGE_SIZE):
+    """(debts, next cursor or None) of the page below cursor; raises ValueError for a malformed cursor"""
+    if cursor:
+        due_date, debt_id = decode_cursor(cursor)
+        debts = debts.filter(Q(due_date__lt=due_date) | Q(due_date=due_date, id__lt=debt_id))
+    # One extra row tells whether another page exists
+    page = list(debts.order_by('-due_date', '-id')[:limit + 1])
+    if len(page) > limit:
+        return page[:limit], encode_cursor(page[limit - 1].due_date, page[limit - 1].id)
+    return page, None
+
+
+CUSTOMER_SEARCH_LIMIT = 20
+
+
+def search_customers(query, limit=CUSTOMER_SEARCH_LIMIT):
+    """Customers whose phone (digits only) or normalized name starts with query, with their balances.
+
+    Prefix matches (LIKE 'prefix%') use the varchar_pattern_ops indexes, so the lookup stays one indexed query.
+    """
+    if any(char.isalpha() for char in query):
+        field, prefix = 'normalized_name', normalize_customer_name(query)
+    else:
+        field, prefix = 'phone', normalize_phone(query)
+    if not prefix:
+        return []
+    return list(
+        Customer.objects.filter(**{f'{field}__startswith': prefix})
+        .order_by(field)
+        .values('id', 'name', 'phone', 'balance')[:limit]
+    )
+
+
+@transaction.atomic
+def backfill_customers():
+    """Link every debt without a customer to one and recompute all balances; returns (created, linked)"""
+    customers = {}
+    for customer in Customer.objects.all():
+        customers[customer.phone or ('', customer.normalized_name)] = customer
+    debts = defaultdict(list)
+    new = {}
+    for debt_id, name, phone in Debt.objects.filter(customer__isnull=True).values_list(
+            'id', 'customer_name', 'customer_phone').order_by('id'):
+        phone = normalize_phone(phone)
+        key = phone or ('', normalize_customer_name(name))
+        if key not in customers and key not in new:
+            new[key] = Customer(
+                name=' '.join(name.split()), normalized_name=normalize_customer_name(name), phone=phone
+            )
+        debts[key].append(debt_id)
+
+    # bulk_create skips Customer.save(): the names and phones are normalized above
+    customers.update(zip(new, Customer.objects.bulk_create(new.values())))
+    for key, debt_ids in debts.items():
+        Debt.objects.filter(id__in=debt_ids).update(customer=customers[key])
+    rebuild_customer_balances()
+    return len(new), sum(len(debt_ids) for debt_ids in debts.values())
+
+
+def rebuild_customer_balances():
+    """Recompute every balance from the pending debts with one UPDATE"""
+    remaining = (
+        Debt.objects.filter(customer=OuterRef('pk'), status='pending')
+        .values('customer').annotate(total=Sum('remaining_amount')).values('total')
+    )
+    decimal = DecimalField(max_digits=12, decimal_places=2)
+    return Customer.objects.update(
+        balance=Coalesce(Subquery(remaining, output_field=decimal), Value(0), output_field=decimal)
+    )
@@ -0,0 +1,148 @@
+"""Streaming CSV/XLSX exports of sales, debts, expenses and stock receipts.
+
+Rows are read with values_list().iterator(chunk_size=...) (server-side cursors
+where the database has them) and written out as they arrive, so memory stays
+flat however many rows are exported. In the sales history, sales and debt items
+are two ordered streams merged by time.
+"""
+import csv
+import heapq
+from datetime import date, datetime
+from decimal import Decimal
+
+from django.http import StreamingHttpResponse
+from django.utils import timezone
+
+from .models import Shop, Sale, Debt, DebtItem
+from .xlsx import XLSX_CONTENT_TYPE, stream_xlsx
+
+EXPORT_CHUNK_SIZE = 2000
+
+# (header, values_list field) columns of the plain table exports
+SALE_EXPORT_COLUMNS = (
+    ('Tarix', 'timestamp'), ('Mağaza', 'shop__name'), ('Məhsul', 'good__name'),
+    ('Barkod', 'good__barcode'), ('Kateqoriya', 'good__category__name'), ('Miqdar', 'quantity'),
+    ('Ümumi məbləğ', 'total_price'), ('Əməliyyat', 'transaction_id'), ('Geri qaytarılan satış', 'voided_sale_id'),
+    ('Kassir', 'worker__username'),
+)
+
+DEBT_EXPORT_COLUMNS = (
+    ('Tarix', 'created_at'), ('Müştəri', 'customer_name'), ('Telefon', 'customer_phone'),
+    ('Mağaza', 'shop__name'), ('Ümumi məbləğ', 'total_amount'), ('Ödənilən', 'paid_amount'),
+    ('Qalan', 'remaining_amount'), ('Status', 'status'), ('Son tarix', 'due_date'),
+    ('Yaradan', 'created_by__username'), ('Qeyd', 'description'),
+)
+
+EXPENSE_EXPORT_COLUMNS = (
+    ('Tarix', 'expense_date'), ('Mağaza', 'shop__name'), ('Məbləğ', 'amount'),
+    ('Açıqlama', 'description'), ('Əlavə edən', 'created_by__username'),
+)
+
+STOCK_RECEIPT_EXPORT_COLUMNS = (
+    ('Tarix', 'created_at'), ('Məhsul', 'good__name'), ('Barkod', 'good__barcode'),
+    ('Mağaza', 'shop__name'), ('Növ', 'receipt_type'), ('Miqdar', 'quantity'),
+    ('Vahid qiymət', 'unit_cost'), ('Ümumi qiymət', 'total_cost'), ('Təchizatçı', 'supplier'),
+    ('Yaradan', 'created_by__username'), ('Qeyd', 'notes'),
+)
+
+SALES_EXPORT_HEADER = (
+    'Tarix', 'Növ', 'Mağaza', 'Məhsul', 'Barkod', 'Kateqoriya',
+    'Miqdar', 'Vahid qiymət', 'Ümumi məbləğ', 'Müştəri', 'Əməliyyat',
+)
+
+
+class Echo:
+    """File-like object whose write() just hands the line back to the caller"""
+
+    def write(self, value):
+        return value
+
+
+def _sale_rows(filters):
+    rows = (
+        Sale.objects.filter(filters.sales_q())
+        .order_by('timestamp', 'id')
+        .values_list(
+            'timestamp', 'shop_id', 'voided_sale_id', 'shop__name', 'good__name', 'good__barcode',
+            'good__category__name', 'quantity', 'total_price', 'transaction_id', 'id'
+        )
+        .iterator(chunk_size=EXPORT_CHUNK_SIZE)
+    )
+    for timestamp, shop_id, voided_sale_id, shop, good, barcode, category, quantity, total, transaction_id, sale_id in rows:
+        unit_price = (total / quantity).quantize(Decimal('0.01')) if quantity else total
+        yield (
+            timestamp, shop_id, 'Geri qaytarma' if voided_sale_id else 'Satış', shop, good, barcode, category,
+            quantity, unit_price, total, '', transaction_id or f'S{sale_id}',
+        )
+
+
+def _debt_rows(filters):
+    # Same debt rules as the report: non-cancelled debts of the period, one row per item
+    rows = (
+        DebtItem.objects.filter(debt__in=Debt.objects.filter(filters.debts_q()))
+        .order_by('debt__created_at', 'debt_id', 'id')
+        .values_list(
+            'debt__created_at', 'debt__shop_id', 'debt__shop__name', 'good__name', 'good__barcode',
+            'good__category__name', 'quantity', 'unit_price', 'total_price', 'debt__customer_name', 'debt_id'
+        )
+        .iterator(chunk_size=EXPORT_CHUNK_SIZE)
+    )
+    for created_at, shop_id, shop, good, barcode, category, quantity, unit_price, total, customer, debt_id in rows:
+        yield (
+            created_at, shop_id, 'Borc', shop, good, barcode, category, quantity, unit_price, total, customer,
+            f'D{debt_id}',
+        )
+
+
+def sales_export_rows(filters):
+    """Header plus every sale and debt item of the filters, oldest first, in each shop's local time"""
+    yield SALES_EXPORT_HEADER
+    timezones = Shop.timezones()
+    for row in heapq.merge(_sale_rows(filters), _debt_rows(filters), key=lambda row: row[0]):
+        yield (_export_value(row[0], Shop.timezone_of(row[1], timezones)),) + row[2:]
+
+
+def _export_value(value, tz=None):
+    if isinstance(value, datetime):
+        return timezone.localtime(value, tz).strftime('%Y-%m-%d %H:%M:%S')
+    if isinstance(value, date):
+        return value.isoformat()
+    return value
+
+
+def queryset_rows(queryset, columns):
+    """Header plus the columns of every row of queryset, in the queryset's order.
+
+    Dates and times of a shop's rows are in the shop's time zone.
+    """
+    yield tuple(header for header, field in columns)
+    fields = [field for header, field in columns]
+    per_shop = any(field.name == 'shop' for field in queryset.model._meta.concrete_fields)
+    timezones = Shop.timezones() if per_shop else {}
+    shop_field = ['shop_id'] if per_shop else []
+    # Choice fields are exported with their labels
+    choices = {
+        index: dict(queryset.model._meta.get_field(field).flatchoices)
+        for index, field in enumerate(fields)
+        if '__' not in field and queryset.model._meta.get_field(field).choices
+    }
+    for values in queryset.values_list(*fields, *shop_field).iterator(chunk_size=EXPORT_CHUNK_SIZE):
+        tz = Shop.timezone_of(values[-1], timezones) if per_shop else None
+        values = [_export_value(value, tz) for value in values[:len(fields)]]
+        for index, labels in choices.items():
+            values[index] = labels.get(values[index], values[index])
+        yield values
+
+
+def xlsx_response(rows, filename, sheet_name):
+    response = StreamingHttpResponse(stream_xlsx(rows, sheet_name=sheet_name), content_type=XLSX_CONTENT_TYPE)
+    response['Content-Disposition'] = f'attachment; filename="{filename}"'
+    return response
+
+
+def csv_lines(rows):
+    """Encode rows as CSV lines one at a time; starts with a BOM so Excel reads UTF-8"""
+    writer = csv.writer(Echo())
+    yield '\ufeff'
+    for row in rows:
+        yield writer.writerow(row)
@@ -0,0 +1,539 @@
+"""Finance report engine behind finance_dashboard.
+
+ReportFilters resolves the dashboard filters once: the selected period becomes
+local days (for the summary tables, whose dates are local to each shop) and
+half-open [start, end) UTC intervals, one per time zone of the shops in scope,
+that every raw Sale/Debt query compares its timestamp column against.
+compute_report() then reads every metric with a single conditional aggregate
+per source:
+
+* whole days: one query over DailyShopSummary,
+* time-of-day windows and shifts: hourly summaries plus the raw edge hours
+  (see rollups.window_totals),
+* barcode filter: one query each over Sale, Debt and Expense.
+
+The today/week/month revenue cards are cached per (shop, period) and dropped by
+the rollup write paths, so they normally cost no query at all. cached_section()
+keeps the other page sections (summary, first history page, expenses) per filter set with
+stale-while-revalidate semantics; the /api/finance/ endpoints serve them.
+"""
+import hashlib
+import json
+import threading
+from datetime import datetime, time as dt_time, timedelta, timezone as dt_timezone
+from decimal import Decimal
+
+from django.core.cache import cache
+from django.db import connections
+from django.db.models import Sum, Count, Q, F, Value, DecimalField, ExpressionWrapper
+from django.db.models.functions import Coalesce, NullIf
+from django.utils import timezone
+
+from .models import Shop, Good, Sale, Debt, Expense, DailyShopSummary
+from .rollups import (
+    SHIFTS, REPORT_GENERATION_KEY, cache_generation, cached_until_write, card_cache_keys, local_hours_q,
+    summary_aggregates, window_totals
+)
+from .history import history_page
+from .routers import use_primary, use_replica
+
+ZERO = Decimal('0.00')
+
+# Cards are invalidated on every write; the timeout only bounds stale keys of past days
+CARD_CACHE_TIMEOUT = 60 * 60 * 24
+
+# Cached reports are served as-is for REPORT_FRESH_SECONDS after being computed
+# and no write happened since; older ones are served once more while a
+# background thread recomputes them. Entries expire after REPORT_STALE_SECONDS.
+REPORT_FRESH_SECONDS = 60
+REPORT_STALE_SECONDS = 60 * 30
+REPORT_REFRESH_LOCK_SECONDS = 60
+
+COMPARISON_CACHE_TIMEOUT = 60 * 60
+
+# Metrics compared against the previous period
+COMPARED_METRICS = ('total_revenue', 'total_profit', 'net_profit', 'total_expenses', 'items_sold', 'num_sales')
+
+COUNT_FIELDS = ('sales_quantity', 'sales_count', 'debts_quantity', 'debts_count', 'pending_debts_count')
+
+
+class ReportFilters:
+    """Normalized finance filters with the selected period resolved once"""
+
+    def __init__(self, shop_id=None, category_id=None, barcode=None, date_filter='today',
+                 start_date=None, end_date=None, start_time=None, end_time=None,
+                 worker_shift=None, today=None):
+        self.shop_id = shop_id or None
+        self.category_id = category_id or None
+        self.barcode = barcode or None
+        self.date_filter = date_filter or 'today'
+        self.start_date = start_date or None
+        self.end_date = end_date or None
+        self.start_time = start_time or None
+        self.end_time = end_time or None
+        self.shift = worker_shift if worker_shift in SHIFTS else None
+        self._given_today = today
+
+        # [(tzinfo, shop_ids)] of the shops in scope; shop_ids is None when one zone covers them all
+        self.zones = self._zones()
+        # Zone of "today" and of the hour windows: the selected shop's, else the shops' common one
+        self.tz = self.zones[0][0] if len(self.zones) == 1 else timezone.get_default_timezone()
+        self.today = today or timezone.localdate(timezone=self.tz)
+        self.week_start = self.today - timedelta(days=self.today.weekday())
+        self.month_start = self.today.replace(day=1)
+
+        # Either an inclusive range of whole local days, or a [start, end) window
+        # (aware, in self.tz). Both None means no date restriction (custom range
+        # without dates). `intervals` holds the same period as aware UTC
+        # [(tzinfo, shop_ids, start, end)], one per zone, for the raw tables.
+        self.days = None
+        self.window = None
+        self.intervals = []
+        self._bounds = None
+        self._resolve_period()
+
+    @classmethod
+    def from_request(cls, request):
+        params = request.GET
+        return cls(
+            shop_id=params.get('shop'),
+            category_id=params.get('category'),
+            barcode=params.get('barcode'),
+            date_filter=params.get('date_filter', 'today'),
+            start_date=params.get('start_date'),
+            end_date=params.get('end_date'),
+            start_time=params.get('start_time'),
+            end_time=params.get('end_time'),
+            worker_shift=params.get('worker_shift'),
+        )
+
+    def for_shop(self, shop_id):
+        """The same filters for another shop (None: every shop), with the period resolved in its zones"""
+        return ReportFilters(
+            shop_id=shop_id, category_id=self.category_id, barcode=self.barcode, date_filter=self.date_filter,
+            start_date=self.start_date, end_date=self.end_date, start_time=self.start_time,
+            end_time=self.end_time, worker_shift=self.shift, today=self._given_today,
+        )
+
+    def _zones(self):
+        if self.shop_id:
+            try:
+                return [(Shop.timezone_of(self.shop_id), None)]
+            except ValueError:
+                return [(timezone.get_default_timezone(), None)]
+        groups = Shop.timezone_groups()
+        if len(groups) <= 1:
+            return [(groups[0][0] if groups else timezone.get_default_timezone(), None)]
+        return groups
+
+    def _resolve_period(self):
+        if self.date_filter == 'today':
+            self.days = (self.today, self.today)
+        elif self.date_filter == 'week':
+            self.days = (self.week_start, self.today)
+        elif self.date_filter == 'month':
+            self.days = (self.month_start, self.today)
+        elif self.date_filter == 'custom' and self.start_date and self.end_date:
+            try:
+                first = datetime.strptime(self.start_date, '%Y-%m-%d').date()
+                last = datetime.strptime(self.end_date, '%Y-%m-%d').date()
+                if self.start_time or self.end_time:
+                    start = datetime.combine(first, datetime.strptime(self.start_time, '%H:%M').time()
+                                             if self.start_time else dt_time.min)
+                    # Half-open window: up to end_time, or up to the end of end_date
+                    end = (datetime.combine(last, datetime.strptime(self.end_time, '%H:%M').time())
+                           if self.end_time else datetime.combine(last + timedelta(days=1), dt_time.min))
+                    self._bounds = (start, end)
+                else:
+                    self.days = (first, last)
+            except ValueError:
+                pass
+
+        if self.days:
+            self._bounds = (
+                datetime.combine(self.days[0], dt_time.min),
+                datetime.combine(self.days[1] + timedelta(days=1), dt_time.min),
+            )
+        if not self._bounds:
+            return
+        # Local wall-clock bounds, made aware in every zone once
+        self.intervals = [
+            (tz, shop_ids, *(timezone.make_aware(value, tz).astimezone(dt_timezone.utc) for value in self._bounds))
+            for tz, shop_ids in self.zones
+        ]
+        if not self.days or self.shift:
+            # Time-of-day windows, and shifts (the whole selected days, restricted to
+            # the shift hours), need hour buckets
+            self.window = tuple(timezone.make_aware(value, self.tz) for value in self._bounds)
+
+    @property
+    def expense_days(self):
+        """Expenses only have a date: the days touched by the selected period"""
+        if self.window:
+            start, end = self._bounds
+            return (start.date(), (end - timedelta(microseconds=1)).date())
+        return self.days
+
+    def _zone_q(self, q, shop_ids):
+        return q & Q(shop_id__in=shop_ids) if shop_ids is not None else q
+
+    def _period_q(self, field):
+        q = Q()
+        for tz, shop_ids, start, end in self.intervals:
+            q |= self._zone_q(Q(**{f'{field}__gte': start, f'{field}__lt': end}), shop_ids)
+        return q
+
+    def _shift_q(self, field):
+        if not self.shift:
+            return Q()
+        q = Q()
+        for tz, shop_ids in self.zones:
+            q |= self._zone_q(local_hours_q(field, SHIFTS[self.shift], tz), shop_ids)
+        return q
+
+    def sales_q(self):
+        q = self._period_q('timestamp') & self._shift_q('timestamp')
+        if self.shop_id:
+            q &= Q(shop_id=self.shop_id)
+        if self.category_id:
+            q &= Q(good__category_id=self.category_id)
+        if self.barcode:
+            q &= Q(good__barcode__icontains=self.barcode)
+        return q
+
+    def debts_q(self):
+        """All non-cancelled debts of the period (category/barcode never apply to debts)"""
+        q = self._period_q('created_at') & self._shift_q('created_at') & ~Q(status='cancelled')
+        if self.shop_id:
+            q &= Q(shop_id=self.shop_id)
+        return q
+
+    def expenses_q(self):
+        q = Q()
+        days = self.expense_days
+        if days:
+            q &= Q(expense_date__gte=days[0], expense_date__lte=days[1])
+        if self.shop_id:
+            q &= Q(shop_id=self.shop_id)
+        return q
+
+    def cache_key(self, section):
+        """Stable key of a page section for the normalized filters and the day they were resolved on"""
+        values = dict(self.as_dict(), today=str(self.today), zones=[(str(tz), ids) for tz, ids in self.zones])
+        digest = hashlib.sha1(json.dumps(values, sort_keys=True, default=str).encode()).hexdigest()
+        return f'finance_report:{section}:{digest}'
+
+    def as_dict(self):
+        """Filter values as the template expects them"""
+        return {
+            'shop': self.shop_id,
+            'category': self.category_id,
+            'barcode': self.barcode,
+            'date_filter': self.date_filter,
+            'start_date': self.start_date,
+            'end_date': self.end_date,
+            'start_time': self.start_time,
+            'end_time': self.end_time,
+            'worker_shift': self.shift,
+        }
+
+
+def summary_cards(filters):
+    """Today/week/month revenue of the selected shop (or all shops), cached per card.
+
+    Missing cards are computed together with one conditional aggregate.
+    """
+    keys = card_cache_keys(filters.shop_id, filters.today)
+    cached = cache.get_many(keys.values())
+    if len(cached) == len(keys):
+        return {f'{period}_revenue': cached[key] for period, key in keys.items()}
+
+    starts = {'today': filters.today, 'week': filters.week_start, 'month': filters.month_start}
+    rows = DailyShopSummary.objects.filter(date__gte=min(starts.values()), date__lte=filters.today)
+    if filters.shop_id:
+        rows = rows.filter(shop_id=filters.shop_id)
+    revenue = F('sales_revenue') + F('debts_revenue')
+    # Cards are stored under the current generation, so they must see every committed write
+    with use_primary():
+        totals = rows.aggregate(**{
+            period: Sum(revenue, filter=Q(date__gte=start)) for period, start in starts.items()
+        })
+    cards = {keys[period]: Decimal(str(value or 0)) for period, value in totals.items()}
+    cache.set_many(cards, CARD_CACHE_TIMEOUT)
+    return {f'{period}_revenue': cards[key] for period, key in keys.items()}
+
+
+def _summary_report(filters, expenses_only=False):
+    """Period totals in one query over the daily summary.
+
+    With expenses_only the sales/debt totals come from elsewhere (hour windows)
+    and only the expenses of the touched days are summed here.
+    """
+    days = filters.expense_days
+    condition = Q()
+    if days:
+        condition &= Q(date__gte=days[0], date__lte=days[1])
+    if filters.shop_id:
+        condition &= Q(shop_id=filters.shop_id)
+
+    rows = DailyShopSummary.objects.filter(condition)
+    if expenses_only:
+        return rows.aggregate(expenses_total=Sum('expenses_total'))
+    return rows.aggregate(**summary_aggregates(filters.category_id))
+
+
+def _raw_sales_totals(filters):
+    return Sale.objects.filter(filters.sales_q()).aggregate(
+        sales_revenue=Sum('total_price'),
+        sales_quantity=Sum('quantity'),
+        # Void rows are corrections, not extra transactions
+        sales_count=Count('id', filter=Q(voided_sale__isnull=True)),
+        sales_profit=Sum(ExpressionWrapper(
+            F('total_price') - F('cost'),
+            output_field=DecimalField()
+        )),
+    )
+
+
+def _raw_debts_totals(filters):
+    # Profit and item count are stored on Debt at creation: no DebtItem join needed
+    return Debt.objects.filter(filters.debts_q()).aggregate(
+        debts_revenue=Sum('total_amount'),
+        debts_quantity=Sum('items_quantity'),
+        debts_count=Count('id'),
+        debts_profit=Sum('profit'),
+        pending_debts_count=Count('id', filter=Q(status='pending')),
+    )
+
+
+def _stock_value(filters):
+    """Current stock of the filtered goods at their moving average cost (buy price before any receipt)"""
+    goods = Good.objects.all()
+    if filters.shop_id:
+        goods = goods.filter(shop_id=filters.shop_id)
+    if filters.category_id:
+        goods = goods.filter(category_id=filters.category_id)
+    if filters.barcode:
+        goods = goods.filter(barcode__icontains=filters.barcode)
+    value = goods.filter(stock_count__gt=0).aggregate(value=Sum(ExpressionWrapper(
+        # Same unit cost as the inventory report: avg_cost stays 0 until a good's first receipt
+        F('stock_count') * Coalesce(NullIf('avg_cost', Value(0)), 'buy_price'), output_field=DecimalField()
+    )))['value']
+    return Decimal(str(value or 0)).quantize(Decimal('0.01'))
+
+
+def compute_report(filters, cards=True):
+    """Every number shown on the finance page for the given filters.
+
+    cards=False leaves out the today/week/month cards (served separately by summary_cards).
+    """
+    if filters.barcode:
+        # Summaries are not kept per product: read the raw tables
+        totals = _raw_sales_totals(filters)
+        totals.update(_raw_debts_totals(filters))
+        totals.update(Expense.objects.filter(filters.expenses_q()).aggregate(expenses_total=Sum('amount')))
+    elif filters.window or filters.shift:
+        # Hourly rows are in each shop's local hours: one window per time zone
+        windows = filters.intervals or [(tz, shop_ids, None, None) for tz, shop_ids in filters.zones]
+        totals = {}
+        for tz, shop_ids, start, end in windows:
+            part = window_totals(start, end, shop_id=filters.shop_id, category_id=filters.category_id,
+                                 shift=filters.shift, tz=tz, shop_ids=shop_ids)
+            for field, value in part.items():
+                totals[field] = totals.get(field, 0) + value
+        totals.update(_summary_report(filters, expenses_only=True))
+    else:
+        totals = _summary_report(filters)
+    if cards:
+        totals.update(summary_cards(filters))
+
+    if 'pending_debts_count' not in totals:
+        totals['pending_debts_count'] = Debt.objects.filter(filters.debts_q(), status='pending').count()
+
+    # Missing sums come back as None; money is always returned as Decimal
+    totals = {
+        field: (value or 0) if field in COUNT_FIELDS else Decimal(str(value or 0))
+        for field, value in totals.items()
+    }
+
+    total_revenue = totals['sales_revenue'] + totals['debts_revenue']
+    num_sales = totals['sales_count'] + totals['debts_count']
+    total_profit = totals['sales_profit'] + totals['debts_profit']
+
+    return {
+        'total_revenue': total_revenue,
+        'sales_revenue': totals['sales_revenue'],
+        'debts_revenue': totals['debts_revenue'],
+        'total_profit': total_profit,
+        'net_profit': total_profit - totals['expenses_total'],
+        'total_expenses': totals['expenses_total'],
+        'items_sold': totals['sales_quantity'] + totals['debts_quantity'],
+        'num_sales': num_sales,
+        'avg_sale': total_revenue / num_sales if num_sales > 0 else ZERO,
+        'sales_count': totals['sales_count'],
+        'debts_count': totals['debts_count'],
+        'pending_debts_count': totals['pending_debts_count'],
+        'stock_value': _stock_value(filters),
+        **{card: totals[card] for card in ('today_revenue', 'week_revenue', 'month_revenue') if card in totals},
+    }
+
+
+def _comparison_periods(filters):
+    """(current, previous) inclusive day ranges of every comparison"""
+    today = filters.today
+    yesterday = today - timedelta(days=1)
+    last_week = today - timedelta(days=7)
+    previous_month_end = filters.month_start - timedelta(days=1)
+    previous_month_start = previous_month_end.replace(day=1)
+    return {
+        # Week and month are compared up to the same point of the previous period
+        'yesterday': ((today, today), (yesterday, yesterday)),
+        'last_week': ((filters.week_start, today), (filters.week_start - timedelta(days=7), last_week)),
+        'last_month': (
+            (filters.month_start, today),
+            (previous_month_start, previous_month_start.replace(day=min(today.day, previous_month_end.day))),
+        ),
+        'same_weekday': ((today, today), (last_week, last_week)),
+    }
+
+
+def _compare(filters, current, previous):
+    """One conditional aggregate over the daily summary for both periods of a pair"""
+    shop_q = Q(shop_id=filters.shop_id) if filters.shop_id else Q()
+    aggregates = {}
+    for prefix, (first, last) in (('current', current), ('previous', previous)):
+        period_q = shop_q & Q(date__gte=first, date__lte=last)
+        for field, aggregate in summary_aggregates(filters.category_id, condition=period_q).items():
+            aggregates[f'{prefix}_{field}'] = aggregate
+    totals = (
+        DailyShopSummary.objects
+        .filter(date__gte=min(current[0], previous[0]), date__lte=max(current[1], previous[1]))
+        .aggregate(**aggregates)
+    )
+
+    result = {}
+    for prefix in ('current', 'previous'):
+        values = {
+            field[len(prefix) + 1:]: Decimal(str(value or 0))
+            for field, value in totals.items() if field.startswith(f'{prefix}_')
+        }
+        profit = values['sales_profit'] + values['debts_profit']
+        result[prefix] = {
+            'total_revenue': values['sales_revenue'] + values['debts_revenue'],
+            'total_profit': profit,
+            'net_profit': profit - values['expenses_total'],
+            'total_expenses': values['expenses_total'],
+            'items_sold': int(values['sales_quantity'] + values['debts_quantity']),
+            'num_sales': int(values['sales_count'] + values['debts_count']),
+        }
+    return {
+        metric: {
+            'current': result['current'][metric],
+            'previous': result['previous'][metric],
+            'change_percent': (
+                round(float((result['current'][metric] - result['previous'][metric]) * 100
+                            / abs(result['previous'][metric])), 1)
+                if result['previous'][metric] else None
+            ),
+        }
+        for metric in COMPARED_METRICS
+    }
+
+
+def compare_periods(filters):
+    """Every metric of today/this week/this month against the previous equivalent period.
+
+    Pairs: today vs yesterday, this week vs last week and this month vs last
+    month (both up to the same day), today vs the same weekday last week. Each
+    pair is one query over DailyShopSummary; the shop and category filters
+    apply, the selected period and time-of-day filters do not.
+    """
+    def compute():
+        return {
+            name: dict(_compare(filters, current, previous), period={
+                'current': [current[0].isoformat(), current[1].isoformat()],
+                'previous': [previous[0].isoformat(), previous[1].isoformat()],
+            })
+            for name, (current, previous) in _comparison_periods(filters).items()
+        }
+    # Only shop and category change the result: share the entry across the other filters
+    key = ReportFilters(shop_id=filters.shop_id, category_id=filters.category_id, today=filters.today).cache_key('comparison')
+    return cached_until_write(key, compute, COMPARISON_CACHE_TIMEOUT)
+
+
+def expense_list(filters):
+    return Expense.objects.filter(filters.expenses_q()).select_related('shop', 'created_by')
+
+
+def _sales_section(filters):
+    # First page of the history; the page scrolls further with its cursor
+    return history_page(filters)
+
+
+def _expenses_section(filters):
+    return [
+        {
+            'expense_date': expense.expense_date.isoformat(),
+            'shop_name': expense.shop.name,
+            'amount': expense.amount,
+            'description': expense.description,
+            'created_by': expense.created_by.username,
+        }
+        for expense in expense_list(filters)
+    ]
+
+
+# JSON-ready builders of the cacheable finance page sections
+SECTIONS = {
+    'summary': lambda filters: compute_report(filters, cards=False),
+    'sales': _sales_section,
+    'expenses': _expenses_section,
+}
+
+
+def build_section(filters, section):
+    """Compute a page section and store it in the cache"""
+    generation = cache_generation(REPORT_GENERATION_KEY)
+    entry = {
+        'generation': generation,
+        'computed_at': timezone.now(),
+        'data': SECTIONS[section](filters),
+    }
+    cache.set(filters.cache_key(section), entry, REPORT_STALE_SECONDS)
+    return entry
+
+
+def _refresh_section(filters, section, lock_key):
+    try:
+        # A new thread starts outside the request's replica routing
+        with use_replica():
+            build_section(filters, section)
+    finally:
+        cache.delete(lock_key)
+        # The thread opened its own connections; don't leak them
+        connections.close_all()
+
+
+def start_refresh(filters, section, lock_key):
+    threading.Thread(target=_refresh_section, args=(filters, section, lock_key), daemon=True).start()
+
+
+def cached_section(filters, section):
+    """A page section of a filter set from the cache, stale-while-revalidate.
+
+    A miss is computed inline. A stale entry (too old, or written before the last
+    sale/debt/expense change) is returned immediately and recomputed by a single
+    background thread; the cache.add lock keeps concurrent requests from
+    starting more refreshes.
+    """
+    key = filters.cache_key(section)
+    entry = cache.get(key)
+    if entry is None:
+        return build_section(filters, section)
+
+    age = (timezone.now() - entry['computed_at']).total_seconds()
+    if age > REPORT_FRESH_SECONDS or entry['generation'] != cache.get(REPORT_GENERATION_KEY):
+        lock_key = f'{key}:refreshing'
+        if cache.add(lock_key, True, REPORT_REFRESH_LOCK_SECONDS):
+            start_refresh(filters, section, lock_key)
+    return entry
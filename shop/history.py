@@ -0,0 +1,119 @@
+"""Sales and debt history feed of the finance page, newest first.
+
+Sales and non-cancelled debts are two streams ordered by (time, id) and merged
+by (time, kind, id). Pages are keyset-paginated: the cursor is the key of the
+last row shown, and each source reads the next `limit + 1` rows below it, so a
+page costs the same bounded index range read however deep the user scrolls.
+"""
+import base64
+import heapq
+from datetime import datetime
+
+from django.db.models import Q, F
+from django.utils import timezone
+
+from .models import Sale, Debt
+
+HISTORY_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+
+# Merge order of rows sharing a timestamp: 'sale' > 'debt'
+KINDS = ('sale', 'debt')
+
+DEBTS_CATEGORY = 'Borc Satışı'
+
+
+def encode_cursor(timestamp, kind, row_id):
+    value = f'{timestamp.isoformat()}|{kind}|{row_id}'
+    return base64.urlsafe_b64encode(value.encode()).decode()
+
+
+def decode_cursor(cursor):
+    """(timestamp, kind, id) of a cursor; raises ValueError for anything else"""
+    try:
+        timestamp, kind, row_id = base64.urlsafe_b64decode(cursor.encode()).decode().split('|')
+        timestamp, row_id = datetime.fromisoformat(timestamp), int(row_id)
+    except (TypeError, UnicodeError, ValueError) as exc:
+        raise ValueError('cursor') from exc
+    if kind not in KINDS or timezone.is_naive(timestamp):
+        raise ValueError('cursor')
+    return timestamp, kind, row_id
+
+
+def _before(field, kind, cursor):
+    """Rows of the `kind` source whose merge key is below the cursor"""
+    if cursor is None:
+        return Q()
+    timestamp, cursor_kind, row_id = cursor
+    earlier = Q(**{f'{field}__lt': timestamp})
+    if kind == cursor_kind:
+        return earlier | Q(**{field: timestamp, 'id__lt': row_id})
+    if kind < cursor_kind:
+        # Same timestamp, but this kind sorts below the cursor's kind
+        return earlier | Q(**{field: timestamp})
+    return earlier
+
+
+def _sales(filters, cursor, limit):
+    rows = (
+        Sale.objects.filter(filters.sales_q(), _before('timestamp', 'sale', cursor))
+        .order_by('-timestamp', '-id')
+        .values(
+            'id', 'timestamp', 'quantity', 'total_price', 'voided_sale_id',
+            good_name=F('good__name'), category=F('good__category__name'), shop_name=F('shop__name'),
+        )[:limit]
+    )
+    for row in rows:
+        yield (row['timestamp'], 'sale', row['id']), {
+            'type': 'sale',
+            'good_name': row['good_name'],
+            'category': row['category'],
+            'shop_name': row['shop_name'],
+            'quantity': row['quantity'],
+            'total_price': row['total_price'],
+            'is_debt': False,
+            'is_void': row['voided_sale_id'] is not None,
+        }
+
+
+def _debts(filters, cursor, limit):
+    rows = (
+        Debt.objects.filter(filters.debts_q(), _before('created_at', 'debt', cursor))
+        .order_by('-created_at', '-id')
+        .values('id', 'created_at', 'customer_name', 'items_quantity', 'total_amount', 'status',
+                shop_name=F('shop__name'))[:limit]
+    )
+    for row in rows:
+        yield (row['created_at'], 'debt', row['id']), {
+            'type': 'debt',
+            'good_name': f"BORC: {row['customer_name']}",
+            'category': DEBTS_CATEGORY,
+            'shop_name': row['shop_name'],
+            'quantity': row['items_quantity'],
+            'total_price': row['total_amount'],
+            'is_debt': True,
+            'is_void': False,
+            'customer_name': row['customer_name'],
+            'status': row['status'],
+        }
+
+
+def history_page(filters, cursor=None, limit=HISTORY_PAGE_SIZE):
+    """One page of the merged history below cursor, with the cursor of the next page (None at the end).
+
+    Raises ValueError for a malformed cursor.
+    """
+    limit = max(1, min(int(limit), MAX_PAGE_SIZE))
+    position = decode_cursor(cursor) if cursor else None
+    # One extra row per source tells whether another page exists
+    merged = heapq.merge(
+        _sales(filters, position, limit + 1), _debts(filters, position, limit + 1),
+        key=lambda item: item[0], reverse=True
+    )
+    page = [item for _, item in zip(range(limit + 1), merged)]
+    rows = [
+        dict(row, id=key[2], timestamp=timezone.localtime(key[0]).strftime('%Y-%m-%d %H:%M'))
+        for key, row in page[:limit]
+    ]
+    next_cursor = encode_cursor(*page[limit - 1][0]) if len(page) > limit else None
+    return {'rows': rows, 'next': next_cursor}
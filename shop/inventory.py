@@ -0,0 +1,124 @@
+"""Stock analytics per good, materialized into GoodStockSummary.
+
+build_inventory_report() reads the last INVENTORY_WINDOW_DAYS days with three
+grouped queries whatever the number of goods (the goods, their sales and debt
+items from DailyGoodSummary, their stock receipts) and rewrites the table:
+
+* daily velocity: units sold (till and debt) per day of the window,
+* days of cover: current stock / daily velocity,
+* turnover: cost of the units sold / average stock value of the window, the
+  opening stock being today's stock with the window's sales and receipts undone,
+* ABC class by revenue share within the shop: A up to ABC_THRESHOLDS['A'] of
+  the revenue, B up to ABC_THRESHOLDS['B'], C for the rest and unsold goods.
+
+Run nightly with `manage.py rebuild_inventory_report`; the inventory page only
+reads the table.
+"""
+from collections import defaultdict
+from datetime import datetime, time as dt_time, timedelta
+from decimal import Decimal
+
+from django.db import transaction
+from django.db.models import Q, Sum
+from django.utils import timezone
+
+from .models import Shop, Good, StockReceipt, DailyGoodSummary, GoodStockSummary
+
+INVENTORY_WINDOW_DAYS = 30
+
+# Cumulative revenue share of the shop covered by the A and B goods
+ABC_THRESHOLDS = {'A': Decimal('0.80'), 'B': Decimal('0.95')}
+
+BATCH_SIZE = 2000
+
+CENT = Decimal('0.01')
+
+
+def _abc_classes(revenues):
+    """{good_id: class} for the {good_id: revenue} of one shop"""
+    total = sum(revenue for revenue in revenues.values() if revenue > 0)
+    classes, covered = {}, Decimal('0')
+    for good_id, revenue in sorted(revenues.items(), key=lambda item: (-item[1], item[0])):
+        if revenue <= 0:
+            classes[good_id] = 'C'
+            continue
+        # A good belongs to the class its first unit of revenue falls in
+        share = covered / total
+        classes[good_id] = 'A' if share < ABC_THRESHOLDS['A'] else 'B' if share < ABC_THRESHOLDS['B'] else 'C'
+        covered += revenue
+    return classes
+
+
+@transaction.atomic
+def build_inventory_report(today=None, window_days=INVENTORY_WINDOW_DAYS):
+    """Recompute GoodStockSummary for every good; returns the number of rows written.
+
+    The window ends on each shop's local today (or on `today`) and starts at its local midnight.
+    """
+    days, in_window, received_in_window = {}, Q(), Q()
+    for tz, shop_ids in Shop.timezone_groups():
+        last_day = today or timezone.localdate(timezone=tz)
+        first_day = last_day - timedelta(days=window_days - 1)
+        days.update(dict.fromkeys(shop_ids, last_day))
+        in_window |= Q(shop_id__in=shop_ids, date__gte=first_day, date__lte=last_day)
+        received_in_window |= Q(
+            shop_id__in=shop_ids, created_at__gte=timezone.make_aware(datetime.combine(first_day, dt_time.min), tz)
+        )
+
+    goods = list(Good.objects.values_list('id', 'shop_id', 'stock_count', 'avg_cost', 'buy_price'))
+    sold = {
+        row['good_id']: row
+        for row in DailyGoodSummary.objects.filter(in_window)
+        .values('good_id').annotate(quantity=Sum('quantity'), revenue=Sum('revenue'), profit=Sum('profit'))
+        .order_by()
+    }
+    received = dict(
+        StockReceipt.objects.filter(received_in_window)
+        .values('good_id').annotate(quantity=Sum('quantity')).order_by()
+        .values_list('good_id', 'quantity')
+    )
+
+    revenues = defaultdict(dict)
+    for good_id, shop_id, *_ in goods:
+        revenues[shop_id][good_id] = sold.get(good_id, {}).get('revenue') or Decimal('0')
+    classes = {}
+    shop_revenue = {}
+    for shop_id, shop_goods in revenues.items():
+        classes.update(_abc_classes(shop_goods))
+        shop_revenue[shop_id] = sum(revenue for revenue in shop_goods.values() if revenue > 0)
+
+    rows = []
+    for good_id, shop_id, stock_count, avg_cost, buy_price in goods:
+        unit_cost = avg_cost or buy_price
+        sales = sold.get(good_id, {})
+        quantity = sales.get('quantity') or 0
+        revenue = revenues[shop_id][good_id]
+        cost = revenue - (sales.get('profit') or Decimal('0'))
+        velocity = Decimal(quantity) / window_days
+
+        stock = max(stock_count, 0)
+        opening = max(stock + quantity - received.get(good_id, 0), 0)
+        average_value = (stock + opening) * unit_cost / 2
+        rows.append(GoodStockSummary(
+            shop_id=shop_id,
+            good_id=good_id,
+            computed_on=days[shop_id],
+            window_days=window_days,
+            stock_count=stock_count,
+            stock_value=(stock * unit_cost).quantize(CENT),
+            quantity_sold=quantity,
+            revenue=revenue,
+            cost=cost,
+            daily_velocity=velocity.quantize(Decimal('0.0001')),
+            days_of_cover=(stock / velocity).quantize(Decimal('0.1')) if velocity > 0 else None,
+            turnover=(cost / average_value).quantize(CENT) if average_value > 0 else None,
+            revenue_share=(
+                (max(revenue, Decimal('0')) / shop_revenue[shop_id]).quantize(Decimal('0.0001'))
+                if shop_revenue[shop_id] else Decimal('0')
+            ),
+            abc_class=classes[good_id],
+        ))
+
+    GoodStockSummary.objects.all().delete()
+    GoodStockSummary.objects.bulk_create(rows, batch_size=BATCH_SIZE)
+    return len(rows)
@@ -0,0 +1,93 @@
+"""Best- and worst-seller rankings for /api/finance/leaderboard/.
+
+Rankings read DailyGoodSummary: the per-day rows of the period are summed and
+ordered in the database, so only the top `limit` rows come back whatever the
+history size. Goods are ranked from the Good side with the period joined in
+(FilteredRelation), so goods without a sale in the period still take part in
+the worst-seller ranking.
+"""
+from django.db.models import Sum, Q, F, FilteredRelation, Value, DecimalField, IntegerField
+from django.db.models.functions import Coalesce
+
+from .models import Good, DailyGoodSummary
+from .rollups import cached_until_write
+
+METRICS = ('quantity', 'revenue', 'profit')
+LEVELS = ('good', 'category')
+MAX_LIMIT = 100
+
+LEADERBOARD_CACHE_TIMEOUT = 60 * 60
+
+
+def _period_q(days, prefix=''):
+    if not days:
+        return Q()
+    return Q(**{f'{prefix}date__gte': days[0], f'{prefix}date__lte': days[1]})
+
+
+def _totals(prefix):
+    money = DecimalField(max_digits=14, decimal_places=2)
+    return {
+        'quantity': Coalesce(Sum(f'{prefix}quantity'), Value(0), output_field=IntegerField()),
+        'revenue': Coalesce(Sum(f'{prefix}revenue'), Value(0), output_field=money),
+        'profit': Coalesce(Sum(f'{prefix}profit'), Value(0), output_field=money),
+    }
+
+
+def _goods(filters, days, order_by, limit):
+    goods = Good.objects.all()
+    if filters.shop_id:
+        goods = goods.filter(shop_id=filters.shop_id)
+    if filters.category_id:
+        goods = goods.filter(category_id=filters.category_id)
+    if filters.barcode:
+        goods = goods.filter(barcode__icontains=filters.barcode)
+    goods = (
+        goods.annotate(period=FilteredRelation('daily_totals', condition=_period_q(days, 'daily_totals__')))
+        .values('id', 'name', 'barcode', shop_name=F('shop__name'), category_name=F('category__name'))
+        .annotate(**_totals('period__'))
+        .order_by(order_by, 'name', 'id')
+    )
+    return list(goods[:limit])
+
+
+def _categories(filters, days, order_by, limit):
+    rows = DailyGoodSummary.objects.filter(_period_q(days))
+    if filters.shop_id:
+        rows = rows.filter(shop_id=filters.shop_id)
+    if filters.category_id:
+        rows = rows.filter(good__category_id=filters.category_id)
+    if filters.barcode:
+        rows = rows.filter(good__barcode__icontains=filters.barcode)
+    rows = (
+        rows.values('good__category_id', 'good__category__name')
+        .annotate(**_totals(''))
+        .order_by(order_by, 'good__category__name')
+    )
+    return [
+        {
+            'id': row.pop('good__category_id'),
+            'name': row.pop('good__category__name'),
+            **row,
+        }
+        for row in rows[:limit]
+    ]
+
+
+def leaderboard(filters, metric='quantity', level='good', worst=False, limit=10):
+    """The `limit` best (or worst) goods or categories of the filtered period by metric.
+
+    Debt items count as sales. Time-of-day windows and shifts are widened to
+    the whole days they touch. Raises ValueError for unknown options.
+    """
+    if metric not in METRICS or level not in LEVELS:
+        raise ValueError(metric)
+    limit = max(1, min(int(limit), MAX_LIMIT))
+    order_by = metric if worst else f'-{metric}'
+    days = filters.expense_days
+    rank = _goods if level == 'good' else _categories
+    return cached_until_write(
+        filters.cache_key(f'leaderboard:{level}:{order_by}:{limit}'),
+        lambda: rank(filters, days, order_by, limit),
+        LEADERBOARD_CACHE_TIMEOUT
+    )
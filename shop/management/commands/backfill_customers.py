@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from shop.debts import backfill_customers
+
+
+class Command(BaseCommand):
+    help = 'Link debts without a customer to one (by phone, else by name) and recompute every customer balance'
+
+    def handle(self, *args, **options):
+        created, linked = backfill_customers()
+        self.stdout.write(self.style.SUCCESS(f'{linked} debts linked, {created} customers created, balances recomputed'))
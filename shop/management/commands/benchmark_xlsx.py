@@ -0,0 +1,66 @@
+import resource
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+from decimal import Decimal
+
+from django.core.management.base import BaseCommand
+
+from shop.exports import SALES_EXPORT_HEADER
+from shop.xlsx import stream_xlsx
+
+
+def synthetic_rows(count):
+    """Header plus count rows shaped like the finance sales export, without touching the database"""
+    yield SALES_EXPORT_HEADER
+    start = datetime(2024, 1, 1, 9)
+    for number in range(count):
+        yield (
+            (start + timedelta(seconds=number)).strftime('%Y-%m-%d %H:%M:%S'), 'Satış', f'Mağaza {number % 7 + 1}',
+            f'Məhsul {number % 500}', f'{4760000000000 + number % 500}', 'Ərzaq', number % 5 + 1, Decimal('12.50'),
+            Decimal(number % 5 + 1) * Decimal('12.50'), '', f'TX{number:010d}',
+        )
+
+
+class Command(BaseCommand):
+    help = 'Stream synthetic sale rows through the XLSX writer and report time, size and memory'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=1000000)
+        parser.add_argument('--output', help='Also write the workbook to this path')
+        parser.add_argument(
+            '--trace-memory', action='store_true',
+            help='Also report the tracemalloc peak (a second, much slower pass)',
+        )
+
+    def write(self, rows, output=None):
+        """(bytes, chunks) of the workbook of rows"""
+        size = chunks = 0
+        for chunk in stream_xlsx(synthetic_rows(rows), 'Satışlar'):
+            size += len(chunk)
+            chunks += 1
+            if output:
+                output.write(chunk)
+        return size, chunks
+
+    def handle(self, *args, **options):
+        started = time.perf_counter()
+        if options['output']:
+            with open(options['output'], 'wb') as output:
+                size, chunks = self.write(options['rows'], output)
+        else:
+            size, chunks = self.write(options['rows'])
+        elapsed = time.perf_counter() - started
+        # ru_maxrss is in kilobytes on Linux
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+        self.stdout.write(self.style.SUCCESS(
+            f"{options['rows']} rows of {len(SALES_EXPORT_HEADER)} columns in {elapsed:.1f} s: "
+            f'{size / 1e6:.1f} MB in {chunks} chunks, {max_rss:.0f} MB max RSS'
+        ))
+
+        if options['trace_memory']:
+            tracemalloc.start()
+            self.write(options['rows'])
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            self.stdout.write(self.style.SUCCESS(f'{peak / 1e6:.1f} MB peak traced'))
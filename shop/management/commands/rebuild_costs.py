@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+
+from shop.costing import cost_method, rebuild_costs
+from shop.rollups import rebuild_summaries
+
+
+class Command(BaseCommand):
+    help = 'Replay the stock history to rebuild cost layers and the cost of every sale and debt item'
+
+    def handle(self, *args, **options):
+        layers, sales, items = rebuild_costs()
+        self.stdout.write(self.style.SUCCESS(
+            f'{layers} cost layers, {sales} sales and {items} debt items costed ({cost_method()}); average costs updated'
+        ))
+        # Profit in the summaries follows the new costs
+        rebuild_summaries()
+        self.stdout.write(self.style.SUCCESS('Finance summaries rebuilt'))
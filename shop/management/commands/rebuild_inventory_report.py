@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+
+from shop.inventory import INVENTORY_WINDOW_DAYS, build_inventory_report
+
+
+class Command(BaseCommand):
+    help = 'Recompute stock analytics (days of cover, turnover, ABC class) for every good; run nightly'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--window-days', type=int, default=INVENTORY_WINDOW_DAYS,
+            help=f'Days of sales the analytics look back on (default {INVENTORY_WINDOW_DAYS})'
+        )
+
+    def handle(self, *args, **options):
+        rows = build_inventory_report(window_days=options['window_days'])
+        self.stdout.write(self.style.SUCCESS(f'Stock analytics of {rows} goods rebuilt'))
@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+
+from shop.rollups import rebuild_summaries
+
+
+class Command(BaseCommand):
+    help = 'Regenerate the finance summary tables from raw sales, debts and expenses'
+
+    def handle(self, *args, **options):
+        daily, hourly, goods, shifts = rebuild_summaries()
+        self.stdout.write(self.style.SUCCESS(
+            f'{daily} daily, {hourly} hourly, {goods} per-good and {shifts} worker shift summary rows rebuilt'
+        ))
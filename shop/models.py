@@ -1,12 +1,88 @@
-from django.db import models
+import zoneinfo
+from django.db import models, transaction
+from django.db.models import F, Case, When, Value
+from django.db.models.functions import Greatest
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
 from django.core.validators import MinValueValidator
 from django.contrib.auth.models import User
 from datetime import datetime
 from django.utils import timezone
 from decimal import Decimal
 
+# {shop_id: timezone name} of every shop, dropped whenever a shop is saved or deleted
+SHOP_TIMEZONES_CACHE_KEY = 'shop_timezones'
+SHOP_TIMEZONES_CACHE_TIMEOUT = 60 * 5
+
+
+def validate_timezone(value):
+    if value not in zoneinfo.available_timezones():
+        raise ValidationError(f'{value} tanınmayan saat qurşağıdır')
+
+
+def _rebuild_shop_summaries(shop_id):
+    from .rollups import rebuild_summaries  # rollups imports the models
+
+    # Another request may have cached the old zone before the commit
+    cache.delete(SHOP_TIMEZONES_CACHE_KEY)
+    rebuild_summaries(shop_ids=[shop_id])
+
+
 class Shop(models.Model):
     name = models.CharField(max_length=200, unique=True)
+    # Local time of the shop: its report days, hours and shifts
+    timezone = models.CharField(
+        max_length=64, default=settings.TIME_ZONE, validators=[validate_timezone], verbose_name="Saat qurşağı"
+    )
+
+    @property
+    def tzinfo(self):
+        return zoneinfo.ZoneInfo(self.timezone)
+
+    @classmethod
+    def timezones(cls):
+        """{shop_id: ZoneInfo} of every shop, cached"""
+        names = cache.get(SHOP_TIMEZONES_CACHE_KEY)
+        if names is None:
+            names = dict(cls.objects.values_list('id', 'timezone'))
+            cache.set(SHOP_TIMEZONES_CACHE_KEY, names, SHOP_TIMEZONES_CACHE_TIMEOUT)
+        return {shop_id: zoneinfo.ZoneInfo(name) for shop_id, name in names.items()}
+
+    @classmethod
+    def timezone_of(cls, shop_id, timezones=None):
+        """ZoneInfo of a shop; the default time zone for an unknown shop"""
+        timezones = cls.timezones() if timezones is None else timezones
+        return timezones.get(int(shop_id), timezone.get_default_timezone())
+
+    @classmethod
+    def timezone_groups(cls):
+        """[(ZoneInfo, [shop_id, ...])] of the shops sharing each time zone, by zone name"""
+        groups = {}
+        for shop_id, tz in sorted(cls.timezones().items()):
+            groups.setdefault(tz, []).append(shop_id)
+        return sorted(groups.items(), key=lambda group: group[0].key)
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        shop = super().from_db(db, field_names, values)
+        # Stored time zone, to notice a change in save()
+        shop._saved_timezone = shop.__dict__.get('timezone')
+        return shop
+
+    def save(self, *args, **kwargs):
+        moved = getattr(self, '_saved_timezone', None) not in (None, self.timezone)
+        super().save(*args, **kwargs)
+        self._saved_timezone = self.timezone
+        cache.delete(SHOP_TIMEZONES_CACHE_KEY)
+        if moved:
+            # The shop's summary days and hours are local: redo them in the new zone once it is committed
+            transaction.on_commit(lambda shop_id=self.pk: _rebuild_shop_summaries(shop_id))
+
+    def delete(self, *args, **kwargs):
+        result = super().delete(*args, **kwargs)
+        cache.delete(SHOP_TIMEZONES_CACHE_KEY)
+        return result
 
     def __str__(self):
         return self.name
@@ -49,6 +125,8 @@ class Good(models.Model):
         default=0,
         validators=[MinValueValidator(0)]
     )
+    # Moving weighted-average unit cost of the stock, kept by the stock receipts
+    avg_cost = models.DecimalField(max_digits=12, decimal_places=4, default=0, verbose_name="Orta maya dəyəri")
     barcode = models.CharField(max_length=100, db_index=True)
     category = models.ForeignKey(
         'Category', 
@@ -75,6 +153,25 @@ class Good(models.Model):
         limit_choices_to={'product_type': 'cigarette_pack'},
         related_name='related_singles'
     )
+
+    def receive_stock(self, quantity, unit_cost):
+        """Add received units (negative: take them back), keeping avg_cost the moving weighted average.
+
+        Stock from before the first receipt is valued at buy_price.
+        """
+        self.avg_cost = moving_average_cost(self.stock_count, self.avg_cost or self.buy_price, quantity, unit_cost)
+        self.stock_count += quantity
+
+    @classmethod
+    def add_to_stock(cls, quantities):
+        """Atomically add {good_id: quantity} (negative to take out) to the stock counts with one UPDATE"""
+        quantities = {good_id: quantity for good_id, quantity in quantities.items() if quantity}
+        if quantities:
+            cls.objects.filter(pk__in=quantities).update(stock_count=F('stock_count') + Case(
+                *(When(pk=good_id, then=Value(quantity)) for good_id, quantity in quantities.items()),
+                output_field=models.IntegerField()
+            ))
+
     def __str__(self):
         shop_name = self.shop.name if self.shop else "No Shop"
         return f"{self.name} - {shop_name}"
@@ -85,18 +182,83 @@ class Good(models.Model):
             models.Index(fields=['barcode', 'shop']),
         ]
 
+
+def moving_average_cost(stock_count, avg_cost, quantity, unit_cost):
+    """Average unit cost after quantity units at unit_cost come in (or, if negative, are taken back)"""
+    before = max(stock_count, 0)
+    after = before + quantity
+    if after <= 0:
+        # Nothing left to average: the last known cost stays
+        return avg_cost if quantity < 0 else Decimal(unit_cost)
+    average = (before * Decimal(avg_cost) + quantity * Decimal(unit_cost)) / after
+    return max(average, Decimal('0')).quantize(Decimal('0.0001'))
+
+
 class Sale(models.Model):
-    good = models.ForeignKey(Good, on_delete=models.CASCADE, related_name='sales')
-    quantity = models.IntegerField(validators=[MinValueValidator(1)])
-    total_price = models.DecimalField(max_digits=10, decimal_places=2, validators=[MinValueValidator(0)])
+    # PROTECT: deleting a good or shop must not take its sales out from under the summaries
+    good = models.ForeignKey(Good, on_delete=models.PROTECT, related_name='sales')
+    # Positive on sales, negative on void rows (see clean())
+    quantity = models.IntegerField()
+    total_price = models.DecimalField(max_digits=10, decimal_places=2)
     timestamp = models.DateTimeField(default=datetime.now)  # ← Use datetime.now
-    shop = models.ForeignKey(Shop, on_delete=models.CASCADE, related_name='sales')
+    shop = models.ForeignKey(Shop, on_delete=models.PROTECT, related_name='sales')
+    # All lines of one checkout share the request_id sent by the till
+    transaction_id = models.CharField(max_length=64, blank=True, db_index=True)
+    # Set on compensating (negative) rows written by a void/return
+    voided_sale = models.ForeignKey(
+        'self',
+        on_delete=models.CASCADE,
+        null=True,
+        blank=True,
+        related_name='voids'
+    )
+    # Cost of goods sold for the line (see shop.costing); negative on void rows
+    cost = models.DecimalField(max_digits=12, decimal_places=2, default=0, verbose_name="Maya dəyəri")
+    # Cashier logged in at the till; void rows keep the original sale's cashier
+    worker = models.ForeignKey(
+        User,
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+        related_name='sales',
+        verbose_name="Kassir"
+    )
+
+    @property
+    def is_void(self):
+        return self.voided_sale_id is not None
+
+    def clean(self):
+        """Sales sell at least one unit for a non-negative price; void rows reverse them with the opposite sign"""
+        super().clean()
+        sign = -1 if self.is_void else 1
+        errors = {}
+        if self.quantity is not None and sign * self.quantity < 1:
+            errors['quantity'] = 'Satışda miqdar müsbət, ləğvdə mənfi olmalıdır'
+        if self.total_price is not None and sign * self.total_price < 0:
+            errors['total_price'] = 'Satışda məbləğ mənfi, ləğvdə müsbət ola bilməz'
+        if errors:
+            raise ValidationError(errors)
 
     def __str__(self):
         return f"{self.good.name} x{self.quantity} - {self.timestamp.strftime('%Y-%m-%d %H:%M')}"
 
     class Meta:
         ordering = ['-timestamp']
+        # Keyset pages of the finance history: (timestamp, id) ranges, optionally per shop
+        indexes = [
+            models.Index(fields=['timestamp', 'id']),
+            models.Index(fields=['shop', 'timestamp', 'id']),
+            models.Index(fields=['worker', 'timestamp']),
+        ]
+        # A void request (its request_id is the transaction_id of its rows) reverses each line once
+        constraints = [
+            models.UniqueConstraint(
+                fields=['transaction_id', 'voided_sale'],
+                condition=models.Q(voided_sale__isnull=False),
+                name='unique_void_line',
+            ),
+        ]
 
 
 class Worker(models.Model):
@@ -126,6 +288,71 @@ class Expense(models.Model):
     class Meta:
         ordering = ['-expense_date', '-created_at']
 
+def normalize_customer_name(name):
+    """Case- and whitespace-insensitive form of a customer name"""
+    return ' '.join((name or '').split()).casefold()
+
+
+def normalize_phone(phone):
+    """Digits of a phone number: '+994 (50) 123-45-67' -> '994501234567'"""
+    return ''.join(char for char in (phone or '') if char.isdigit())
+
+
+class Customer(models.Model):
+    """A debtor; the phone identifies them, or the normalized name when there is no phone"""
+    name = models.CharField(max_length=200, verbose_name="Ad")
+    normalized_name = models.CharField(max_length=200, editable=False)
+    phone = models.CharField(max_length=20, blank=True, verbose_name="Telefon")
+    # Remaining amount of the pending debts, kept by create_debt/pay_debt/cancel_debt
+    balance = models.DecimalField(max_digits=12, decimal_places=2, default=0, verbose_name="Qalıq borc")
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def save(self, *args, **kwargs):
+        self.normalized_name = normalize_customer_name(self.name)
+        self.phone = normalize_phone(self.phone)
+        super().save(*args, **kwargs)
+
+    @classmethod
+    def for_debt(cls, name, phone):
+        """The customer of a new debt, created on first use"""
+        phone = normalize_phone(phone)
+        if phone:
+            lookup = {'phone': phone}
+        else:
+            lookup = {'phone': '', 'normalized_name': normalize_customer_name(name)}
+        customer, created = cls.objects.get_or_create(**lookup, defaults={'name': ' '.join(name.split())})
+        return customer
+
+    @classmethod
+    def add_to_balance(cls, customer_id, amount):
+        """Atomically add amount (negative to subtract) to a customer's balance"""
+        if customer_id and amount:
+            cls.objects.filter(pk=customer_id).update(balance=F('balance') + amount)
+
+    def __str__(self):
+        return f"{self.name} ({self.phone})" if self.phone else self.name
+
+    class Meta:
+        verbose_name = "Müştəri"
+        verbose_name_plural = "Müştərilər"
+        ordering = ['name']
+        constraints = [
+            # One customer per phone, and per name among those without a phone
+            models.UniqueConstraint(fields=['phone'], condition=~models.Q(phone=''), name='unique_customer_phone'),
+            models.UniqueConstraint(
+                fields=['normalized_name'], condition=models.Q(phone=''), name='unique_customer_name_without_phone'
+            ),
+        ]
+        # Prefix search (debts.search_customers): LIKE 'prefix%' can use a pattern_ops index on
+        # PostgreSQL whatever the database collation; other backends ignore the opclass
+        indexes = [
+            models.Index(fields=['phone'], name='customer_phone_prefix', opclasses=['varchar_pattern_ops']),
+            models.Index(
+                fields=['normalized_name'], name='customer_name_prefix', opclasses=['varchar_pattern_ops']
+            ),
+        ]
+
+
 class Debt(models.Model):
     DEBT_STATUS = [
         ('pending', 'Gözləyir'),
@@ -135,10 +362,16 @@ class Debt(models.Model):
 
     customer_name = models.CharField(max_length=200, verbose_name="Müştəri adı")
     customer_phone = models.CharField(max_length=20, blank=True, verbose_name="Telefon")
-    shop = models.ForeignKey(Shop, on_delete=models.CASCADE, verbose_name="Mağaza")
+    customer = models.ForeignKey(
+        Customer, on_delete=models.PROTECT, null=True, blank=True, related_name='debts', verbose_name="Müştəri"
+    )
+    shop = models.ForeignKey(Shop, on_delete=models.PROTECT, verbose_name="Mağaza")
     total_amount = models.DecimalField(max_digits=10, decimal_places=2, verbose_name="Ümumi məbləğ")
     paid_amount = models.DecimalField(max_digits=10, decimal_places=2, default=0, verbose_name="Ödənilən məbləğ")
     remaining_amount = models.DecimalField(max_digits=10, decimal_places=2, verbose_name="Qalan məbləğ")
+    # Filled from the items when the debt is created, so reports never need to join DebtItem
+    profit = models.DecimalField(max_digits=10, decimal_places=2, default=0, verbose_name="Mənfəət")
+    items_quantity = models.PositiveIntegerField(default=0, verbose_name="Məhsul sayı")
     status = models.CharField(max_length=20, choices=DEBT_STATUS, default='pending', verbose_name="Status")
     due_date = models.DateField(verbose_name="Son tarix")
     description = models.TextField(blank=True, verbose_name="Qeyd")
@@ -159,14 +392,22 @@ class Debt(models.Model):
         verbose_name = "Borc"
         verbose_name_plural = "Borclar"
         ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['created_at', 'id']),
+            models.Index(fields=['shop', 'created_at', 'id']),
+            # Debt list: shop/status filters, overdue (due_date < today) and the due-date pages
+            models.Index(fields=['shop', 'status', 'due_date']),
+        ]
 
 
 class DebtItem(models.Model):
     debt = models.ForeignKey(Debt, on_delete=models.CASCADE, related_name='items')
-    good = models.ForeignKey(Good, on_delete=models.CASCADE)
+    good = models.ForeignKey(Good, on_delete=models.PROTECT)
     quantity = models.PositiveIntegerField(default=1)
     unit_price = models.DecimalField(max_digits=10, decimal_places=2)
     total_price = models.DecimalField(max_digits=10, decimal_places=2)
+    # Cost of goods sold for the item (see shop.costing)
+    cost = models.DecimalField(max_digits=12, decimal_places=2, default=0, verbose_name="Maya dəyəri")
 
     def save(self, *args, **kwargs):
         self.total_price = self.unit_price * self.quantity
@@ -210,27 +451,64 @@ class StockReceipt(models.Model):
         self.total_cost = quantity_decimal * unit_cost_decimal
         
         # Check if this is a new record or an update
-        if self.pk is None:  # New record
-            # Update good stock count
-            self.good.stock_count += self.quantity
+        is_new = self.pk is None
+        if is_new:  # New record
+            # Update good stock count and average cost
+            self.good.receive_stock(self.quantity, self.unit_cost)
             self.good.save()
         else:  # Updating existing record
             # Get the old receipt to calculate the difference
             old_receipt = StockReceipt.objects.get(pk=self.pk)
             quantity_diff = self.quantity - old_receipt.quantity
             
-            # Update good stock count by the difference
-            self.good.stock_count += quantity_diff
+            # Take the old receipt back out, then add it as it is now
+            self.good.receive_stock(-old_receipt.quantity, old_receipt.unit_cost)
+            self.good.receive_stock(self.quantity, self.unit_cost)
             self.good.save()
+
+            # Units already sold keep the cost they were sold at
+            CostLayer.objects.filter(receipt=self).update(
+                quantity=self.quantity,
+                remaining=Greatest(F('remaining') + quantity_diff, 0),
+                unit_cost=self.unit_cost
+            )
         
         super().save(*args, **kwargs)
+
+        if is_new:
+            # The delivery becomes a cost layer of the COGS engine
+            CostLayer.objects.create(
+                good=self.good, receipt=self, received_at=self.created_at,
+                quantity=self.quantity, remaining=self.quantity, unit_cost=self.unit_cost
+            )
     
     def delete(self, *args, **kwargs):
         # When deleting a receipt, subtract the quantity from stock
-        self.good.stock_count -= self.quantity
+        # (its cost layer is deleted with it)
+        self.good.receive_stock(-self.quantity, self.unit_cost)
         self.good.save()
         super().delete(*args, **kwargs)
     
+    @classmethod
+    @transaction.atomic
+    def bulk_receive(cls, receipts):
+        """Create unsaved receipts in bulk: one stock/avg_cost write per good, receipts and layers in batches"""
+        goods = Good.objects.select_for_update().in_bulk({receipt.good_id for receipt in receipts})
+        for receipt in receipts:
+            receipt.good = goods[receipt.good_id]
+            receipt.total_cost = receipt.quantity * Decimal(str(receipt.unit_cost))
+            receipt.good.receive_stock(receipt.quantity, receipt.unit_cost)
+        Good.objects.bulk_update(goods.values(), ['stock_count', 'avg_cost'])
+        created = cls.objects.bulk_create(receipts)
+        CostLayer.objects.bulk_create(
+            CostLayer(
+                good_id=receipt.good_id, receipt=receipt, received_at=receipt.created_at,
+                quantity=receipt.quantity, remaining=receipt.quantity, unit_cost=receipt.unit_cost
+            )
+            for receipt in created
+        )
+        return created
+
     def __str__(self):
         return f"{self.good.name} - {self.quantity} adet - {self.created_at.strftime('%Y-%m-%d %H:%M')}"
     
@@ -238,3 +516,222 @@ class StockReceipt(models.Model):
         ordering = ['-created_at']
         verbose_name = "Stok Qəbulu"
         verbose_name_plural = "Stok Qəbulları"
+
+
+class CostLayer(models.Model):
+    """Units of a good that came in at one unit cost: a stock receipt, or goods back from a void/cancel.
+
+    Sales and debts take units out of the open layers (see shop.costing).
+    """
+    good = models.ForeignKey(Good, on_delete=models.CASCADE, related_name='cost_layers')
+    receipt = models.OneToOneField(
+        StockReceipt, on_delete=models.CASCADE, null=True, blank=True, related_name='cost_layer'
+    )
+    received_at = models.DateTimeField()
+    quantity = models.IntegerField()
+    remaining = models.IntegerField()
+    unit_cost = models.DecimalField(max_digits=12, decimal_places=4)
+
+    def __str__(self):
+        return f"{self.good.name} - {self.remaining}/{self.quantity} x {self.unit_cost}"
+
+    class Meta:
+        ordering = ['received_at', 'id']
+        verbose_name = "Maya Qatı"
+        verbose_name_plural = "Maya Qatları"
+        indexes = [
+            models.Index(fields=['good', 'received_at', 'id'], condition=models.Q(remaining__gt=0), name='open_cost_layers'),
+        ]
+
+
+class DailyShopSummary(models.Model):
+    """Per-shop daily totals, kept up to date by the sale/debt/expense write paths.
+
+    Sales are split by category; debts and expenses have no category and are
+    stored on the row with category=NULL.
+    """
+    shop = models.ForeignKey(Shop, on_delete=models.CASCADE, related_name='daily_summaries')
+    date = models.DateField()
+    category = models.ForeignKey(Category, on_delete=models.CASCADE, null=True, blank=True)
+
+    sales_revenue = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    sales_quantity = models.IntegerField(default=0)
+    sales_count = models.IntegerField(default=0)
+    sales_profit = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+
+    debts_revenue = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    debts_quantity = models.IntegerField(default=0)
+    debts_count = models.IntegerField(default=0)
+    debts_profit = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+
+    expenses_total = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+
+    def __str__(self):
+        return f"{self.shop.name} - {self.date}"
+
+    class Meta:
+        ordering = ['-date']
+        verbose_name = "Günlük Hesabat"
+        verbose_name_plural = "Günlük Hesabatlar"
+        constraints = [
+            models.UniqueConstraint(fields=['shop', 'date', 'category'], name='unique_daily_summary'),
+            models.UniqueConstraint(
+                fields=['shop', 'date'],
+                condition=models.Q(category__isnull=True),
+                name='unique_daily_summary_no_category'
+            ),
+        ]
+        indexes = [
+            models.Index(fields=['date', 'shop']),
+        ]
+
+
+class DailyGoodSummary(models.Model):
+    """Per-good daily sales (including debt items), kept up to date like DailyShopSummary.
+
+    Backs the best/worst-seller rankings.
+    """
+    shop = models.ForeignKey(Shop, on_delete=models.CASCADE, related_name='daily_good_summaries')
+    good = models.ForeignKey(Good, on_delete=models.CASCADE, related_name='daily_totals')
+    date = models.DateField()
+
+    quantity = models.IntegerField(default=0)
+    revenue = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    profit = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+
+    def __str__(self):
+        return f"{self.good.name} - {self.date}"
+
+    class Meta:
+        ordering = ['-date']
+        verbose_name = "Günlük Məhsul Hesabatı"
+        verbose_name_plural = "Günlük Məhsul Hesabatları"
+        constraints = [
+            models.UniqueConstraint(fields=['good', 'date'], name='unique_daily_good_summary'),
+        ]
+        indexes = [
+            models.Index(fields=['date', 'shop']),
+        ]
+
+
+class WorkerShiftSummary(models.Model):
+    """Per-cashier sales totals of one shift (local time) of one day, for shift analytics.
+
+    Kept up to date by the sale and void write paths like the other summaries.
+    A transaction is one checkout; void rows subtract from the original cashier.
+    """
+    SHIFT_CHOICES = [
+        ('morning', 'Səhər (08:00-16:00)'),
+        ('evening', 'Axşam (16:00-24:00)'),
+        ('night', 'Gecə (00:00-08:00)'),
+    ]
+
+    shop = models.ForeignKey(Shop, on_delete=models.CASCADE, related_name='worker_shift_summaries')
+    # Like Sale.worker: a deleted cashier's rows become the unknown cashier's (see rollups.fold_deleted_worker)
+    worker = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True, related_name='shift_summaries')
+    date = models.DateField()
+    shift = models.CharField(max_length=10, choices=SHIFT_CHOICES)
+
+    revenue = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    items = models.IntegerField(default=0)
+    transactions = models.IntegerField(default=0)
+    profit = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+
+    def __str__(self):
+        return f"{self.worker or '-'} - {self.date} {self.get_shift_display()}"
+
+    class Meta:
+        ordering = ['-date', 'shift']
+        verbose_name = "Növbə Hesabatı"
+        verbose_name_plural = "Növbə Hesabatları"
+        constraints = [
+            models.UniqueConstraint(fields=['shop', 'worker', 'date', 'shift'], name='unique_worker_shift_summary'),
+            models.UniqueConstraint(
+                fields=['shop', 'date', 'shift'],
+                condition=models.Q(worker__isnull=True),
+                name='unique_worker_shift_summary_no_worker'
+            ),
+        ]
+        indexes = [
+            models.Index(fields=['date', 'shop']),
+        ]
+
+
+class GoodStockSummary(models.Model):
+    """Stock analytics of one good over the last window_days: velocity, days of cover, turnover, ABC class.
+
+    Materialized nightly by `manage.py rebuild_inventory_report` (see shop.inventory).
+    """
+    ABC_CLASSES = [
+        ('A', 'A'),
+        ('B', 'B'),
+        ('C', 'C'),
+    ]
+
+    shop = models.ForeignKey(Shop, on_delete=models.CASCADE, related_name='good_stock_summaries')
+    good = models.OneToOneField(Good, on_delete=models.CASCADE, related_name='stock_summary')
+    computed_on = models.DateField()
+    window_days = models.PositiveSmallIntegerField()
+
+    stock_count = models.IntegerField(default=0)
+    stock_value = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    quantity_sold = models.IntegerField(default=0)
+    revenue = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    cost = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    daily_velocity = models.DecimalField(max_digits=12, decimal_places=4, default=0)
+    # Empty when nothing sold (cover) or nothing was in stock (turnover) during the window
+    days_of_cover = models.DecimalField(max_digits=10, decimal_places=1, null=True, blank=True)
+    turnover = models.DecimalField(max_digits=10, decimal_places=2, null=True, blank=True)
+    revenue_share = models.DecimalField(max_digits=7, decimal_places=4, default=0)
+    abc_class = models.CharField(max_length=1, choices=ABC_CLASSES)
+
+    def __str__(self):
+        return f"{self.good.name} - {self.abc_class}"
+
+    class Meta:
+        ordering = ['shop', 'abc_class', '-revenue']
+        verbose_name = "Stok Analizi"
+        verbose_name_plural = "Stok Analizi"
+        indexes = [
+            models.Index(fields=['shop', 'abc_class']),
+        ]
+
+
+class HourlyShopSummary(models.Model):
+    """Per-shop totals for one local hour, used for time-of-day and shift reports.
+
+    Same split as DailyShopSummary: sales per category, debts on category=NULL.
+    """
+    shop = models.ForeignKey(Shop, on_delete=models.CASCADE, related_name='hourly_summaries')
+    date = models.DateField()
+    hour = models.PositiveSmallIntegerField()  # 0-23, local time
+    category = models.ForeignKey(Category, on_delete=models.CASCADE, null=True, blank=True)
+
+    sales_revenue = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    sales_quantity = models.IntegerField(default=0)
+    sales_count = models.IntegerField(default=0)
+    sales_profit = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+
+    debts_revenue = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    debts_quantity = models.IntegerField(default=0)
+    debts_count = models.IntegerField(default=0)
+    debts_profit = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+
+    def __str__(self):
+        return f"{self.shop.name} - {self.date} {self.hour:02d}:00"
+
+    class Meta:
+        ordering = ['-date', '-hour']
+        verbose_name = "Saatlıq Hesabat"
+        verbose_name_plural = "Saatlıq Hesabatlar"
+        constraints = [
+            models.UniqueConstraint(fields=['shop', 'date', 'hour', 'category'], name='unique_hourly_summary'),
+            models.UniqueConstraint(
+                fields=['shop', 'date', 'hour'],
+                condition=models.Q(category__isnull=True),
+                name='unique_hourly_summary_no_category'
+            ),
+        ]
+        indexes = [
+            models.Index(fields=['date', 'hour', 'shop']),
+        ]
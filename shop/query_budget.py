@@ -0,0 +1,67 @@
+"""Bounds on the number of SQL queries a request may run.
+
+query_budget() fails a block (or a decorated function) that runs more than
+`limit` queries and lists them, so an N+1 shows up as a failing test rather
+than a slow page. QueryBudgetMiddleware logs a warning for every request above
+settings.QUERY_BUDGET_WARNING; it is only installed when DEBUG is on.
+"""
+import logging
+from contextlib import ContextDecorator
+
+from django.conf import settings
+from django.db import connections
+from django.test.utils import CaptureQueriesContext
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_WARNING_BUDGET = 30
+
+
+class QueryBudgetExceeded(AssertionError):
+    pass
+
+
+class query_budget(ContextDecorator):
+    """Raise QueryBudgetExceeded if the block runs more than limit queries on the `using` database"""
+
+    def __init__(self, limit, using='default'):
+        self.limit = limit
+        self.using = using
+
+    def __enter__(self):
+        self.captured = CaptureQueriesContext(connections[self.using])
+        self.captured.__enter__()
+        return self.captured
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.captured.__exit__(exc_type, exc_value, traceback)
+        if exc_type is not None:
+            return False
+        if len(self.captured) > self.limit:
+            queries = '\n'.join(
+                f'{number}. {query["sql"]}' for number, query in enumerate(self.captured.captured_queries, start=1)
+            )
+            raise QueryBudgetExceeded(f'{len(self.captured)} queries, budget {self.limit}:\n{queries}')
+        return False
+
+
+class QueryBudgetMiddleware:
+    """Log requests that run more queries than settings.QUERY_BUDGET_WARNING"""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.limit = getattr(settings, 'QUERY_BUDGET_WARNING', DEFAULT_WARNING_BUDGET)
+
+    def __call__(self, request):
+        count = 0
+
+        def counter(execute, sql, params, many, context):
+            nonlocal count
+            count += 1
+            return execute(sql, params, many, context)
+
+        with connections['default'].execute_wrapper(counter):
+            response = self.get_response(request)
+        if count > self.limit:
+            logger.warning('%s %s ran %d queries (budget %d)', request.method, request.path, count, self.limit)
+        return response
@@ -0,0 +1,555 @@
+"""Summary tables for the finance reports.
+
+The write paths (process_sale, void_sale, create_debt, cancel_debt and
+expense creation) call the record_* helpers inside their transaction, so the
+summary rows always match the raw Sale/Debt/Expense data. rebuild_summaries()
+regenerates everything from raw rows in bulk (see the rebuild_summaries command).
+
+Days and hours are local to each shop (Shop.timezone). Daily rows answer
+whole-day ranges, hourly rows answer time-of-day windows and shifts. Only the partial hours at the edges of a window are read from the raw tables.
+DailyGoodSummary keeps the same per good, for the product rankings, and
+WorkerShiftSummary the sales of every cashier per shift.
+
+The cached today/week/month revenue cards and finance reports (see
+finance.summary_cards and finance.cached_section) are invalidated once the
+writing transaction commits.
+"""
+import uuid
+from collections import defaultdict
+from datetime import timedelta
+
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Sum, Count, Q, F, DecimalField, ExpressionWrapper, OuterRef, Subquery, Value
+from django.db.models.functions import TruncDate, ExtractHour, Coalesce
+from django.db.models.lookups import GreaterThanOrEqual, LessThan
+from django.utils import timezone
+
+from .models import (
+    Shop, Sale, Debt, DebtItem, Expense, DailyShopSummary, HourlyShopSummary, DailyGoodSummary,
+    WorkerShiftSummary
+)
+from .routers import use_primary
+
+SALES_FIELDS = ('sales_revenue', 'sales_quantity', 'sales_count', 'sales_profit')
+DEBTS_FIELDS = ('debts_revenue', 'debts_quantity', 'debts_count', 'debts_profit')
+
+# Local-time hour ranges [start, end) for the worker_shift filter
+SHIFTS = {
+    'morning': (8, 16),
+    'evening': (16, 24),
+    'night': (0, 8),
+}
+
+CARD_PERIODS = ('today', 'week', 'month')
+
+
+def shift_of(hour):
+    """The shift a local hour (0-23) belongs to"""
+    return next(shift for shift, (start, end) in SHIFTS.items() if start <= hour < end)
+
+
+def local_hours_q(field, hours, tz):
+    """Q for rows whose datetime `field` falls in the [start, end) hours of the day in tz"""
+    hour = ExtractHour(field, tzinfo=tz)
+    return Q(GreaterThanOrEqual(hour, hours[0]), LessThan(hour, hours[1]))
+
+
+REPORT_GENERATION_KEY = 'finance_report_gen'
+
+
+def _card_generation_key(shop_id):
+    return f'finance_card_gen:{shop_id or "all"}'
+
+
+def cache_generation(key):
+    """Current token stored under a generation key, created on first use"""
+    generation = cache.get(key)
+    if generation is None:
+        cache.add(key, uuid.uuid4().hex, None)
+        generation = cache.get(key)
+    return generation
+
+
+def cached_until_write(key, compute, timeout):
+    """compute() cached under key until the next sale/debt/expense write"""
+    key = f'{key}:{cache_generation(REPORT_GENERATION_KEY)}'
+    result = cache.get(key)
+    if result is None:
+        # Stored under the current generation, so it must see every committed write
+        with use_primary():
+            result = compute()
+        cache.set(key, result, timeout)
+    return result
+
+
+def _bump_generations(keys):
+    transaction.on_commit(lambda: cache.set_many({key: uuid.uuid4().hex for key in keys}, None))
+
+
+def card_cache_keys(shop_id, today):
+    """Cache keys of the today/week/month revenue cards; shop_id=None means all shops.
+
+    Keys embed the local date (cards roll over at midnight by themselves) and the
+    shop's card generation. Writers replace the generation instead of deleting
+    keys, so a reader that computed from pre-commit data can never store a card
+    that is read again.
+    """
+    generation = cache_generation(_card_generation_key(shop_id))
+    return {
+        period: f'finance_card:{shop_id or "all"}:{today}:{period}:{generation}'
+        for period in CARD_PERIODS
+    }
+
+
+def invalidate_cards(shop_ids):
+    """Invalidate the cards of the given shops, the all-shops cards and every report after commit"""
+    _bump_generations([_card_generation_key(shop_id) for shop_id in set(shop_ids) | {None}]
+                      + [REPORT_GENERATION_KEY])
+
+
+def invalidate_reports():
+    """Mark every cached finance report stale after commit"""
+    _bump_generations([REPORT_GENERATION_KEY])
+
+
+def _apply(model, key, deltas):
+    """Add deltas to the row identified by key, creating it on first use"""
+    deltas = {field: value for field, value in deltas.items() if value}
+    if not deltas:
+        return
+    updates = {field: F(field) + value for field, value in deltas.items()}
+    if not model.objects.filter(**key).update(**updates):
+        row, created = model.objects.get_or_create(**key, defaults=deltas)
+        if not created:  # Lost a race with another writer
+            model.objects.filter(pk=row.pk).update(**updates)
+
+
+def _apply_hourly(hourly):
+    """Write per (shop, day, hour, category) deltas to both summary tables"""
+    daily = defaultdict(lambda: defaultdict(int))
+    for (shop_id, day, hour, category_id), deltas in hourly.items():
+        _apply(HourlyShopSummary, {'shop_id': shop_id, 'date': day, 'hour': hour, 'category_id': category_id}, deltas)
+        for field, value in deltas.items():
+            daily[(shop_id, day, category_id)][field] += value
+    for (shop_id, day, category_id), deltas in daily.items():
+        _apply(DailyShopSummary, {'shop_id': shop_id, 'date': day, 'category_id': category_id}, deltas)
+    if daily:
+        invalidate_cards(shop_id for shop_id, day, category_id in daily)
+
+
+def _apply_goods(goods):
+    """Write per (shop, day, good) deltas to DailyGoodSummary"""
+    for (shop_id, day, good_id), deltas in goods.items():
+        _apply(DailyGoodSummary, {'shop_id': shop_id, 'date': day, 'good_id': good_id}, deltas)
+
+
+def _apply_worker_shifts(shifts, transactions):
+    """Write per (shop, worker, day, shift) deltas, with the set of new transactions of each"""
+    for (shop_id, worker_id, day, shift), deltas in shifts.items():
+        deltas['transactions'] = len(transactions[(shop_id, worker_id, day, shift)])
+        _apply(WorkerShiftSummary, {'shop_id': shop_id, 'worker_id': worker_id, 'date': day, 'shift': shift}, deltas)
+
+
+def fold_deleted_worker(sender, instance, **kwargs):
+    """pre_delete of a User: move their shift rows to the unknown cashier (worker=None).
+
+    Their sales keep no cashier either (Sale.worker is SET_NULL), which is what a rebuild groups by.
+    """
+    rows = list(WorkerShiftSummary.objects.select_for_update().filter(worker_id=instance.pk))
+    if not rows:
+        return
+    WorkerShiftSummary.objects.filter(worker_id=instance.pk).delete()
+    for row in rows:
+        _apply(
+            WorkerShiftSummary, {'shop_id': row.shop_id, 'worker_id': None, 'date': row.date, 'shift': row.shift},
+            {field: getattr(row, field) for field in ('revenue', 'items', 'transactions', 'profit')}
+        )
+    invalidate_reports()
+
+
+def record_sales(sales):
+    """Add freshly created Sale rows (including void rows) to the summaries.
+
+    Sales must have `good` loaded (category_id is read from it).
+    Compensating void rows carry negative quantities, so they subtract on their own.
+    All lines of a transaction must be recorded in the same call.
+    """
+    buckets = defaultdict(lambda: defaultdict(int))
+    goods = defaultdict(lambda: defaultdict(int))
+    shifts = defaultdict(lambda: defaultdict(int))
+    transactions = defaultdict(set)
+    timezones = Shop.timezones()
+    for sale in sales:
+        local = timezone.localtime(sale.timestamp, Shop.timezone_of(sale.shop_id, timezones))
+        profit = sale.total_price - sale.cost
+        bucket = buckets[(sale.shop_id, local.date(), local.hour, sale.good.category_id)]
+        bucket['sales_revenue'] += sale.total_price
+        bucket['sales_quantity'] += sale.quantity
+        bucket['sales_count'] += 0 if sale.voided_sale_id else 1
+        bucket['sales_profit'] += profit
+        good = goods[(sale.shop_id, local.date(), sale.good_id)]
+        good['quantity'] += sale.quantity
+        good['revenue'] += sale.total_price
+        good['profit'] += profit
+        shift_key = (sale.shop_id, sale.worker_id, local.date(), shift_of(local.hour))
+        shift = shifts[shift_key]
+        shift['revenue'] += sale.total_price
+        shift['items'] += sale.quantity
+        shift['profit'] += profit
+        if not sale.voided_sale_id:
+            transactions[shift_key].add(sale.transaction_id or sale.id)
+    _apply_hourly(buckets)
+    _apply_goods(goods)
+    _apply_worker_shifts(shifts, transactions)
+
+
+def record_debt(debt, items, sign=1):
+    """Add (sign=1) or remove (sign=-1, on cancel) a debt and its items.
+
+    The shop summaries use the totals stored on the debt, the items only feed DailyGoodSummary.
+    """
+    local = timezone.localtime(debt.created_at, Shop.timezone_of(debt.shop_id))
+    _apply_hourly({
+        (debt.shop_id, local.date(), local.hour, None): {
+            'debts_revenue': sign * debt.total_amount,
+            'debts_quantity': sign * debt.items_quantity,
+            'debts_count': sign,
+            'debts_profit': sign * debt.profit,
+        }
+    })
+    goods = defaultdict(lambda: defaultdict(int))
+    for item in items:
+        good = goods[(debt.shop_id, local.date(), item.good_id)]
+        good['quantity'] += sign * item.quantity
+        good['revenue'] += sign * item.total_price
+        good['profit'] += sign * (item.total_price - item.cost)
+    _apply_goods(goods)
+
+
+def record_expense(expense, amount=None):
+    """Add an expense; pass amount explicitly for edits (difference) or deletes (negative)"""
+    _apply(
+        DailyShopSummary,
+        {'shop_id': expense.shop_id, 'date': expense.expense_date, 'category_id': None},
+        {'expenses_total': expense.amount if amount is None else amount}
+    )
+    invalidate_reports()
+
+
+def summary_aggregates(category_id=None, condition=None, expenses=True):
+    """Conditional Sum() for every summary field, to be used in one aggregate() call.
+
+    The category filter only applies to sales, exactly like the raw report:
+    debts and expenses are never split by category. `condition` restricts all
+    fields (e.g. to a date range) so several periods can share one query.
+    """
+    sales_filter = condition
+    if category_id:
+        sales_filter = Q(category_id=category_id) if condition is None else condition & Q(category_id=category_id)
+    aggregates = {field: Sum(field, filter=sales_filter) for field in SALES_FIELDS}
+    aggregates.update({field: Sum(field, filter=condition) for field in DEBTS_FIELDS})
+    if expenses:
+        aggregates['expenses_total'] = Sum('expenses_total', filter=condition)
+    return aggregates
+
+
+def _hour_range_q(start, end):
+    """Q for hourly rows in [start, end); both must be local, hour-aligned datetimes"""
+    return (
+        (Q(date__gt=start.date()) | Q(date=start.date(), hour__gte=start.hour))
+        & (Q(date__lt=end.date()) | Q(date=end.date(), hour__lt=end.hour))
+    )
+
+
+def _raw_totals(ranges, shop_id=None, category_id=None, hours=None, tz=None, shop_ids=None):
+    """Sales/debt totals for a list of [start, end) ranges read from the raw tables"""
+    sales_q, debts_q = Q(), Q()
+    for start, end in ranges:
+        sales_q |= Q(timestamp__gte=start, timestamp__lt=end)
+        debts_q |= Q(created_at__gte=start, created_at__lt=end)
+    sales = Sale.objects.filter(sales_q)
+    debts = Debt.objects.exclude(status='cancelled').filter(debts_q)
+    if shop_id:
+        sales = sales.filter(shop_id=shop_id)
+        debts = debts.filter(shop_id=shop_id)
+    if shop_ids is not None:
+        sales = sales.filter(shop_id__in=shop_ids)
+        debts = debts.filter(shop_id__in=shop_ids)
+    if category_id:
+        sales = sales.filter(good__category_id=category_id)
+    if hours:
+        sales = sales.filter(local_hours_q('timestamp', hours, tz))
+        debts = debts.filter(local_hours_q('created_at', hours, tz))
+
+    totals = sales.aggregate(
+        sales_revenue=Sum('total_price'),
+        sales_quantity=Sum('quantity'),
+        sales_count=Count('id', filter=Q(voided_sale__isnull=True)),
+        sales_profit=Sum(ExpressionWrapper(
+            F('total_price') - F('cost'),
+            output_field=DecimalField()
+        )),
+    )
+    totals.update(debts.aggregate(
+        debts_revenue=Sum('total_amount'),
+        debts_quantity=Sum('items_quantity'),
+        debts_count=Count('id'),
+        debts_profit=Sum('profit'),
+    ))
+    return totals
+
+
+def window_totals(start, end, shop_id=None, category_id=None, shift=None, tz=None, shop_ids=None):
+    """Sales/debt totals for the aware datetime window [start, end).
+
+    Full hours are summed from HourlyShopSummary (at most 24 rows per shop
+    and day); only the partial hours at either edge hit the raw tables.
+    `shift` restricts the window to that shift's hours on every day.
+    Without start/end the whole history is summed (used for shift-only reports).
+    Hours are those of tz (default: the current time zone), so the shops
+    summed (shop_id, or shop_ids when given) must all be in that zone.
+    """
+    tz = tz or timezone.get_current_timezone()
+    hours = SHIFTS.get(shift)
+    parts = []
+    if start is None or end is None:
+        rows = HourlyShopSummary.objects.all()
+    else:
+        start = timezone.localtime(start, tz)
+        end = timezone.localtime(end, tz)
+        first_full = start.replace(minute=0, second=0, microsecond=0)
+        if first_full < start:
+            first_full += timedelta(hours=1)
+        last_full = end.replace(minute=0, second=0, microsecond=0)
+
+        if first_full >= last_full:
+            # No complete hour inside the window: raw only
+            parts.append(_raw_totals([(start, end)], shop_id, category_id, hours, tz, shop_ids))
+            rows = None
+        else:
+            # Both partial edge hours are read together, one query per raw table
+            edges = [edge for edge in ((start, first_full), (last_full, end)) if edge[0] < edge[1]]
+            if edges:
+                parts.append(_raw_totals(edges, shop_id, category_id, hours, tz, shop_ids))
+            rows = HourlyShopSummary.objects.filter(_hour_range_q(first_full, last_full))
+
+    if rows is not None:
+        if shop_id:
+            rows = rows.filter(shop_id=shop_id)
+        if shop_ids is not None:
+            rows = rows.filter(shop_id__in=shop_ids)
+        if hours:
+            rows = rows.filter(hour__gte=hours[0], hour__lt=hours[1])
+        parts.append(rows.aggregate(**summary_aggregates(category_id, expenses=False)))
+
+    totals = {field: 0 for field in SALES_FIELDS + DEBTS_FIELDS}
+    for part in parts:
+        for field, value in part.items():
+            totals[field] += value or 0
+    return totals
+
+
+def _timezone_groups(shop_ids=None):
+    """Shop.timezone_groups(), restricted to shop_ids when given"""
+    groups = Shop.timezone_groups()
+    if shop_ids is None:
+        return groups
+    shop_ids = set(shop_ids)
+    return [(tz, [shop_id for shop_id in ids if shop_id in shop_ids]) for tz, ids in groups if shop_ids.intersection(ids)]
+
+
+def _grouped_raw_rows(hourly, shop_ids=None):
+    """Per (shop, day[, hour], category) totals from the raw tables via grouped queries.
+
+    Days and hours are local to each shop: one query per time zone and table.
+    """
+    rows = defaultdict(lambda: defaultdict(int))
+
+    def buckets(timestamp_field, tz):
+        annotations = {'day': TruncDate(timestamp_field, tzinfo=tz)}
+        if hourly:
+            annotations['hour'] = ExtractHour(timestamp_field, tzinfo=tz)
+        return annotations
+
+    def key(row, shop_field, category_id):
+        if hourly:
+            return (row[shop_field], row['day'], row['hour'], category_id)
+        return (row[shop_field], row['day'], category_id)
+
+    for tz, zone_shop_ids in _timezone_groups(shop_ids):
+        annotations = buckets('timestamp', tz)
+        sales = (
+            Sale.objects.filter(shop_id__in=zone_shop_ids)
+            .annotate(**annotations)
+            .values('shop_id', 'good__category_id', *annotations)
+            .annotate(
+                revenue=Sum('total_price'),
+                items=Sum('quantity'),
+                count=Count('id', filter=Q(voided_sale__isnull=True)),
+                profit=Sum(ExpressionWrapper(
+                    F('total_price') - F('cost'),
+                    output_field=DecimalField()
+                )),
+            )
+        )
+        for row in sales:
+            bucket = rows[key(row, 'shop_id', row['good__category_id'])]
+            bucket['sales_revenue'] += row['revenue']
+            bucket['sales_quantity'] += row['items']
+            bucket['sales_count'] += row['count']
+            bucket['sales_profit'] += row['profit']
+
+        annotations = buckets('created_at', tz)
+        debts = (
+            Debt.objects.filter(shop_id__in=zone_shop_ids).exclude(status='cancelled')
+            .annotate(**annotations)
+            .values('shop_id', *annotations)
+            .annotate(
+                revenue=Sum('total_amount'),
+                items=Sum('items_quantity'),
+                count=Count('id'),
+                total_profit=Sum('profit'),
+            )
+        )
+        for row in debts:
+            bucket = rows[key(row, 'shop_id', None)]
+            bucket['debts_revenue'] += row['revenue']
+            bucket['debts_quantity'] += row['items']
+            bucket['debts_count'] += row['count']
+            bucket['debts_profit'] += row['total_profit']
+
+    if not hourly:
+        expenses = Expense.objects.all() if shop_ids is None else Expense.objects.filter(shop_id__in=shop_ids)
+        expenses = expenses.values('shop_id', 'expense_date').annotate(total=Sum('amount'))
+        for row in expenses:
+            rows[(row['shop_id'], row['expense_date'], None)]['expenses_total'] += row['total']
+
+    return rows
+
+
+def _grouped_good_rows(shop_ids=None):
+    """Per (shop, day, good) totals of sales and non-cancelled debt items, in local days"""
+    rows = defaultdict(lambda: defaultdict(int))
+    profit = ExpressionWrapper(F('total_price') - F('cost'), output_field=DecimalField())
+    for tz, zone_shop_ids in _timezone_groups(shop_ids):
+        sales = (
+            Sale.objects.filter(shop_id__in=zone_shop_ids)
+            .annotate(day=TruncDate('timestamp', tzinfo=tz))
+            .values('shop_id', 'good_id', 'day')
+            .annotate(items=Sum('quantity'), revenue=Sum('total_price'), total_profit=Sum(profit))
+        )
+        debt_items = (
+            DebtItem.objects.filter(debt__shop_id__in=zone_shop_ids).exclude(debt__status='cancelled')
+            .annotate(day=TruncDate('debt__created_at', tzinfo=tz), shop_id=F('debt__shop_id'))
+            .values('shop_id', 'good_id', 'day')
+            .annotate(items=Sum('quantity'), revenue=Sum('total_price'), total_profit=Sum(profit))
+        )
+        for queryset in (sales, debt_items):
+            for row in queryset:
+                bucket = rows[(row['shop_id'], row['day'], row['good_id'])]
+                bucket['quantity'] += row['items']
+                bucket['revenue'] += row['revenue']
+                bucket['profit'] += row['total_profit']
+    return rows
+
+
+def _grouped_worker_shift_rows(shop_ids=None):
+    """Per (shop, worker, day, shift) sales totals; grouped per local hour, folded into shifts here"""
+    rows = defaultdict(lambda: defaultdict(int))
+    original = Q(voided_sale__isnull=True)
+    for tz, zone_shop_ids in _timezone_groups(shop_ids):
+        sales = (
+            Sale.objects.filter(shop_id__in=zone_shop_ids)
+            .annotate(day=TruncDate('timestamp', tzinfo=tz), hour=ExtractHour('timestamp', tzinfo=tz))
+            .values('shop_id', 'worker_id', 'day', 'hour')
+            .annotate(
+                revenue=Sum('total_price'),
+                items=Sum('quantity'),
+                # Lines of one checkout share a transaction_id; older rows without one count alone
+                transactions=(
+                    Count('transaction_id', distinct=True, filter=original & ~Q(transaction_id=''))
+                    + Count('id', filter=original & Q(transaction_id=''))
+                ),
+                profit=Sum(ExpressionWrapper(
+                    F('total_price') - F('cost'),
+                    output_field=DecimalField()
+                )),
+            )
+        )
+        for row in sales:
+            bucket = rows[(row['shop_id'], row['worker_id'], row['day'], shift_of(row['hour']))]
+            for field in ('revenue', 'items', 'transactions', 'profit'):
+                bucket[field] += row[field]
+    return rows
+
+
+def backfill_debt_totals():
+    """Recompute Debt.profit/items_quantity from the items (and their costs) with one UPDATE"""
+    items = DebtItem.objects.filter(debt=OuterRef('pk')).values('debt')
+    decimal = DecimalField(max_digits=10, decimal_places=2)
+    return Debt.objects.update(
+        profit=Coalesce(
+            Subquery(items.annotate(total=Sum(ExpressionWrapper(
+                F('total_price') - F('cost'),
+                output_field=decimal
+            ))).values('total')),
+            Value(0),
+            output_field=decimal
+        ),
+        items_quantity=Coalesce(Subquery(items.annotate(total=Sum('quantity')).values('total')), Value(0)),
+    )
+
+
+@transaction.atomic
+def rebuild_summaries(shop_ids=None):
+    """Regenerate every summary row (or those of shop_ids) from raw data with grouped queries"""
+    if shop_ids is None:
+        backfill_debt_totals()
+        shops = Q()
+    else:
+        # Debt totals do not depend on the shop: only the shop's buckets are redone (e.g. new time zone)
+        shop_ids = list(shop_ids)
+        shops = Q(shop_id__in=shop_ids)
+
+    daily = _grouped_raw_rows(hourly=False, shop_ids=shop_ids)
+    DailyShopSummary.objects.filter(shops).delete()
+    DailyShopSummary.objects.bulk_create(
+        (
+            DailyShopSummary(shop_id=shop_id, date=day, category_id=category_id, **values)
+            for (shop_id, day, category_id), values in daily.items()
+        ),
+        batch_size=1000
+    )
+
+    hourly = _grouped_raw_rows(hourly=True, shop_ids=shop_ids)
+    HourlyShopSummary.objects.filter(shops).delete()
+    HourlyShopSummary.objects.bulk_create(
+        (
+            HourlyShopSummary(shop_id=shop_id, date=day, hour=hour, category_id=category_id, **values)
+            for (shop_id, day, hour, category_id), values in hourly.items()
+        ),
+        batch_size=1000
+    )
+
+    goods = _grouped_good_rows(shop_ids)
+    DailyGoodSummary.objects.filter(shops).delete()
+    DailyGoodSummary.objects.bulk_create(
+        (
+            DailyGoodSummary(shop_id=shop_id, date=day, good_id=good_id, **values)
+            for (shop_id, day, good_id), values in goods.items()
+        ),
+        batch_size=1000
+    )
+
+    shifts = _grouped_worker_shift_rows(shop_ids)
+    WorkerShiftSummary.objects.filter(shops).delete()
+    WorkerShiftSummary.objects.bulk_create(
+        (
+            WorkerShiftSummary(shop_id=shop_id, worker_id=worker_id, date=day, shift=shift, **values)
+            for (shop_id, worker_id, day, shift), values in shifts.items()
+        ),
+        batch_size=1000
+    )
+    invalidate_cards(Shop.objects.values_list('id', flat=True) if shop_ids is None else shop_ids)
+    return len(daily), len(hourly), len(goods), len(shifts)
@@ -0,0 +1,92 @@
+"""Send reporting reads to the read replica, when one is configured.
+
+settings.DATABASES gets a REPLICA alias when REPLICA_DATABASE_URL is set. Only
+code running under use_replica() (GET requests of the finance page and its API,
+exports, the debt list, via the @reporting_view decorator) reads from it; everything else,
+including every write and the checkout paths that read their own writes,
+stays on 'default'.
+
+Results cached under the current write generation (the revenue cards and the
+cached_until_write sections) are computed under use_primary(): a lagging
+replica would otherwise store pre-write totals under the post-write generation.
+"""
+import contextvars
+from contextlib import contextmanager
+from functools import wraps
+
+from django.conf import settings
+
+REPLICA = 'replica'
+
+# Requests that only read: a POST to a reporting page (e.g. a new expense) stays on the primary
+REPLICA_METHODS = ('GET', 'HEAD')
+
+_reporting = contextvars.ContextVar('reporting', default=False)
+
+
+def replica_configured():
+    return REPLICA in settings.DATABASES
+
+
+@contextmanager
+def use_replica():
+    """Route the reads of the block to the replica"""
+    token = _reporting.set(True)
+    try:
+        yield
+    finally:
+        _reporting.reset(token)
+
+
+@contextmanager
+def use_primary():
+    """Route the reads of the block back to the primary, even under use_replica()"""
+    token = _reporting.set(False)
+    try:
+        yield
+    finally:
+        _reporting.reset(token)
+
+
+def _pinned(chunks):
+    # Streamed responses run their queries while the server reads them, after the view returned
+    chunks = iter(chunks)
+    while True:
+        with use_replica():
+            try:
+                chunk = next(chunks)
+            except StopIteration:
+                return
+        yield chunk
+
+
+def reporting_view(view):
+    """Run the GET requests of a reporting view (and their streamed body) against the replica"""
+    @wraps(view)
+    def wrapped(request, *args, **kwargs):
+        if request.method not in REPLICA_METHODS:
+            return view(request, *args, **kwargs)
+        with use_replica():
+            response = view(request, *args, **kwargs)
+        if response.streaming:
+            response.streaming_content = _pinned(response.streaming_content)
+        return response
+    return wrapped
+
+
+class ReplicaRouter:
+    def db_for_read(self, model, **hints):
+        if _reporting.get() and replica_configured():
+            return REPLICA
+        return None
+
+    def db_for_write(self, model, **hints):
+        return 'default'
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # The replica holds the same rows as the primary
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # The replica receives its schema from the primary
+        return db != REPLICA
@@ -0,0 +1,102 @@
+"""Every shop side by side for /api/finance/shops/.
+
+The shop x metric matrix of the selected period takes one grouped query per
+source instead of one finance report per shop:
+
+* whole days: DailyShopSummary grouped by shop,
+* time-of-day windows, shifts and the barcode filter: Sale, Debt and Expense
+  grouped by shop (the raw tables, like compute_report's barcode path),
+* pending debts of the period: Debt grouped by shop.
+
+The shop filter does not apply (every shop is a row); the others do, with the
+same meaning as on the rest of the finance page.
+"""
+from decimal import Decimal
+
+from django.db.models import Sum, Count, Q, F, DecimalField, ExpressionWrapper
+
+from .models import Shop, Sale, Debt, Expense, DailyShopSummary
+from .rollups import cached_until_write, summary_aggregates, SALES_FIELDS, DEBTS_FIELDS
+
+SHOP_MATRIX_CACHE_TIMEOUT = 60 * 60
+
+SUMMARY_FIELDS = SALES_FIELDS + DEBTS_FIELDS + ('expenses_total',)
+
+
+def _grouped(queryset, **aggregates):
+    """{shop_id: {name: value}} of one query grouped by shop"""
+    rows = queryset.values('shop_id').annotate(**aggregates).order_by()
+    return {row.pop('shop_id'): row for row in rows}
+
+
+def _summary_totals(filters):
+    days = filters.expense_days
+    rows = DailyShopSummary.objects.all()
+    if days:
+        rows = rows.filter(date__gte=days[0], date__lte=days[1])
+    return _grouped(rows, **summary_aggregates(filters.category_id))
+
+
+def _raw_totals(filters):
+    totals = _grouped(
+        Sale.objects.filter(filters.sales_q()),
+        sales_revenue=Sum('total_price'),
+        sales_quantity=Sum('quantity'),
+        # Void rows are corrections, not extra transactions
+        sales_count=Count('id', filter=Q(voided_sale__isnull=True)),
+        sales_profit=Sum(ExpressionWrapper(F('total_price') - F('cost'), output_field=DecimalField())),
+    )
+    sources = (
+        (Debt.objects.filter(filters.debts_q()), {
+            'debts_revenue': Sum('total_amount'),
+            'debts_quantity': Sum('items_quantity'),
+            'debts_count': Count('id'),
+            'debts_profit': Sum('profit'),
+        }),
+        (Expense.objects.filter(filters.expenses_q()), {'expenses_total': Sum('amount')}),
+    )
+    for queryset, aggregates in sources:
+        for shop_id, values in _grouped(queryset, **aggregates).items():
+            totals.setdefault(shop_id, {}).update(values)
+    return totals
+
+
+def _compute(filters):
+    if filters.barcode or filters.window or filters.shift:
+        totals = _raw_totals(filters)
+    else:
+        totals = _summary_totals(filters)
+    pending = _grouped(
+        Debt.objects.filter(filters.debts_q(), status='pending'),
+        count=Count('id'), amount=Sum('remaining_amount'),
+    )
+
+    matrix = []
+    for shop in Shop.objects.order_by('name'):
+        values = {field: Decimal(str(value or 0)) for field, value in totals.get(shop.id, {}).items()}
+        values = {field: values.get(field, Decimal('0')) for field in SUMMARY_FIELDS}
+        shop_pending = pending.get(shop.id, {})
+        revenue = values['sales_revenue'] + values['debts_revenue']
+        profit = values['sales_profit'] + values['debts_profit']
+        transactions = int(values['sales_count'] + values['debts_count'])
+        matrix.append({
+            'shop_id': shop.id,
+            'shop_name': shop.name,
+            'total_revenue': revenue,
+            'total_profit': profit,
+            'net_profit': profit - values['expenses_total'],
+            'total_expenses': values['expenses_total'],
+            'items_sold': int(values['sales_quantity'] + values['debts_quantity']),
+            'num_sales': transactions,
+            'avg_sale': (revenue / transactions).quantize(Decimal('0.01')) if transactions else Decimal('0.00'),
+            'pending_debts_count': shop_pending.get('count', 0),
+            'pending_debts_amount': shop_pending.get('amount') or Decimal('0.00'),
+        })
+    return matrix
+
+
+def shop_matrix(filters):
+    """One row of period metrics per shop, by name, cached until the next write"""
+    # The selected shop's zone must not leak into the other shops' periods
+    filters = filters.for_shop(None)
+    return cached_until_write(filters.cache_key('shops'), lambda: _compute(filters), SHOP_MATRIX_CACHE_TIMEOUT)
@@ -1,3 +1,1313 @@
-from django.test import TestCase
+import csv
+import json
+import io
+import re
+import zipfile
+from datetime import datetime, time as dt_time, timedelta, timezone as dt_timezone
+from decimal import Decimal
+from unittest import mock
 
-# Create your tests here.
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from django.db import IntegrityError, connection, transaction
+from django.db.models import ProtectedError, Sum
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from . import routers, shifts, urls, xlsx
+
+from . import finance
+from .finance import ReportFilters, cached_section, compare_periods, compute_report, summary_cards
+from .timeseries import timeseries
+from .leaderboard import leaderboard
+from .models import (
+    Shop, Category, Good, Sale, Expense, Debt, DebtItem, StockReceipt, CostLayer, WorkerShiftSummary, Worker,
+    GoodStockSummary, HourlyShopSummary, Customer, DailyShopSummary, DailyGoodSummary
+)
+from .checks import check_shared_cache
+from .exports import SALE_EXPORT_COLUMNS, queryset_rows
+from .query_budget import QueryBudgetExceeded, QueryBudgetMiddleware, query_budget
+from .routers import REPLICA, ReplicaRouter, use_replica
+from .rollups import rebuild_summaries, record_expense
+from .costing import rebuild_costs
+from .inventory import build_inventory_report
+from .debts import DEBT_PAGE_SIZE, backfill_customers, encode_cursor, rebuild_customer_balances
+
+
+class FinanceDashboardTests(TestCase):
+    # Finance page shell or one section endpoint, including session/user lookups
+    QUERY_BUDGET = 15
+    URLS = ('/finance/', '/api/finance/summary/', '/api/finance/cards/',
+            '/api/finance/sales/', '/api/finance/expenses/', '/api/finance/timeseries/',
+            '/api/finance/leaderboard/', '/api/finance/comparison/', '/api/finance/shifts/',
+            '/api/finance/shops/')
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.admin = User.objects.create_superuser('admin', password='admin123')
+        cls.shops = [Shop.objects.create(name=f'Shop {i}') for i in range(2)]
+        categories = [Category.objects.create(name=f'Category {i}') for i in range(2)]
+        goods = [
+            Good.objects.create(
+                name=f'Good {i}', price=Decimal('3.00') + i, buy_price=Decimal('1.50') + i,
+                stock_count=1000, barcode=f'100{i}', category=categories[i % 2], shop=cls.shops[i % 2]
+            )
+            for i in range(6)
+        ]
+
+        now = timezone.now()
+        Sale.objects.bulk_create([
+            Sale(
+                good=goods[i % 6], quantity=1 + i % 3, total_price=goods[i % 6].price * (1 + i % 3),
+                shop=goods[i % 6].shop, timestamp=now - timedelta(hours=7 * i)
+            )
+            for i in range(200)
+        ])
+        for i in range(30):
+            good = goods[i % 6]
+            debt = Debt.objects.create(
+                customer_name=f'Customer {i}', shop=good.shop, total_amount=good.price * 2,
+                remaining_amount=good.price * 2, due_date=timezone.localdate() + timedelta(days=7),
+                status=['pending', 'paid', 'cancelled'][i % 3], created_by=cls.admin
+            )
+            Debt.objects.filter(pk=debt.pk).update(created_at=now - timedelta(hours=13 * i))
+            DebtItem.objects.create(debt=debt, good=good, quantity=2, unit_price=good.price)
+        for i in range(20):
+            Expense.objects.create(
+                shop=cls.shops[i % 2], amount=Decimal('5.00') + i, created_by=cls.admin,
+                expense_date=timezone.localdate() - timedelta(days=i)
+            )
+        rebuild_costs()
+        rebuild_summaries()
+
+    def setUp(self):
+        cache.clear()
+        self.client.force_login(self.admin)
+
+    def filter_sets(self):
+        today = timezone.localdate()
+        start, end = str(today - timedelta(days=20)), str(today - timedelta(days=1))
+        shop = str(self.shops[1].id)
+        return [
+            {},
+            {'date_filter': 'week', 'shop': shop},
+            {'date_filter': 'month', 'category': str(Category.objects.first().id)},
+            {'date_filter': 'month', 'worker_shift': 'evening'},
+            {'date_filter': 'custom', 'start_date': start, 'end_date': end},
+            {'date_filter': 'custom', 'start_date': start, 'end_date': end, 'start_time': '07:15', 'end_time': '18:45'},
+            {'date_filter': 'custom'},
+        ]
+
+    def test_query_budget(self):
+        for params in self.filter_sets() + [dict(params, barcode='100') for params in self.filter_sets()]:
+            for url in self.URLS:
+                with self.subTest(url=url, params=params):
+                    with CaptureQueriesContext(connection) as queries:
+                        response = self.client.get(url, params)
+                    self.assertEqual(response.status_code, 200)
+                    self.assertLessEqual(len(queries), self.QUERY_BUDGET)
+
+    def test_workers_get_no_profit(self):
+        worker = User.objects.create_user('worker', password='worker123')
+        self.client.force_login(worker)
+        summary = self.client.get('/api/finance/summary/').json()['summary']
+        self.assertIn('total_revenue', summary)
+        self.assertNotIn('total_profit', summary)
+        self.assertNotIn('net_profit', summary)
+        self.assertEqual(list(self.client.get('/api/finance/cards/').json()['cards']), ['today_revenue'])
+        self.assertEqual(self.client.get('/api/finance/expenses/').status_code, 403)
+        self.assertEqual(self.client.get('/api/finance/shops/').status_code, 403)
+
+    def test_summaries_match_raw_tables(self):
+        # A barcode matching every good forces the raw-table path
+        for params in self.filter_sets():
+            filters = {
+                'shop_id': params.get('shop'), 'category_id': params.get('category'),
+                'date_filter': params.get('date_filter', 'today'), 'worker_shift': params.get('worker_shift'),
+                'start_date': params.get('start_date'), 'end_date': params.get('end_date'),
+                'start_time': params.get('start_time'), 'end_time': params.get('end_time'),
+            }
+            with self.subTest(params=params):
+                self.assertEqual(
+                    compute_report(ReportFilters(**filters)),
+                    compute_report(ReportFilters(barcode='100', **filters))
+                )
+
+    def test_shop_timezones(self):
+        with self.assertRaises(ValidationError):
+            Shop(name='Mars', timezone='Mars/Olympus').full_clean()
+        shop = self.shops[1]
+        shop.timezone = 'America/New_York'
+        # Saving the new zone rebuilds the shop's summaries once committed
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            shop.save()
+        self.assertTrue(callbacks)
+        with self.captureOnCommitCallbacks() as callbacks:
+            Shop.objects.get(id=shop.id).save()
+        self.assertEqual(callbacks, [])
+
+        filters = ReportFilters(shop_id=str(shop.id), date_filter='week')
+        today = timezone.localdate(timezone=shop.tzinfo)
+        self.assertEqual(filters.today, today)
+        tz, shop_ids, start, end = filters.intervals[0]
+        self.assertEqual(start, timezone.make_aware(
+            datetime.combine(filters.week_start, dt_time.min), shop.tzinfo
+        ).astimezone(dt_timezone.utc))
+        self.assertEqual(end - start, timedelta(days=(today - filters.week_start).days + 1))
+        # All shops: one interval per zone (by zone name), each restricted to its shops
+        self.assertEqual(
+            [(str(tz), shop_ids) for tz, shop_ids, start, end in ReportFilters().intervals],
+            [('America/New_York', [shop.id]), ('Asia/Baku', [self.shops[0].id])]
+        )
+        self.test_summaries_match_raw_tables()
+        # Shop matrix with a Baku shop selected: the New York row keeps New York's periods
+        self.test_shop_matrix_matches_reports()
+
+        goods = list(Good.objects.filter(shop=shop))
+        response = self.client.post('/api/sale/', {
+            'request_id': 'tz', 'shop_id': shop.id, 'items': [{'id': good.id, 'quantity': 1} for good in goods],
+        }, content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+
+        def rows():
+            return sorted(HourlyShopSummary.objects.filter(shop=shop).values_list(
+                'date', 'hour', 'category_id', 'sales_revenue', 'sales_count'
+            ), key=str)
+        recorded = rows()
+        rebuild_summaries()
+        self.assertEqual(recorded, rows())
+
+        # Exports show every row in its shop's local time
+        sale = Sale.objects.get(transaction_id='tz', good=goods[0])
+        content = b''.join(self.client.get('/finance/export/csv/').streaming_content).decode('utf-8-sig')
+        self.assertIn(timezone.localtime(sale.timestamp, shop.tzinfo).strftime('%Y-%m-%d %H:%M:%S'), content)
+        self.assertEqual(
+            list(queryset_rows(Sale.objects.filter(id=sale.id), SALE_EXPORT_COLUMNS))[1][0],
+            timezone.localtime(sale.timestamp, shop.tzinfo).strftime('%Y-%m-%d %H:%M:%S')
+        )
+
+    def test_cards_cached_until_write(self):
+        shop_filters, all_filters = ReportFilters(shop_id=self.shops[0].id), ReportFilters()
+        shop_cards, all_cards = summary_cards(shop_filters), summary_cards(all_filters)
+        with self.assertNumQueries(0):
+            self.assertEqual(summary_cards(shop_filters), shop_cards)
+
+        good = Good.objects.filter(shop=self.shops[0]).first()
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post('/api/sale/', {
+                'shop_id': self.shops[0].id, 'items': [{'id': good.id, 'quantity': 2}]
+            }, content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+
+        for filters, cards in ((shop_filters, shop_cards), (all_filters, all_cards)):
+            updated = summary_cards(filters)
+            for card in ('today_revenue', 'week_revenue', 'month_revenue'):
+                self.assertEqual(updated[card], cards[card] + good.price * 2)
+
+    def test_deploy_check_wants_a_shared_cache(self):
+        self.assertEqual([warning.id for warning in check_shared_cache(None)], ['shop.W001'])
+        redis = {'default': {'BACKEND': 'django.core.cache.backends.redis.RedisCache', 'LOCATION': 'redis://cache:6379/0'}}
+        with override_settings(CACHES=redis):
+            self.assertEqual(check_shared_cache(None), [])
+
+    def test_stale_report_served_while_refreshing(self):
+        filters = ReportFilters(shop_id=self.shops[0].id, date_filter='month')
+        entry = cached_section(filters, 'summary')
+        with mock.patch.object(finance, 'start_refresh') as refresh:
+            self.assertEqual(cached_section(filters, 'summary')['computed_at'], entry['computed_at'])
+            refresh.assert_not_called()
+
+            # A write makes the entry stale: it is still served, one refresh is started
+            with self.captureOnCommitCallbacks(execute=True):
+                record_expense(Expense.objects.create(
+                    shop=self.shops[0], amount=Decimal('1.00'), created_by=self.admin,
+                    expense_date=timezone.localdate()
+                ))
+            self.assertEqual(cached_section(filters, 'summary')['computed_at'], entry['computed_at'])
+            self.assertEqual(cached_section(filters, 'summary')['computed_at'], entry['computed_at'])
+            refresh.assert_called_once()
+
+    def test_csv_export_streams_sales_and_debts(self):
+        params = {'date_filter': 'custom'}
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/finance/export/csv/', params)
+            content = b''.join(response.streaming_content).decode('utf-8-sig')
+        self.assertLessEqual(len(queries), self.QUERY_BUDGET)
+
+        rows = list(csv.reader(io.StringIO(content)))
+        kinds = [row[1] for row in rows[1:]]
+        self.assertEqual(kinds.count('Satış'), Sale.objects.count())
+        self.assertEqual(kinds.count('Borc'), DebtItem.objects.exclude(debt__status='cancelled').count())
+        self.assertEqual([row[0] for row in rows[1:]], sorted(row[0] for row in rows[1:]))
+
+    def xlsx_rows(self, response):
+        archive = zipfile.ZipFile(io.BytesIO(b''.join(response.streaming_content)))
+        self.assertIsNone(archive.testzip())
+        sheet = archive.read('xl/worksheets/sheet1.xml').decode()
+        return re.findall(r'<row r="\d+">(.*?)</row>', sheet)
+
+    def test_xlsx_exports(self):
+        with CaptureQueriesContext(connection) as queries:
+            rows = self.xlsx_rows(self.client.get('/finance/export/xlsx/', {'date_filter': 'custom'}))
+        self.assertLessEqual(len(queries), self.QUERY_BUDGET)
+        debt_items = DebtItem.objects.exclude(debt__status='cancelled').count()
+        self.assertEqual(len(rows), 1 + Sale.objects.count() + debt_items)
+
+        rows = self.xlsx_rows(self.client.get('/finance/export/xlsx/', {'kind': 'expenses', 'date_filter': 'custom'}))
+        self.assertEqual(len(rows), 1 + Expense.objects.count())
+
+        response = self.client.post('/admin/shop/debt/', {
+            'action': 'export_xlsx', '_selected_action': list(Debt.objects.values_list('pk', flat=True)[:5]),
+        })
+        rows = self.xlsx_rows(response)
+        self.assertEqual(len(rows), 6)
+        self.assertIn('Gözləyir', ''.join(rows))
+
+    def test_xlsx_splits_sheets_at_the_row_limit(self):
+        rows = [('Tarix', 'Məbləğ')] + [(f'2024-01-0{day}', day) for day in range(1, 6)]
+        with mock.patch.object(xlsx, 'MAX_SHEET_ROWS', 3):
+            archive = zipfile.ZipFile(io.BytesIO(b''.join(xlsx.stream_xlsx(iter(rows), 'Satışlar', batch_size=2))))
+        self.assertIsNone(archive.testzip())
+        sheets = [re.findall(r'<row r="(\d+)">(.*?)</row>', archive.read(f'xl/worksheets/sheet{n}.xml').decode())
+                  for n in (1, 2, 3)]
+        self.assertEqual([len(sheet) for sheet in sheets], [3, 3, 2])
+        # Every sheet starts again at row 1 with the header
+        self.assertTrue(all(sheet[0][0] == '1' and 'Tarix' in sheet[0][1] for sheet in sheets))
+        self.assertEqual(sum(len(sheet) - 1 for sheet in sheets), 5)
+        workbook = archive.read('xl/workbook.xml').decode()
+        self.assertEqual(re.findall(r'<sheet name="(.*?)"', workbook), ['Satışlar', 'Satışlar (2)', 'Satışlar (3)'])
+        self.assertEqual(archive.read('[Content_Types].xml').decode().count('worksheet+xml'), 3)
+        self.assertEqual(archive.read('xl/_rels/workbook.xml.rels').decode().count('worksheets/sheet'), 3)
+
+        # Exactly full sheets do not leave an empty one behind
+        with mock.patch.object(xlsx, 'MAX_SHEET_ROWS', 3):
+            archive = zipfile.ZipFile(io.BytesIO(b''.join(xlsx.stream_xlsx(rows[:5], 'Satışlar'))))
+        self.assertEqual(sorted(n for n in archive.namelist() if 'worksheets/' in n),
+                         ['xl/worksheets/sheet1.xml', 'xl/worksheets/sheet2.xml'])
+
+    def test_admin_cannot_bypass_the_write_paths(self):
+        sale, debt = Sale.objects.first(), Debt.objects.first()
+        for model, obj in ((Sale, sale), (Debt, debt), (DebtItem, debt.items.first()), (DailyShopSummary, None),
+                           (CostLayer, None)):
+            url = f'/admin/shop/{model._meta.model_name}/'
+            with self.subTest(model=model.__name__):
+                self.assertEqual(self.client.get(url).status_code, 200)
+                self.assertEqual(self.client.get(url + 'add/').status_code, 403)
+                if obj is not None:
+                    self.assertEqual(self.client.post(f'{url}{obj.pk}/delete/', {'post': 'yes'}).status_code, 403)
+                    # The change page only shows the row
+                    self.assertNotContains(self.client.get(f'{url}{obj.pk}/change/'), 'name="_save"')
+        self.assertTrue(Sale.objects.filter(pk=sale.pk).exists())
+
+        # Deleting a shop, category or good would cascade to its sales and debts behind the summaries
+        good = sale.good
+        for model, obj in ((Shop, sale.shop), (Category, good.category), (Good, good)):
+            url = f'/admin/shop/{model._meta.model_name}/'
+            with self.subTest(model=model.__name__):
+                self.assertContains(self.client.post(f'{url}{obj.pk}/delete/', {'post': 'yes'}), 'Cannot delete')
+                self.client.post(url, {'action': 'delete_selected', '_selected_action': [obj.pk], 'post': 'yes'})
+                with self.assertRaises(ProtectedError):
+                    model.objects.filter(pk=obj.pk).delete()
+                self.assertTrue(model.objects.filter(pk=obj.pk).exists())
+        debt_good = debt.items.first().good
+        Sale.objects.filter(good=debt_good).delete()
+        with self.assertRaises(ProtectedError):
+            debt_good.delete()
+        unsold = Good.objects.create(
+            name='Unsold', price=Decimal('1.00'), buy_price=Decimal('0.50'), barcode='999',
+            category=good.category, shop=good.shop
+        )
+        self.client.post(f'/admin/shop/good/{unsold.pk}/delete/', {'post': 'yes'})
+        self.assertFalse(Good.objects.filter(pk=unsold.pk).exists())
+
+    def test_timeseries_dense_and_consistent(self):
+        today = timezone.localdate()
+        params = {'date_filter': 'custom', 'start_date': str(today - timedelta(days=40)), 'end_date': str(today)}
+        report = compute_report(ReportFilters(**params))
+        for bucket in ('hour', 'day', 'week', 'month'):
+            for group in ('shop', 'category'):
+                with self.subTest(bucket=bucket, group=group):
+                    data = timeseries(ReportFilters(**params), bucket, group)
+                    for item in data['series']:
+                        self.assertEqual(len(item['revenue']), len(data['labels']))
+                    self.assertAlmostEqual(
+                        sum(sum(item['revenue']) for item in data['series']), float(report['total_revenue']), places=2
+                    )
+                    self.assertEqual(sum(sum(item['transactions']) for item in data['series']), report['num_sales'])
+                    # The raw-table path buckets the same way
+                    raw = timeseries(ReportFilters(barcode='100', **params), bucket, group)
+                    self.assertEqual(raw['labels'], data['labels'])
+                    self.assertEqual(
+                        {item['name']: item['revenue'] for item in raw['series']},
+                        {item['name']: item['revenue'] for item in data['series']}
+                    )
+
+    def test_leaderboard_matches_raw_tables(self):
+        filters = ReportFilters(date_filter='custom')
+        good = Good.objects.get(barcode='1000')
+        sold = (
+            Sale.objects.filter(good=good).aggregate(total=Sum('quantity'))['total']
+            + DebtItem.objects.filter(good=good).exclude(debt__status='cancelled').aggregate(total=Sum('quantity'))['total']
+        )
+        rows = {row['id']: row for row in leaderboard(filters, 'quantity', limit=100)}
+        self.assertEqual(rows[good.id]['quantity'], sold)
+
+        top = leaderboard(filters, 'revenue')
+        self.assertEqual([row['revenue'] for row in top], sorted((row['revenue'] for row in top), reverse=True))
+
+        # Goods that never sold still rank last
+        unsold = Good.objects.create(
+            name='Unsold', price=Decimal('1.00'), buy_price=Decimal('0.50'), stock_count=5, barcode='999',
+            category=good.category, shop=good.shop
+        )
+        cache.clear()
+        self.assertEqual(leaderboard(filters, 'quantity', worst=True)[0]['id'], unsold.id)
+
+        categories = leaderboard(filters, 'quantity', level='category')
+        self.assertEqual(sum(row['quantity'] for row in categories), sum(row['quantity'] for row in rows.values()))
+
+    def test_shop_matrix_matches_reports(self):
+        for params in self.filter_sets() + [dict(params, barcode='100') for params in self.filter_sets()]:
+            params = dict(params, shop=str(self.shops[0].id))
+            with self.subTest(params=params):
+                with CaptureQueriesContext(connection) as queries:
+                    response = self.client.get('/api/finance/shops/', params)
+                self.assertLessEqual(len(queries), self.QUERY_BUDGET)
+                rows = response.json()['rows']
+                # Every shop is a row, whatever the shop filter
+                self.assertEqual([row['shop_id'] for row in rows], [shop.id for shop in self.shops])
+                for row in rows:
+                    filters = ReportFilters.from_request(response.wsgi_request).for_shop(row['shop_id'])
+                    expected = compute_report(filters, cards=False)
+                    for metric in ('total_revenue', 'total_profit', 'net_profit', 'total_expenses',
+                                   'items_sold', 'num_sales', 'pending_debts_count'):
+                        self.assertEqual(Decimal(str(row[metric])), expected[metric], metric)
+                    pending = Debt.objects.filter(filters.debts_q(), status='pending')
+                    self.assertEqual(
+                        Decimal(str(row['pending_debts_amount'])),
+                        pending.aggregate(total=Sum('remaining_amount'))['total'] or 0
+                    )
+
+    def test_comparisons_match_reports(self):
+        today = timezone.localdate()
+        shop = self.shops[0].id
+        comparisons = compare_periods(ReportFilters(shop_id=shop))
+
+        def report(first, last):
+            return compute_report(ReportFilters(
+                shop_id=shop, date_filter='custom', start_date=str(first), end_date=str(last)
+            ), cards=False)
+
+        for name, pair in comparisons.items():
+            for side in ('current', 'previous'):
+                with self.subTest(name=name, side=side):
+                    expected = report(*pair['period'][side])
+                    for metric in ('total_revenue', 'net_profit', 'items_sold', 'num_sales'):
+                        self.assertEqual(pair[metric][side], expected[metric])
+        self.assertEqual(comparisons['same_weekday']['period']['previous'], [str(today - timedelta(days=7))] * 2)
+
+    def test_history_pages_walk_the_whole_feed(self):
+        # Rows sharing a timestamp, across and within sources, must neither repeat nor go missing
+        debt = Debt.objects.exclude(status='cancelled').order_by('-created_at')[3]
+        good = Good.objects.filter(shop=debt.shop).first()
+        Sale.objects.bulk_create([
+            Sale(good=good, quantity=1, total_price=good.price, shop=debt.shop, timestamp=debt.created_at)
+            for _ in range(3)
+        ])
+        for params in self.filter_sets():
+            with self.subTest(params=params):
+                response = self.client.get('/api/finance/sales/', params)
+                filters = ReportFilters.from_request(response.wsgi_request)
+                page = response.json()['sales']
+                seen = [(row['type'], row['id']) for row in page['rows']]
+                while page['next']:
+                    with CaptureQueriesContext(connection) as queries:
+                        page = self.client.get('/api/finance/sales/', dict(params, cursor=page['next'])).json()['sales']
+                    self.assertLessEqual(len(queries), self.QUERY_BUDGET)
+                    seen += [(row['type'], row['id']) for row in page['rows']]
+
+                expected = sorted(
+                    [(sale.timestamp, 'sale', sale.id) for sale in Sale.objects.filter(filters.sales_q())]
+                    + [(debt.created_at, 'debt', debt.id) for debt in Debt.objects.filter(filters.debts_q())],
+                    reverse=True
+                )
+                self.assertEqual(seen, [(kind, row_id) for _, kind, row_id in expected])
+        self.assertEqual(self.client.get('/api/finance/sales/', {'cursor': 'bogus'}).status_code, 400)
+
+    def test_worker_shift_rollups_match_rebuild(self):
+        cashier = User.objects.create_user('cashier', password='cashier123')
+        self.client.force_login(cashier)
+        goods = list(Good.objects.filter(shop=self.shops[0]))
+        for request_id in ('t1', 't2'):
+            response = self.client.post('/api/sale/', {
+                'request_id': request_id, 'shop_id': self.shops[0].id,
+                'items': [{'id': good.id, 'quantity': 2} for good in goods],
+            }, content_type='application/json')
+            self.assertEqual(response.status_code, 200)
+        self.client.force_login(self.admin)
+        self.client.post('/api/sale/void/', {'request_id': 'v2', 'transaction_id': 't2'}, content_type='application/json')
+        self.assertEqual(set(Sale.objects.filter(transaction_id__in=['t1', 't2']).values_list('worker', flat=True)), {cashier.id})
+
+        def rows():
+            return sorted(WorkerShiftSummary.objects.values_list(
+                'shop_id', 'worker_id', 'date', 'shift', 'revenue', 'items', 'transactions', 'profit'
+            ), key=str)
+
+        recorded = rows()
+        rebuild_summaries()
+        self.assertEqual(recorded, rows())
+
+        report = {row['worker']: row for row in self.client.get('/api/finance/shifts/').json()['rows']}
+        expected = sum(good.price * 2 for good in goods)
+        self.assertEqual(Decimal(report['cashier']['revenue']), expected)
+        self.assertEqual(report['cashier']['transactions'], 2)
+        self.assertEqual(Decimal(report['cashier']['avg_basket']), (expected / 2).quantize(Decimal('0.01')))
+        self.client.force_login(cashier)
+        self.assertEqual(self.client.get('/api/finance/shifts/').status_code, 403)
+
+
+    def test_deleted_cashier_becomes_unknown(self):
+        cashier = User.objects.create_user('cashier', password='cashier123')
+        goods = list(Good.objects.filter(shop=self.shops[0]))
+        # Sold by the cashier, then at a till without a login: both land in the same shift
+        for request_id, user in (('t1', cashier), ('t2', None)):
+            if user:
+                self.client.force_login(user)
+            else:
+                self.client.logout()
+            self.client.post('/api/sale/', {
+                'request_id': request_id, 'shop_id': self.shops[0].id,
+                'items': [{'id': good.id, 'quantity': 1} for good in goods],
+            }, content_type='application/json')
+        cashier.delete()
+
+        def rows():
+            return sorted(WorkerShiftSummary.objects.values_list(
+                'shop_id', 'worker_id', 'date', 'shift', 'revenue', 'items', 'transactions', 'profit'
+            ), key=str)
+        recorded = rows()
+        rebuild_summaries()
+        self.assertEqual(recorded, rows())
+
+        self.client.force_login(self.admin)
+        self.assertFalse(WorkerShiftSummary.objects.filter(worker__isnull=False).exists())
+        report = self.client.get('/api/finance/shifts/').json()['rows']
+        self.assertEqual({row['worker'] for row in report}, {shifts.UNKNOWN_WORKER})
+
+class CostingTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.admin = User.objects.create_superuser('admin', password='admin123')
+        cls.shop = Shop.objects.create(name='Shop')
+        # 2 units of opening stock have no layer: they cost buy_price
+        cls.good = Good.objects.create(
+            name='Good', price=Decimal('5.00'), buy_price=Decimal('3.00'), stock_count=2, barcode='200',
+            category=Category.objects.create(name='Category'), shop=cls.shop
+        )
+        for quantity, unit_cost in ((5, '1.00'), (5, '2.00')):
+            StockReceipt.objects.create(
+                good=cls.good, quantity=quantity, unit_cost=Decimal(unit_cost), shop=cls.shop, created_by=cls.admin
+            )
+
+    def setUp(self):
+        cache.clear()
+        self.client.force_login(self.admin)
+
+    def sell(self, quantity, request_id):
+        response = self.client.post('/api/sale/', {
+            'request_id': request_id, 'shop_id': self.shop.id, 'items': [{'id': self.good.id, 'quantity': quantity}],
+        }, content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        return Sale.objects.get(id=response.json()['sale_ids'][0])
+
+    def costs(self):
+        return list(Sale.objects.order_by('id').values_list('cost', flat=True))
+
+    def test_fifo_costs_survive_rebuild(self):
+        self.assertEqual(self.sell(7, 's1').cost, Decimal('9.00'))  # 5 x 1.00 + 2 x 2.00
+        self.client.post('/api/sale/void/', {'request_id': 'v1', 'transaction_id': 's1', 'lines': [
+            {'sale_id': Sale.objects.get(transaction_id='s1').id, 'quantity': 2}
+        ]}, content_type='application/json')
+        # 3 x 2.00 left, then the 2 returned units at 9.00 / 7, then 2 units without a layer at 3.00
+        self.assertEqual(self.sell(7, 's2').cost, Decimal('14.57'))
+        live = self.costs()
+        self.assertEqual(live[1], Decimal('-2.57'))
+
+        rebuild_costs()
+        self.assertEqual(self.costs(), live)
+        self.assertEqual(CostLayer.objects.filter(remaining__gt=0).count(), 0)
+
+    @override_settings(COST_METHOD='average')
+    def test_weighted_average_costs(self):
+        self.assertEqual(self.sell(4, 's1').cost, Decimal('6.00'))  # 4 x 1.50
+        self.assertEqual(self.sell(6, 's2').cost, Decimal('11.00'))  # 6 x (1 x 1.00 + 5 x 2.00) / 6
+        self.assertEqual(self.sell(2, 's3').cost, Decimal('6.00'))
+        live = self.costs()
+        rebuild_costs()
+        self.assertEqual(self.costs(), live)
+
+    def test_debts_consume_and_return_layers(self):
+        self.good.refresh_from_db()
+        stock = self.good.stock_count
+        response = self.client.post('/api/debt/create/', {
+            'customer_name': 'Customer', 'shop_id': self.shop.id, 'due_date': '2030-01-01',
+            'items': [{'id': self.good.id, 'quantity': 6}],
+        }, content_type='application/json')
+        debt = Debt.objects.get(id=response.json()['debt_id'])
+        self.assertEqual(debt.items.get().cost, Decimal('7.00'))  # 5 x 1.00 + 1 x 2.00
+        self.assertEqual(debt.profit, Decimal('23.00'))
+
+        # The whole debt goes back to stock with one set-based UPDATE
+        with CaptureQueriesContext(connection) as queries:
+            self.client.post('/api/debt/cancel/', {'debt_id': debt.id}, content_type='application/json')
+        stock_updates = [query['sql'] for query in queries if query['sql'].startswith('UPDATE "shop_good"')]
+        self.assertEqual(len(stock_updates), 1)
+        self.assertIn('CASE WHEN', stock_updates[0])
+        self.good.refresh_from_db()
+        self.assertEqual(self.good.stock_count, stock)
+        self.assertEqual(self.sell(7, 's1').cost, Decimal('11.50'))  # 4 x 2.00 + 3 of the 6 returned at 7.00 / 6
+
+        # The rebuild replays the cancellation: taken at creation, returned when cancelled
+        def state():
+            layers = CostLayer.objects.order_by('received_at', 'id').values_list('quantity', 'remaining', 'unit_cost')
+            return self.costs(), debt.items.get().cost, list(layers)
+        live = state()
+        rebuild_costs()
+        self.assertEqual(state(), live)
+
+    def test_create_debt_is_atomic(self):
+        self.good.refresh_from_db()
+        stock = self.good.stock_count
+
+        def create(items):
+            return self.client.post('/api/debt/create/', {
+                'customer_name': 'Customer', 'shop_id': self.shop.id, 'due_date': '2030-01-01', 'items': items,
+            }, content_type='application/json')
+
+        # Two lines of the same good are checked against the stock together
+        self.assertEqual(create([{'id': self.good.id, 'quantity': stock}, {'id': self.good.id, 'quantity': 1}]).status_code, 400)
+        self.assertEqual(create([{'id': self.good.id, 'quantity': 1}, {'id': 0, 'quantity': 1}]).status_code, 404)
+        self.assertFalse(Debt.objects.exists())
+        self.good.refresh_from_db()
+        self.assertEqual(self.good.stock_count, stock)
+
+        debt = Debt.objects.get(id=create([
+            {'id': self.good.id, 'quantity': 2}, {'id': self.good.id, 'quantity': 1},
+        ]).json()['debt_id'])
+        self.good.refresh_from_db()
+        self.assertEqual(self.good.stock_count, stock - 3)
+        self.assertEqual([item.total_price for item in debt.items.order_by('id')], [self.good.price * 2, self.good.price])
+        self.assertEqual((debt.total_amount, debt.items_quantity), (self.good.price * 3, 3))
+
+    def test_moving_average_cost(self):
+        self.good.refresh_from_db()
+        # 2 units of opening stock at the 3.00 buy price, then 5 x 1.00 and 5 x 2.00
+        self.assertEqual(self.good.avg_cost, Decimal('1.7500'))
+        rebuild_costs()
+        self.good.refresh_from_db()
+        self.assertEqual(self.good.avg_cost, Decimal('1.7500'))
+
+        receipt, = StockReceipt.bulk_receive([StockReceipt(
+            good=self.good, quantity=12, unit_cost=Decimal('4.00'), shop=self.shop, created_by=self.admin
+        )])
+        self.good.refresh_from_db()
+        self.assertEqual((self.good.stock_count, self.good.avg_cost), (24, Decimal('2.8750')))
+        self.assertEqual(receipt.cost_layer.remaining, 12)
+
+        StockReceipt.objects.get(id=receipt.id).delete()
+        self.good.refresh_from_db()
+        self.assertEqual((self.good.stock_count, self.good.avg_cost), (12, Decimal('1.7500')))
+
+    def test_stock_receipt_page_receives_in_bulk(self):
+        items = [{'id': self.good.id, 'quantity': 12, 'unit_cost': '4.00'}, {'id': self.good.id, 'quantity': 6, 'unit_cost': '1,75'}]
+        self.client.post('/stock-receipt/', {
+            'items_data': json.dumps(items), 'shop_id': self.shop.id, 'receipt_type': 'purchase',
+        })
+        self.good.refresh_from_db()
+        self.assertEqual((self.good.stock_count, self.good.avg_cost), (30, Decimal('2.6500')))
+        self.assertEqual(CostLayer.objects.filter(receipt__isnull=False).count(), 4)
+
+
+class VoidSaleTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.admin = User.objects.create_superuser('admin', password='admin123')
+        cls.shop, cls.other_shop = Shop.objects.create(name='Shop'), Shop.objects.create(name='Other')
+        category = Category.objects.create(name='Category')
+        cls.goods = [
+            Good.objects.create(
+                name=f'Good {i}', price=Decimal('2.50') + i, buy_price=Decimal('1.00'), stock_count=10,
+                barcode=f'30{i}', category=category, shop=cls.shop
+            )
+            for i in range(2)
+        ]
+        cls.cashier = User.objects.create_user('cashier', password='cashier123')
+        Worker.objects.create(user=cls.cashier, shop=cls.shop)
+
+    def setUp(self):
+        cache.clear()
+        self.client.force_login(self.admin)
+        response = self.client.post('/api/sale/', {
+            'request_id': 't1', 'shop_id': self.shop.id,
+            'items': [{'id': self.goods[0].id, 'quantity': 3}, {'id': self.goods[1].id, 'quantity': 2}],
+        }, content_type='application/json')
+        self.sales = list(Sale.objects.filter(id__in=response.json()['sale_ids']).order_by('id'))
+
+    def void(self, data, user=None):
+        self.client.force_login(user or self.admin)
+        return self.client.post('/api/sale/void/', data, content_type='application/json')
+
+    def stock(self):
+        return list(Good.objects.filter(shop=self.shop).order_by('id').values_list('stock_count', flat=True))
+
+    def test_partial_then_full_void(self):
+        response = self.void({'request_id': 'v1', 'lines': [{'sale_id': self.sales[0].id, 'quantity': 1}]})
+        self.assertEqual(response.json()['voided_lines'], 1)
+        self.assertEqual(self.stock(), [8, 8])
+
+        response = self.void({'request_id': 'v2', 'transaction_id': 't1'})
+        self.assertEqual(response.json()['voided_lines'], 2)
+        self.assertEqual(self.stock(), [10, 10])
+        self.assertEqual(
+            Sale.objects.filter(good__shop=self.shop).aggregate(Sum('quantity'), Sum('total_price'), Sum('cost')),
+            {'quantity__sum': 0, 'total_price__sum': Decimal('0.00'), 'cost__sum': Decimal('0.00')}
+        )
+        self.assertEqual(self.void({'request_id': 'v3', 'transaction_id': 't1'}).json()['message'], 'Sale already voided')
+
+        recorded = compute_report(ReportFilters(date_filter='today'))
+        rebuild_summaries()
+        self.assertEqual(recorded, compute_report(ReportFilters(date_filter='today')))
+        self.assertEqual(recorded['total_revenue'], 0)
+
+    def test_retried_void_is_applied_once(self):
+        line = {'request_id': 'v1', 'lines': [{'sale_id': self.sales[0].id, 'quantity': 1}]}
+        self.void(line)
+        response = self.void(line)
+        self.assertEqual(response.json()['message'], 'Void already processed (duplicate request ignored)')
+        self.assertEqual(self.stock(), [8, 8])
+        self.assertEqual(Sale.objects.filter(voided_sale__isnull=False).count(), 1)
+
+        # A concurrent retry that missed the rows of the first one hits the constraint
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            Sale.objects.create(
+                good=self.goods[0], quantity=-1, total_price=Decimal('-2.50'), shop=self.shop,
+                timestamp=timezone.now(), transaction_id='v1', voided_sale=self.sales[0]
+            )
+        # The till's request_id is required: a fresh one per retry would void again
+        self.assertEqual(self.void({'lines': line['lines']}).status_code, 400)
+
+    def test_invalid_quantities(self):
+        for quantity in (0, -1, 'two', 4):
+            with self.subTest(quantity=quantity):
+                response = self.void({'request_id': 'v1', 'lines': [{'sale_id': self.sales[0].id, 'quantity': quantity}]})
+                self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.stock(), [7, 8])
+        self.assertFalse(Sale.objects.filter(voided_sale__isnull=False).exists())
+
+    def test_void_rows_validate(self):
+        self.void({'request_id': 'v1', 'transaction_id': 't1'})
+        for row in Sale.objects.all():
+            row.full_clean()
+        for quantity, total_price, voided_sale in ((0, 1, None), (1, -1, None), (1, -1, self.sales[0]), (-1, 1, self.sales[0])):
+            with self.subTest(quantity=quantity, total_price=total_price, voided_sale=voided_sale):
+                with self.assertRaises(ValidationError):
+                    Sale(
+                        good=self.goods[0], shop=self.shop, quantity=quantity, total_price=Decimal(total_price),
+                        voided_sale=voided_sale, timestamp=timezone.now()
+                    ).full_clean()
+
+    def test_cashiers_void_in_their_shop_only(self):
+        outsider = User.objects.create_user('outsider', password='outsider123')
+        self.assertEqual(self.void({'request_id': 'v1', 'transaction_id': 't1'}, outsider).status_code, 403)
+        other = User.objects.create_user('other', password='other123')
+        Worker.objects.create(user=other, shop=self.other_shop)
+        self.assertEqual(self.void({'request_id': 'v1', 'transaction_id': 't1'}, other).status_code, 404)
+        self.assertEqual(self.void({'request_id': 'v1', 'transaction_id': 't1'}, self.cashier).status_code, 200)
+        self.assertEqual(self.stock(), [10, 10])
+
+
+class SummaryTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.admin = User.objects.create_superuser('admin', password='admin123')
+        cls.shop = Shop.objects.create(name='Shop')
+        categories = [Category.objects.create(name=f'Category {i}') for i in range(2)]
+        cls.goods = [
+            Good.objects.create(
+                name=f'Good {i}', price=Decimal('4.00') + i, buy_price=Decimal('1.50'), stock_count=100,
+                barcode=f'50{i}', category=categories[i % 2], shop=cls.shop
+            )
+            for i in range(3)
+        ]
+        cls.cashier = User.objects.create_user('cashier', password='cashier123')
+        Worker.objects.create(user=cls.cashier, shop=cls.shop)
+
+    def setUp(self):
+        cache.clear()
+        self.client.force_login(self.admin)
+
+    def post(self, path, data):
+        response = self.client.post(path, data, content_type='application/json')
+        self.assertEqual(response.status_code, 200, response.content)
+        return response.json()
+
+    def summary_rows(self):
+        """Every summary row the write paths keep up to date, without ids"""
+        return {
+            model.__name__: sorted(
+                model.objects.values_list(*[field.attname for field in model._meta.concrete_fields if field.name != 'id']),
+                key=str
+            )
+            for model in (DailyShopSummary, HourlyShopSummary, DailyGoodSummary, WorkerShiftSummary)
+        }
+
+    def test_incremental_rollups_match_rebuild(self):
+        items = [{'id': good.id, 'quantity': 2 + i} for i, good in enumerate(self.goods)]
+        sale_ids = self.post('/api/sale/', {'request_id': 't1', 'shop_id': self.shop.id, 'items': items})['sale_ids']
+        self.post('/api/sale/', {'request_id': 't2', 'shop_id': self.shop.id, 'items': items[:1]})
+        self.post('/api/sale/void/', {'request_id': 'v1', 'lines': [{'sale_id': sale_ids[1], 'quantity': 1}]})
+        self.post('/api/sale/void/', {'request_id': 'v2', 'transaction_id': 't2'})
+        debts = [
+            self.post('/api/debt/create/', {
+                'customer_name': f'Customer {i}', 'shop_id': self.shop.id, 'due_date': '2030-01-01', 'items': items,
+            })['debt_id']
+            for i in range(2)
+        ]
+        self.post('/api/debt/pay/', {'debt_id': debts[0], 'amount': '3.00'})
+        self.post('/api/debt/cancel/', {'debt_id': debts[1]})
+        self.client.force_login(self.cashier)
+        self.client.post('/finance/', {'expense_amount': '12.50', 'expense_shop': self.shop.id})
+        self.assertEqual(Expense.objects.count(), 1)
+
+        recorded = self.summary_rows()
+        self.assertTrue(all(recorded.values()))
+        rebuild_summaries()
+        self.assertEqual(self.summary_rows(), recorded)
+
+    def test_time_window_edges(self):
+        yesterday = timezone.localdate() - timedelta(days=1)
+        good = self.goods[0]
+        times = [(yesterday, '07:10'), (yesterday, '07:20'), (yesterday, '12:00'), (yesterday, '18:40'),
+                 (yesterday, '18:50'), (yesterday + timedelta(days=1), '00:30'), (yesterday + timedelta(days=1), '07:14')]
+        sales = Sale.objects.bulk_create([
+            Sale(
+                good=good, shop=self.shop, quantity=i + 1, total_price=good.price * (i + 1), cost=Decimal('1.50') * (i + 1),
+                timestamp=timezone.make_aware(datetime.combine(day, datetime.strptime(at, '%H:%M').time()))
+            )
+            for i, (day, at) in enumerate(times)
+        ])
+        rebuild_summaries()
+
+        # Daytime window inside one day, and a night window over midnight: both cut hours in two
+        for start_date, end_date, start_time, end_time, inside in (
+            (yesterday, yesterday, '07:15', '18:45', sales[1:4]),
+            (yesterday, yesterday + timedelta(days=1), '18:45', '07:12', sales[4:6]),
+        ):
+            filters = {
+                'date_filter': 'custom', 'start_date': str(start_date), 'end_date': str(end_date),
+                'start_time': start_time, 'end_time': end_time,
+            }
+            with self.subTest(**filters):
+                report = compute_report(ReportFilters(**filters))
+                self.assertEqual(report['sales_revenue'], sum(sale.total_price for sale in inside))
+                self.assertEqual(report['items_sold'], sum(sale.quantity for sale in inside))
+                self.assertEqual(report['total_profit'], sum(sale.total_price - sale.cost for sale in inside))
+                # A barcode matching every good forces the raw-table path
+                self.assertEqual(report, compute_report(ReportFilters(barcode='50', **filters)))
+
+
+class QueryBudgetTests(TestCase):
+    """Every URL of shop/urls.py runs a bounded number of queries on a realistically sized database"""
+    # Write views pay a few rollup upserts per cart line on top of their base budget,
+    # which includes reading the shop time zones on a cold cache
+    PER_LINE = 4
+    # An upsert that creates its summary row: UPDATE, SELECT, SAVEPOINT, INSERT, RELEASE
+    NEW_ROW = 5
+    CART_LINES = 10
+    # One finance section or export, unfiltered (FinanceDashboardTests covers the filters)
+    FINANCE_BUDGET = 8
+    EXPORT_BUDGET = 12
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.admin = User.objects.create_superuser('admin', password='admin123')
+        cls.shops = [Shop.objects.create(name=f'Shop {i}') for i in range(3)]
+        cls.worker = User.objects.create_user('worker', password='worker123')
+        Worker.objects.create(user=cls.worker, shop=cls.shops[0])
+        categories = [Category.objects.create(name=f'Category {i}') for i in range(4)]
+        Good.objects.bulk_create([
+            Good(
+                name=f'Good {i}', price=Decimal('2.00') + i % 7, buy_price=Decimal('1.00') + i % 5,
+                stock_count=500, barcode=f'4{i:05d}', category=categories[i % 4], shop=cls.shops[i % 3]
+            )
+            for i in range(240)
+        ])
+        cls.goods = list(Good.objects.order_by('id'))
+        cls.pack = Good.objects.create(
+            name='Pack', price=Decimal('6.00'), buy_price=Decimal('4.00'), stock_count=50, barcode='pack',
+            category=categories[0], shop=cls.shops[0], product_type='cigarette_pack'
+        )
+        Good.objects.create(
+            name='Single', price=Decimal('0.40'), buy_price=Decimal('0.20'), stock_count=0, barcode='single',
+            category=categories[0], shop=cls.shops[0], related_pack=cls.pack
+        )
+
+        # Seed history ends at a whole hour of yesterday: the writes of the budget cases
+        # always find today's summary buckets missing, whatever the time of day
+        now = timezone.now().replace(minute=0, second=0, microsecond=0) - timedelta(days=1)
+        StockReceipt.bulk_receive([
+            StockReceipt(
+                good=good, quantity=20, unit_cost=good.buy_price, shop=good.shop,
+                supplier=f'Supplier {i % 4}', created_by=cls.admin
+            )
+            for i, good in enumerate(cls.goods[:120])
+        ])
+        Sale.objects.bulk_create([
+            Sale(
+                good=good, quantity=1 + i % 3, total_price=good.price * (1 + i % 3), shop=good.shop,
+                timestamp=now - timedelta(minutes=37 * i), transaction_id=f'seed-{i // 3}',
+                worker=cls.worker if i % 2 else cls.admin
+            )
+            for i, good in ((i, cls.goods[i % 240]) for i in range(1500))
+        ])
+        debts = Debt.objects.bulk_create([
+            Debt(
+                customer_name=f'Customer {i}', shop=cls.shops[i % 3], total_amount=Decimal('10.00'),
+                remaining_amount=Decimal('10.00'), due_date=timezone.localdate() + timedelta(days=i % 20 - 10),
+                status=['pending', 'paid', 'cancelled'][i % 3], created_by=cls.admin
+            )
+            for i in range(150)
+        ])
+        DebtItem.objects.bulk_create([
+            DebtItem(debt=debt, good=cls.goods[i % 240], quantity=2, unit_price=Decimal('5.00'), total_price=Decimal('10.00'))
+            for i, debt in enumerate(debts)
+        ])
+        Debt.objects.update(created_at=now)
+        Expense.objects.bulk_create([
+            Expense(
+                shop=cls.shops[i % 3], amount=Decimal('5.00') + i, created_by=cls.admin,
+                expense_date=timezone.localdate() - timedelta(days=i)
+            )
+            for i in range(40)
+        ])
+        rebuild_costs()
+        rebuild_summaries()
+        build_inventory_report()
+        backfill_customers()
+
+    def setUp(self):
+        cache.clear()
+        self.client.force_login(self.admin)
+
+    def cart(self, shop):
+        goods = [good for good in self.goods if good.shop_id == shop.id][:self.CART_LINES]
+        return [{'id': good.id, 'quantity': 1} for good in goods]
+
+    def new_rows(self, sales):
+        """Summary rows that sales create in today's empty buckets: hourly and daily
+        per (shop, category), one per good and one shift per (shop, worker)"""
+        categories = {(sale.shop_id, sale.good.category_id) for sale in sales}
+        shifts = {(sale.shop_id, sale.worker_id) for sale in sales}
+        return 2 * len(categories) + len({sale.good_id for sale in sales}) + len(shifts)
+
+    def cases(self):
+        """(url name, user, method, path, data, budget) for every view; write views get a full cart"""
+        shop = self.shops[0]
+        cart = self.cart(shop)
+        goods = Good.objects.in_bulk([item['id'] for item in cart])
+        sold = self.new_rows([Sale(good=good, shop=shop, worker=self.admin) for good in goods.values()])
+        sale = Sale.objects.filter(shop=shop, voided_sale__isnull=True).latest('timestamp')
+        voided = self.new_rows(Sale.objects.filter(transaction_id=sale.transaction_id).select_related('good'))
+        debt = Debt.objects.filter(shop=shop, status='pending').first()
+        other_debt = Debt.objects.filter(shop=shop, status='pending').last()
+        category = Category.objects.first()
+        return [
+            ('health', None, 'get', '/health/', None, 3),
+            ('root_redirect', None, 'get', '/', None, 0),
+            ('login', None, 'get', '/login/', None, 0),
+            ('login', None, 'post', '/login/', {'username': 'admin', 'password': 'admin123'}, 9),
+            ('logout', self.admin, 'post', '/logout/', None, 4),
+            ('worker', self.admin, 'get', '/worker/', None, 3),
+            ('finance', self.admin, 'get', '/finance/', None, 5),
+            ('finance', self.worker, 'get', '/finance/', None, 5),
+            ('create_debt_page', self.admin, 'get', '/create-debt/', None, 3),
+            ('debt_list', self.admin, 'get', '/debts/', None, 6),
+            ('debt_list', self.admin, 'get', '/debts/?status=pending&shop=%d' % shop.id, None, 6),
+            ('debt_list', self.admin, 'get', '/debts/?cursor=%s' % encode_cursor(debt.due_date, debt.id), None, 6),
+            ('worker_open_pack', self.admin, 'get', '/worker/open-pack/', None, 4),
+            ('worker_open_pack', self.worker, 'get', '/worker/open-pack/', None, 5),
+            ('worker_open_pack', self.worker, 'post', '/worker/open-pack/', {'barcode': 'pack'}, 10),
+            ('stock_receipt', self.admin, 'get', '/stock-receipt/', None, 6),
+            ('inventory_report', self.admin, 'get', '/inventory/', None, 6),
+            ('inventory_report', self.admin, 'get', '/inventory/?shop=%d&abc_class=A' % shop.id, None, 6),
+            ('stock_receipt', self.worker, 'get', '/stock-receipt/', None, 6),
+            ('stock_receipt', self.admin, 'post', '/stock-receipt/', {
+                'items_data': json.dumps([dict(item, unit_cost='1.25') for item in cart]),
+                'shop_id': shop.id, 'receipt_type': 'purchase',
+            }, 12),
+            ('search_goods', None, 'get', '/api/search/?q=Good&shop_id=%d' % shop.id, None, 6),
+            ('search_goods_stock', None, 'get', '/api/search-stock/?q=Good&shop_id=%d' % shop.id, None, 6),
+            ('scan_barcode', None, 'post', '/api/scan/', {'barcode': self.goods[0].barcode, 'shop_id': shop.id}, 1),
+            ('scan_barcode_stock', None, 'post', '/api/scan-stock/', {'barcode': self.goods[0].barcode, 'shop_id': shop.id}, 1),
+            ('process_sale', self.admin, 'post', '/api/sale/', {'request_id': 'budget', 'shop_id': shop.id, 'items': cart}, 11 + sold * self.NEW_ROW),
+            ('void_sale', self.admin, 'post', '/api/sale/void/', {'request_id': 'budget-void', 'transaction_id': sale.transaction_id}, 15 + voided * self.NEW_ROW),
+            ('finance_summary_api', self.admin, 'get', '/api/finance/summary/', None, self.FINANCE_BUDGET),
+            ('finance_cards_api', self.admin, 'get', '/api/finance/cards/', None, self.FINANCE_BUDGET),
+            ('finance_sales_api', self.admin, 'get', '/api/finance/sales/', None, self.FINANCE_BUDGET),
+            ('finance_expenses_api', self.admin, 'get', '/api/finance/expenses/', None, self.FINANCE_BUDGET),
+            ('finance_comparison_api', self.admin, 'get', '/api/finance/comparison/', None, self.FINANCE_BUDGET),
+            ('finance_timeseries_api', self.admin, 'get', '/api/finance/timeseries/', None, self.FINANCE_BUDGET),
+            ('finance_leaderboard_api', self.admin, 'get', '/api/finance/leaderboard/', None, self.FINANCE_BUDGET),
+            ('finance_shifts_api', self.admin, 'get', '/api/finance/shifts/', None, self.FINANCE_BUDGET),
+            ('finance_shops_api', self.admin, 'get', '/api/finance/shops/', None, self.FINANCE_BUDGET),
+            ('export_sales_csv', self.admin, 'get', '/finance/export/csv/', None, self.EXPORT_BUDGET),
+            ('export_finance_xlsx', self.admin, 'get', '/finance/export/xlsx/', None, self.EXPORT_BUDGET),
+            ('create_debt', self.admin, 'post', '/api/debt/create/', {
+                'customer_name': 'Budget', 'shop_id': shop.id, 'due_date': '2030-01-01', 'items': cart,
+            }, 13 + (2 + len(cart)) * self.NEW_ROW),  # Batched writes: only the per-good summary rows grow with the cart
+            ('pay_debt', self.admin, 'post', '/api/debt/pay/', {'debt_id': debt.id, 'amount': '1.00'}, 7),
+            ('search_customers_api', self.admin, 'get', '/api/customers/search/?q=Customer', None, 3),
+            ('cancel_debt', self.admin, 'post', '/api/debt/cancel/', {'debt_id': other_debt.id}, 10 + self.PER_LINE),
+            ('api_open_pack', self.worker, 'post', '/api/open-pack/', {'barcode': 'pack'}, 10),
+            ('api_stock_receipt', self.admin, 'post', '/api/stock-receipt/', {
+                'barcode': self.goods[0].barcode, 'quantity': 5, 'unit_cost': '1.10', 'shop_id': shop.id,
+            }, 10),
+            ('create_good_api', self.admin, 'post', '/api/create-good/', {
+                'name': 'New', 'price': '2.50', 'buy_price': '1.50', 'shop_id': shop.id,
+                'barcode': 'new-good', 'category_id': category.id,
+            }, 6),
+            ('api_categories', self.admin, 'get', '/api/categories/', None, 3),
+        ]
+
+    def login(self, user):
+        self.client.logout()
+        if user:
+            self.client.force_login(user)
+
+    def request(self, method, path, data):
+        if method == 'get':
+            return self.client.get(path)
+        if path.startswith('/api/'):
+            return self.client.post(path, data or {}, content_type='application/json')
+        return self.client.post(path, data or {})
+
+    def test_every_url_has_a_budget(self):
+        budgeted = {case[0] for case in self.cases()}
+        self.assertEqual({pattern.name for pattern in urls.urlpatterns} - budgeted, set())
+        for name in budgeted:
+            reverse(f'shop:{name}')
+
+    def test_views_stay_within_budget(self):
+        for name, user, method, path, data, budget in self.cases():
+            with self.subTest(name=name, user=user and user.username, method=method), transaction.atomic():
+                cache.clear()
+                self.login(user)
+                with query_budget(budget):
+                    response = self.request(method, path, data)
+                    # Streamed exports query while they are read
+                    body = b''.join(response.streaming_content) if response.streaming else response.content
+                # Every case starts from the seeded database, so writes always create today's buckets
+                transaction.set_rollback(True)
+                self.assertLess(response.status_code, 400, body[:300])
+
+    def test_budget_reports_the_queries(self):
+        with self.assertRaisesRegex(QueryBudgetExceeded, r'2 queries, budget 1:\n1\. SELECT'):
+            with query_budget(1):
+                list(Shop.objects.all())
+                list(Category.objects.all())
+
+        @query_budget(3)
+        def search():
+            return self.client.get('/api/search/', {'q': 'Good', 'shop_id': self.shops[0].id})
+        self.assertEqual(len(search().json()['results']), 10)
+
+    def test_debt_list_pages(self):
+        seen, cursor = [], ''
+        while True:
+            response = self.client.get('/debts/', {'cursor': cursor})
+            seen += [debt.id for debt in response.context['debts']]
+            cursor = response.context['next_cursor']
+            if not cursor:
+                break
+        self.assertEqual(seen, list(Debt.objects.order_by('-due_date', '-id').values_list('id', flat=True)))
+        self.assertGreater(len(seen), DEBT_PAGE_SIZE)
+
+        shop = self.shops[1]
+        debts = Debt.objects.filter(shop=shop)
+        response = self.client.get('/debts/', {'shop': shop.id})
+        overdue = debts.filter(status='pending', due_date__lt=timezone.localdate())
+        self.assertEqual(response.context['overdue_count'], overdue.count())
+        self.assertEqual(response.context['total_overdue'], sum(debt.remaining_amount for debt in overdue))
+        self.assertEqual(response.context['total_debts'], sum(debt.total_amount for debt in debts))
+        # A malformed cursor shows the first page
+        response = self.client.get('/debts/', {'cursor': 'nonsense'})
+        self.assertEqual(len(response.context['debts']), DEBT_PAGE_SIZE)
+
+    @override_settings(QUERY_BUDGET_WARNING=1)
+    def test_middleware_warns_over_budget(self):
+        middleware = QueryBudgetMiddleware(lambda request: self.client.get('/api/categories/'))
+        request = mock.Mock(method='GET', path='/api/categories/')
+        with self.assertLogs('shop.query_budget', 'WARNING') as logs:
+            middleware(request)
+        self.assertIn('GET /api/categories/ ran', logs.output[0])
+
+
+class ReplicaRoutingTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.admin = User.objects.create_superuser('admin', password='admin123')
+        cls.shop = Shop.objects.create(name='Shop')
+        cls.good = Good.objects.create(
+            name='Good', price=Decimal('5.00'), buy_price=Decimal('3.00'), stock_count=20, barcode='300',
+            category=Category.objects.create(name='Category'), shop=cls.shop
+        )
+        Sale.objects.create(good=cls.good, quantity=1, total_price=cls.good.price, shop=cls.shop, timestamp=timezone.now())
+
+    def setUp(self):
+        cache.clear()
+        self.client.force_login(self.admin)
+
+    def test_router(self):
+        router = ReplicaRouter()
+        self.assertIsNone(router.db_for_read(Sale))
+        with use_replica():
+            # No replica configured: everything stays on the primary
+            self.assertIsNone(router.db_for_read(Sale))
+            with mock.patch.object(routers, 'replica_configured', return_value=True):
+                self.assertEqual(router.db_for_read(Sale), REPLICA)
+                self.assertEqual(router.db_for_write(Sale), 'default')
+        self.assertFalse(router.allow_migrate(REPLICA, 'shop'))
+        self.assertTrue(router.allow_migrate('default', 'shop'))
+
+    def shop_reads(self, request):
+        """Models the request read from the shop app, with whether each read was routed to the replica"""
+        reads = []
+
+        def db_for_read(router, model, **hints):
+            if model._meta.app_label == 'shop':
+                reads.append((model.__name__, routers._reporting.get()))
+
+        with mock.patch.object(ReplicaRouter, 'db_for_read', autospec=True, side_effect=db_for_read):
+            response = request()
+            if response.streaming:
+                b''.join(response.streaming_content)
+        self.assertLess(response.status_code, 400)
+        return reads
+
+    def test_reporting_views_read_from_the_replica(self):
+        for url in ('/finance/', '/api/finance/summary/', '/api/finance/sales/', '/debts/',
+                    '/finance/export/csv/', '/finance/export/xlsx/'):
+            with self.subTest(url=url):
+                cache.clear()
+                reads = self.shop_reads(lambda: self.client.get(url, {'date_filter': 'month'}))
+                self.assertTrue(reads)
+                self.assertTrue(all(pinned for model, pinned in reads), reads)
+        # Streamed exports still read from the replica after the view returned
+        self.assertIn(('Sale', True), self.shop_reads(lambda: self.client.get('/finance/export/csv/')))
+
+    def test_expense_form_posts_to_the_primary(self):
+        self.client.force_login(User.objects.create_user('worker', password='worker123'))
+        reads = self.shop_reads(lambda: self.client.post('/finance/', {'expense_amount': '5.00', 'expense_shop': self.shop.id}))
+        self.assertEqual(Expense.objects.count(), 1)
+        self.assertTrue(reads)
+        self.assertFalse(any(pinned for model, pinned in reads), reads)
+
+    def test_generation_caches_read_from_the_primary(self):
+        # A lagging replica must not fill the caches keyed by the post-write generation
+        for url in ('/api/finance/cards/', '/api/finance/timeseries/', '/api/finance/leaderboard/',
+                    '/api/finance/comparison/', '/api/finance/shops/', '/api/finance/shifts/'):
+            with self.subTest(url=url):
+                cache.clear()
+                reads = self.shop_reads(lambda: self.client.get(url, {'date_filter': 'month'}))
+                self.assertTrue(reads)
+                self.assertFalse([model for model, pinned in reads if pinned and model != 'Shop'], reads)
+
+    def test_checkout_stays_on_the_primary(self):
+        reads = self.shop_reads(lambda: self.client.post('/api/sale/', {
+            'request_id': 'primary', 'shop_id': self.shop.id, 'items': [{'id': self.good.id, 'quantity': 1}],
+        }, content_type='application/json'))
+        self.assertTrue(reads)
+        self.assertFalse(any(pinned for model, pinned in reads), reads)
+
+
+class InventoryReportTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.admin = User.objects.create_superuser('admin', password='admin123')
+        cls.shop, other_shop = Shop.objects.create(name='Shop'), Shop.objects.create(name='Other')
+        category = Category.objects.create(name='Category')
+        cls.goods = [
+            Good.objects.create(
+                name=f'Good {i}', price=Decimal('10.00'), buy_price=Decimal('4.00'), stock_count=100,
+                barcode=f'50{i}', category=category, shop=shop
+            )
+            for i, shop in enumerate([cls.shop] * 5 + [other_shop])
+        ]
+        StockReceipt.objects.create(
+            good=cls.goods[0], quantity=30, unit_cost=Decimal('4.00'), shop=cls.shop, created_by=cls.admin
+        )
+
+        now = timezone.now()
+
+        def sale(good, quantity, when=now):
+            return Sale(
+                good=good, quantity=quantity, total_price=good.price * quantity, cost=good.buy_price * quantity,
+                shop=good.shop, timestamp=when
+            )
+        # Revenue 700, 150 + 50 on debt, 80, 20 (plus 500 before the window), 0; the other shop 10
+        Sale.objects.bulk_create([
+            sale(cls.goods[0], 70), sale(cls.goods[1], 15), sale(cls.goods[2], 8), sale(cls.goods[3], 2),
+            sale(cls.goods[3], 50, now - timedelta(days=40)), sale(cls.goods[5], 1),
+        ])
+        debt = Debt.objects.create(
+            customer_name='Customer', shop=cls.shop, total_amount=Decimal('50.00'), remaining_amount=Decimal('50.00'),
+            profit=Decimal('30.00'), items_quantity=5, due_date=timezone.localdate(), created_by=cls.admin
+        )
+        DebtItem.objects.create(debt=debt, good=cls.goods[1], quantity=5, unit_price=Decimal('10.00'), cost=Decimal('20.00'))
+        rebuild_summaries()
+
+    def setUp(self):
+        self.client.force_login(self.admin)
+
+    def test_report(self):
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(build_inventory_report(), len(self.goods))
+        # Goods, sales, receipts, then the rewrite: independent of the number of goods
+        self.assertLessEqual(len(queries), 8)
+
+        rows = {row.good_id: row for row in GoodStockSummary.objects.all()}
+        self.assertEqual([rows[good.id].abc_class for good in self.goods], ['A', 'A', 'B', 'C', 'C', 'A'])
+        best = rows[self.goods[0].id]
+        self.assertEqual((best.stock_count, best.quantity_sold, best.revenue, best.cost), (130, 70, 700, 280))
+        self.assertEqual(best.revenue_share, Decimal('0.7000'))
+        self.assertEqual(best.days_of_cover, Decimal('55.7'))  # 130 / (70 / 30)
+        self.assertEqual(best.turnover, Decimal('0.47'))  # 280 / ((130 + 170) / 2 x 4.00)
+        self.assertEqual(rows[self.goods[1].id].quantity_sold, 20)
+        self.assertEqual(rows[self.goods[3].id].quantity_sold, 2)
+        unsold = rows[self.goods[4].id]
+        self.assertEqual((unsold.days_of_cover, unsold.turnover, unsold.daily_velocity), (None, 0, 0))
+
+    def test_window_in_shop_time(self):
+        shop = self.goods[5].shop
+        shop.timezone = 'America/New_York'
+        shop.save()
+        today = timezone.localdate(timezone=shop.tzinfo)
+        receipt = StockReceipt.objects.create(
+            good=self.goods[5], quantity=30, unit_cost=Decimal('4.00'), shop=shop, created_by=self.admin
+        )
+        # Received a minute before the shop's local midnight: outside a one-day window
+        StockReceipt.objects.filter(id=receipt.id).update(
+            created_at=timezone.make_aware(datetime.combine(today, dt_time.min), shop.tzinfo) - timedelta(minutes=1)
+        )
+        DailyGoodSummary.objects.filter(good=self.goods[5]).update(date=today)
+        Good.objects.filter(id=self.goods[5].id).update(stock_count=0)
+
+        build_inventory_report(window_days=1)
+        row = GoodStockSummary.objects.get(good=self.goods[5])
+        self.assertEqual((row.computed_on, row.quantity_sold, row.cost), (today, 1, Decimal('4.00')))
+        # Sold out, so the 1 unit sold was in stock when the window started: 4.00 / ((0 + 1) / 2 x 4.00)
+        self.assertEqual(row.turnover, Decimal('2.00'))
+
+    def test_stock_value_matches_finance(self):
+        # Goods without receipts have no average cost yet: both reports value them at the buy price
+        build_inventory_report()
+        for shop_id in (self.shop.id, self.goods[5].shop_id):
+            with self.subTest(shop_id=shop_id):
+                inventory = GoodStockSummary.objects.filter(shop_id=shop_id).aggregate(total=Sum('stock_value'))
+                self.assertEqual(compute_report(ReportFilters(shop_id=shop_id))['stock_value'], inventory['total'])
+        self.assertEqual(
+            compute_report(ReportFilters(shop_id=self.goods[5].shop_id))['stock_value'],
+            self.goods[5].buy_price * Good.objects.get(id=self.goods[5].id).stock_count
+        )
+
+    def test_page(self):
+        build_inventory_report()
+        response = self.client.get('/inventory/', {'shop': self.shop.id, 'abc_class': 'A'})
+        self.assertEqual([row.good for row in response.context['rows']], self.goods[:2])  # Least cover first
+        self.assertEqual(dict(response.context['classes'])['C']['goods'], 2)
+
+        worker = User.objects.create_user('worker', password='worker123')
+        self.client.force_login(worker)
+        self.assertEqual(self.client.get('/inventory/').status_code, 302)
+
+
+class CustomerTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.admin = User.objects.create_superuser('admin', password='admin123')
+        cls.shop = Shop.objects.create(name='Shop')
+        cls.good = Good.objects.create(
+            name='Good', price=Decimal('5.00'), buy_price=Decimal('2.00'), stock_count=100, barcode='300',
+            category=Category.objects.create(name='Category'), shop=cls.shop
+        )
+
+    def setUp(self):
+        cache.clear()
+        self.client.force_login(self.admin)
+
+    def create(self, name, phone, quantity):
+        response = self.client.post('/api/debt/create/', {
+            'customer_name': name, 'customer_phone': phone, 'shop_id': self.shop.id, 'due_date': '2030-01-01',
+            'items': [{'id': self.good.id, 'quantity': quantity}],
+        }, content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        return Debt.objects.get(id=response.json()['debt_id'])
+
+    def post(self, path, data):
+        return self.client.post(path, data, content_type='application/json')
+
+    def balances(self):
+        return dict(Customer.objects.values_list('id', 'balance'))
+
+    def test_balance_follows_debts(self):
+        first = self.create('Əli  Məmmədov', '+994 50 123-45-67', 2)
+        second = self.create('əli məmmədov', '994501234567', 1)
+        third = self.create('Vəli', '', 1)
+        self.assertEqual(self.create(' vəli ', '', 1).customer_id, third.customer_id)
+        self.assertEqual(second.customer_id, first.customer_id)
+        self.assertEqual(Customer.objects.count(), 2)
+        customer = first.customer
+        self.assertEqual((customer.name, customer.phone, customer.balance), ('Əli Məmmədov', '994501234567', 15))
+
+        self.post('/api/debt/pay/', {'debt_id': first.id, 'amount': '4.00'})
+        self.post('/api/debt/cancel/', {'debt_id': second.id})
+        customer.refresh_from_db()
+        self.assertEqual(customer.balance, 6)
+        self.post('/api/debt/pay/', {'debt_id': first.id, 'amount': '6.00'})
+        # A cancelled debt cannot be cancelled again
+        self.assertEqual(self.post('/api/debt/cancel/', {'debt_id': second.id}).status_code, 400)
+        customer.refresh_from_db()
+        self.assertEqual(customer.balance, 0)
+
+        kept = self.balances()
+        rebuild_customer_balances()
+        self.assertEqual(self.balances(), kept)
+
+    def test_search(self):
+        self.create('Əli Məmmədov', '+994 50 123 45 67', 2)
+        self.create('Əliyev Rəşad', '', 1)
+        self.create('Vəli', '055 000 00 00', 1)
+        with query_budget(3):
+            by_name = self.client.get('/api/customers/search/', {'q': 'əli'}).json()['results']
+        self.assertEqual([(row['name'], row['balance']) for row in by_name], [('Əli Məmmədov', 10.0), ('Əliyev Rəşad', 5.0)])
+        by_phone = self.client.get('/api/customers/search/', {'q': '+994 50'}).json()['results']
+        self.assertEqual([row['phone'] for row in by_phone], ['994501234567'])
+        self.assertEqual(self.client.get('/api/customers/search/', {'q': ' '}).json()['results'], [])
+        # Prefixes are matched literally, LIKE wildcards included
+        self.assertEqual(self.client.get('/api/customers/search/', {'q': '%li'}).json()['results'], [])
+
+    def test_backfill(self):
+        for name, phone, amount in (('Əli', '050-111-22-33', 10), ('ƏLİ', '0501112233', 4), ('Vəli', '', 3), ('vəli', '', 2)):
+            Debt.objects.create(
+                customer_name=name, customer_phone=phone, shop=self.shop, total_amount=Decimal(amount),
+                due_date=timezone.localdate(), created_by=self.admin
+            )
+        Debt.objects.filter(customer_name='vəli').update(status='cancelled')
+        self.assertEqual(backfill_customers(), (2, 4))
+        self.assertEqual(
+            sorted(Customer.objects.values_list('phone', 'balance')), [('', 3), ('0501112233', 14)]
+        )
+        self.assertEqual(backfill_customers(), (0, 0))
@@ -0,0 +1,209 @@
+"""Revenue chart series for /api/finance/timeseries/.
+
+Buckets are summed in the database from the summary tables (already in local
+time): hourly rows for hour buckets and shifts, daily rows otherwise, with
+TruncWeek/TruncMonth for the coarser buckets. A barcode filter falls back to the
+raw tables, truncated in the report's time zone (ReportFilters.tz). Every bucket of the range
+is returned, so the arrays can be handed to a chart as they are.
+"""
+from datetime import datetime, timedelta
+
+from django.db.models import Sum, Count, Q, F, Min, DecimalField, ExpressionWrapper
+from django.db.models.functions import TruncDate, TruncHour, TruncWeek, TruncMonth
+from django.utils import timezone
+
+from .models import Shop, Category, Sale, Debt, DailyShopSummary, HourlyShopSummary
+from .rollups import SHIFTS, cached_until_write, summary_aggregates
+
+BUCKETS = ('hour', 'day', 'week', 'month')
+GROUPS = ('shop', 'category')
+METRICS = ('revenue', 'profit', 'items', 'transactions')
+
+# Hour buckets get big quickly; longer ranges should use day buckets
+MAX_HOURLY_DAYS = 62
+
+TIMESERIES_CACHE_TIMEOUT = 60 * 60
+
+DEBTS_LABEL = 'Borc Satışı'
+
+
+def _bucket_key(day, bucket):
+    if bucket == 'week':
+        return day - timedelta(days=day.weekday())
+    if bucket == 'month':
+        return day.replace(day=1)
+    return day
+
+
+def _bucket_keys(first, last, bucket):
+    """Every bucket between the two days, in order"""
+    if bucket == 'hour':
+        return [
+            (first + timedelta(days=offset), hour)
+            for offset in range((last - first).days + 1)
+            for hour in range(24)
+        ]
+    keys = []
+    day = _bucket_key(first, bucket)
+    while day <= last:
+        keys.append(day)
+        if bucket == 'month':
+            day = (day + timedelta(days=32)).replace(day=1)
+        else:
+            day += timedelta(days=7 if bucket == 'week' else 1)
+    return keys
+
+
+def _label(key, bucket):
+    if bucket == 'hour':
+        return f'{key[0].isoformat()} {key[1]:02d}:00'
+    if bucket == 'month':
+        return key.strftime('%Y-%m')
+    return key.isoformat()
+
+
+def _summary_rows(filters, first, last, bucket, group):
+    hourly = bucket == 'hour' or filters.shift
+    rows = (HourlyShopSummary if hourly else DailyShopSummary).objects.filter(date__gte=first, date__lte=last)
+    if filters.shop_id:
+        rows = rows.filter(shop_id=filters.shop_id)
+    if filters.shift:
+        first_hour, last_hour = SHIFTS[filters.shift]
+        rows = rows.filter(hour__gte=first_hour, hour__lt=last_hour)
+
+    if bucket == 'hour':
+        keys = ('date', 'hour')
+    elif bucket == 'day':
+        keys = ('date',)
+    else:
+        rows = rows.annotate(bucket=(TruncWeek if bucket == 'week' else TruncMonth)('date'))
+        keys = ('bucket',)
+
+    group_field = f'{group}_id'
+    rows = rows.values(group_field, *keys).annotate(**summary_aggregates(filters.category_id, expenses=False))
+    for row in rows:
+        key = (row['date'], row['hour']) if bucket == 'hour' else row[keys[0]]
+        if isinstance(key, datetime):  # Some backends truncate dates to datetimes
+            key = key.date()
+        yield key, row[group_field], {
+            'revenue': (row['sales_revenue'] or 0) + (row['debts_revenue'] or 0),
+            'profit': (row['sales_profit'] or 0) + (row['debts_profit'] or 0),
+            'items': (row['sales_quantity'] or 0) + (row['debts_quantity'] or 0),
+            'transactions': (row['sales_count'] or 0) + (row['debts_count'] or 0),
+        }
+
+
+def _raw_rows(filters, bucket, group):
+    """Barcode filter: sales and debts truncated in the database, in local time"""
+    tz = filters.tz
+
+    def truncate(field):
+        if bucket == 'hour':
+            return TruncHour(field, tzinfo=tz)
+        if bucket == 'day':
+            return TruncDate(field, tzinfo=tz)
+        return (TruncWeek if bucket == 'week' else TruncMonth)(field, tzinfo=tz)
+
+    def key(value):
+        if bucket == 'hour':
+            value = timezone.localtime(value, tz)
+            return (value.date(), value.hour)
+        return timezone.localtime(value, tz).date() if isinstance(value, datetime) else value
+
+    sales = (
+        Sale.objects.filter(filters.sales_q())
+        .annotate(bucket=truncate('timestamp'))
+        .values('bucket', 'shop_id' if group == 'shop' else 'good__category_id')
+        .annotate(
+            revenue=Sum('total_price'),
+            profit=Sum(ExpressionWrapper(
+                F('total_price') - F('cost'),
+                output_field=DecimalField()
+            )),
+            items=Sum('quantity'),
+            transactions=Count('id', filter=Q(voided_sale__isnull=True)),
+        )
+    )
+    for row in sales:
+        yield key(row['bucket']), row['shop_id' if group == 'shop' else 'good__category_id'], row
+
+    # Debts are never split by product, exactly like the report
+    debts = (
+        Debt.objects.filter(filters.debts_q())
+        .annotate(bucket=truncate('created_at'))
+        .values('bucket', 'shop_id')
+        .annotate(
+            revenue=Sum('total_amount'),
+            profit=Sum('profit'),
+            items=Sum('items_quantity'),
+            transactions=Count('id'),
+        )
+    )
+    for row in debts:
+        yield key(row['bucket']), row['shop_id'] if group == 'shop' else None, row
+
+
+def _day_range(filters):
+    days = filters.expense_days
+    if days:
+        return days
+    # No date restriction: from the first summarized day
+    first = DailyShopSummary.objects.aggregate(first=Min('date'))['first'] or filters.today
+    return first, filters.today
+
+
+def timeseries(filters, bucket='day', group='shop'):
+    """Dense per-group arrays of every metric for the buckets of the filtered period.
+
+    From the summaries, time-of-day windows are widened to the whole days they touch. Raises
+    ValueError for an unknown bucket/group or an hourly range that is too long.
+    """
+    if bucket not in BUCKETS or group not in GROUPS:
+        raise ValueError('bucket')
+    first, last = _day_range(filters)
+    if bucket == 'hour' and (last - first).days >= MAX_HOURLY_DAYS:
+        raise ValueError('range')
+
+    return cached_until_write(
+        filters.cache_key(f'timeseries:{bucket}:{group}'),
+        lambda: _compute(filters, first, last, bucket, group),
+        TIMESERIES_CACHE_TIMEOUT
+    )
+
+
+def _compute(filters, first, last, bucket, group):
+    keys = _bucket_keys(first, last, bucket)
+    positions = {bucket_key: index for index, bucket_key in enumerate(keys)}
+    rows = _raw_rows(filters, bucket, group) if filters.barcode else _summary_rows(filters, first, last, bucket, group)
+
+    series = {}
+    for bucket_key, group_id, values in rows:
+        index = positions.get(bucket_key)
+        if index is None:
+            continue
+        if group_id not in series:
+            series[group_id] = {metric: [0] * len(keys) for metric in METRICS}
+        for metric in METRICS:
+            series[group_id][metric][index] += values[metric] or 0
+
+    model = Shop if group == 'shop' else Category
+    names = dict(model.objects.filter(id__in=[group_id for group_id in series if group_id]).values_list('id', 'name'))
+    return {
+        'bucket': bucket,
+        'group': group,
+        'labels': [_label(bucket_key, bucket) for bucket_key in keys],
+        'series': sorted(
+            (
+                {
+                    'id': group_id,
+                    'name': names.get(group_id, DEBTS_LABEL),
+                    'revenue': [round(float(value), 2) for value in metrics['revenue']],
+                    'profit': [round(float(value), 2) for value in metrics['profit']],
+                    'items': metrics['items'],
+                    'transactions': metrics['transactions'],
+                }
+                for group_id, metrics in series.items()
+            ),
+            key=lambda item: item['name']
+        ),
+    }
@@ -19,16 +19,32 @@ urlpatterns = [
     path('debts/', views.debt_list, name='debt_list'),
     path('worker/open-pack/', views.worker_open_pack, name='worker_open_pack'),
     path('stock-receipt/', views.stock_receipt, name='stock_receipt'),
+    path('inventory/', views.inventory_report, name='inventory_report'),
     
     # API endpoints for sales
     path('api/search/', views.search_goods, name='search_goods'),
     path('api/scan/', views.scan_barcode, name='scan_barcode'),
     path('api/sale/', views.process_sale, name='process_sale'),
+    path('api/sale/void/', views.void_sale, name='void_sale'),
+    
+    # API endpoints for the finance page sections
+    path('api/finance/summary/', views.finance_summary_api, name='finance_summary_api'),
+    path('api/finance/cards/', views.finance_cards_api, name='finance_cards_api'),
+    path('api/finance/sales/', views.finance_sales_api, name='finance_sales_api'),
+    path('api/finance/expenses/', views.finance_expenses_api, name='finance_expenses_api'),
+    path('api/finance/comparison/', views.finance_comparison_api, name='finance_comparison_api'),
+    path('api/finance/timeseries/', views.finance_timeseries_api, name='finance_timeseries_api'),
+    path('api/finance/leaderboard/', views.finance_leaderboard_api, name='finance_leaderboard_api'),
+    path('api/finance/shifts/', views.finance_shifts_api, name='finance_shifts_api'),
+    path('api/finance/shops/', views.finance_shops_api, name='finance_shops_api'),
+    path('finance/export/csv/', views.export_sales_csv, name='export_sales_csv'),
+    path('finance/export/xlsx/', views.export_finance_xlsx, name='export_finance_xlsx'),
     
     # API endpoints for debt management
     path('api/debt/create/', views.create_debt, name='create_debt'),
     path('api/debt/pay/', views.pay_debt, name='pay_debt'),
     path('api/debt/cancel/', views.cancel_debt, name='cancel_debt'),
+    path('api/customers/search/', views.search_customers_api, name='search_customers_api'),
     
     # API endpoints for pack opening
     path('api/open-pack/', views.api_open_pack, name='api_open_pack'),
@@ -1,22 +1,35 @@
 from django.shortcuts import render, get_object_or_404 ,redirect  
-from django.http import JsonResponse
+from django.http import JsonResponse, StreamingHttpResponse
 from django.views.decorators.http import require_http_methods
-from django.db.models import Sum, Count, Avg, Q ,ExpressionWrapper ,F ,FloatField
+from django.db.models import Sum, Count, Q ,F
 from django.contrib import messages
 from decimal import Decimal
 import json
 import uuid
+from collections import defaultdict
 from django.core.cache import cache
 from django.utils import timezone
-from datetime import datetime, time as dt_time ,timedelta
+from datetime import datetime
 import logging
-import pytz
 from django.contrib.auth.decorators import login_required
 # Add these missing imports
-from django.db import connection ,transaction
+from django.db import connection ,transaction, IntegrityError
 from django.contrib.auth.models import User
 from django.conf import settings
-from .models import Shop, Category, Good, Sale, Expense ,Debt, DebtItem , StockReceipt
+from .models import Shop, Category, Good, Sale, Expense ,Debt, DebtItem , StockReceipt, GoodStockSummary, Customer
+from .rollups import record_sales, record_debt, record_expense
+from .costing import consume, return_to_stock, void_cost
+from .finance import ReportFilters, cached_section, summary_cards, expense_list, compare_periods
+from .history import history_page
+from .shifts import shift_report
+from .shops import shop_matrix
+from .debts import debt_page, debt_stats, search_customers
+from .routers import reporting_view
+from .timeseries import timeseries
+from .leaderboard import leaderboard
+from .exports import (
+    EXPENSE_EXPORT_COLUMNS, sales_export_rows, queryset_rows, csv_lines, xlsx_response
+)
 
 logger = logging.getLogger(__name__)
 
@@ -35,7 +48,7 @@ def search_goods(request):
             Q(name__icontains=query) | Q(barcode__icontains=query),
             shop_id=shop_id,
             stock_count__gt=0  # ← KEEP THIS for sales
-        )[:10]
+        ).select_related('category')[:10]
         
         results = []
         for good in goods:
@@ -139,16 +152,20 @@ def process_sale(request):
     try:
         shop = get_object_or_404(Shop, id=shop_id)
         current_time = timezone.now()
+        # Attribute the sale to the logged-in cashier for shift analytics
+        worker = request.user if request.user.is_authenticated else None
         
         # Use a transaction to ensure atomicity
         with transaction.atomic():
             sales_to_create = []
             goods_to_update = []
             
-            # Validate all items first WITH SELECT FOR UPDATE to lock rows
+            # Validate all items first WITH SELECT FOR UPDATE to lock rows (one query for the whole cart)
+            goods = Good.objects.select_for_update().filter(shop=shop).in_bulk([item['id'] for item in items])
             for item in items:
-                # Use select_for_update() to lock the goods row
-                good = Good.objects.select_for_update().get(id=item['id'], shop=shop)
+                good = goods.get(int(item['id']))
+                if good is None:
+                    raise Good.DoesNotExist('Good matching query does not exist.')
                 quantity = int(item['quantity'])
                 
                 if good.stock_count < quantity:
@@ -162,19 +179,26 @@ def process_sale(request):
                     quantity=quantity,
                     total_price=good.price * quantity,
                     shop=shop,
-                    timestamp=current_time
+                    timestamp=current_time,
+                    transaction_id=request_id,
+                    worker=worker
                 ))
                 
                 # Update stock count
                 good.stock_count -= quantity
                 goods_to_update.append(good)
             
+            # Cost of goods sold from the open cost layers
+            costs = consume([(sale.good, sale.quantity) for sale in sales_to_create])
+            for sale, cost in zip(sales_to_create, costs):
+                sale.cost = cost
+
             # Bulk create all sales
-            Sale.objects.bulk_create(sales_to_create)
+            created_sales = Sale.objects.bulk_create(sales_to_create)
+            record_sales(created_sales)
             
             # Bulk update all goods
-            for good in goods_to_update:
-                good.save()
+            Good.objects.bulk_update(set(goods_to_update), ['stock_count'])
             
             # Mark request as processed (store for 30 seconds)
             cache.set(cache_key, True, timeout=30)
@@ -182,28 +206,165 @@ def process_sale(request):
         return JsonResponse({
             'success': True, 
             'message': 'Sale completed successfully',
-            'request_id': request_id  # Return the request ID
+            'request_id': request_id,  # Return the request ID
+            'sale_ids': [sale.id for sale in created_sales]  # Needed to void single lines
         })
         
     except Exception as e:
         logger.error(f"Error processing sale: {str(e)}")
         return JsonResponse({'error': str(e)}, status=500)
 
+
 @login_required
+@require_http_methods(["POST"])
+def void_sale(request):
+    """Reverse a whole sale transaction or selected lines.
+
+    History is never deleted: every reversed line gets a compensating Sale row
+    with negative quantity/total_price pointing at the original via voided_sale,
+    so all Sum() based reports net out automatically.
+    """
+    try:
+        data = json.loads(request.body)
+    except json.JSONDecodeError:
+        return JsonResponse({'error': 'Invalid JSON data'}, status=400)
+
+    transaction_id = data.get('transaction_id')
+    lines = data.get('lines', [])  # [{'sale_id': 1, 'quantity': 2}, ...]
+    # Sent by the till once per void and repeated on retries, like the sale request_id
+    void_id = data.get('request_id')
+
+    if not transaction_id and not lines:
+        return JsonResponse({'error': 'transaction_id or lines are required'}, status=400)
+    if not void_id:
+        return JsonResponse({'error': 'request_id is required'}, status=400)
+
+    try:
+        # quantity defaults to what is left of the line
+        requested = {
+            int(line['sale_id']): None if line.get('quantity') is None else int(line['quantity'])
+            for line in lines
+        }
+    except (KeyError, TypeError, ValueError):
+        return JsonResponse({'error': 'Invalid lines data'}, status=400)
+    if any(quantity is not None and quantity <= 0 for quantity in requested.values()):
+        return JsonResponse({'error': 'Void quantity must be positive'}, status=400)
+
+    # Admins void in every shop, cashiers only in their own
+    if request.user.is_staff or request.user.is_superuser:
+        shop_id = None
+    elif hasattr(request.user, 'worker'):
+        shop_id = request.user.worker.shop_id
+    else:
+        return JsonResponse({'error': 'Bu əməliyyatı yerinə yetirmək hüququnuz yoxdur'}, status=403)
+
+    duplicate = JsonResponse({
+        'success': True,
+        'message': 'Void already processed (duplicate request ignored)',
+        'request_id': void_id
+    })
+    try:
+        with transaction.atomic():
+            # A retried void request finds its own compensating rows
+            if Sale.objects.filter(transaction_id=void_id, voided_sale__isnull=False).exists():
+                return duplicate
+
+            originals = Sale.objects.select_for_update(of=('self',)).select_related('good').filter(
+                voided_sale__isnull=True
+            )
+            if shop_id is not None:
+                originals = originals.filter(shop_id=shop_id)
+            if transaction_id:
+                originals = originals.filter(transaction_id=transaction_id)
+            if requested:
+                originals = originals.filter(id__in=requested)
+            originals = list(originals.order_by('id'))
+
+            if not originals or (requested and len(originals) != len(requested)):
+                return JsonResponse({'error': 'Sale not found'}, status=404)
+
+            # Quantities/amounts already reversed by earlier voids, one query
+            already_voided = {
+                row['voided_sale']: row
+                for row in Sale.objects.filter(voided_sale__in=originals)
+                .values('voided_sale')
+                .annotate(quantity=Sum('quantity'), total=Sum('total_price'), cost=Sum('cost'))
+            }
+
+            now = timezone.now()
+            compensating = []
+            restock = {}
+            returned = []
+            for sale in originals:
+                previous = already_voided.get(sale.id, {'quantity': 0, 'total': Decimal('0.00'), 'cost': Decimal('0.00')})
+                remaining = sale.quantity + previous['quantity']  # previous quantity is negative
+
+                quantity = requested.get(sale.id)
+                if quantity is None:
+                    quantity = remaining
+                if quantity <= 0 or quantity > remaining:
+                    if transaction_id and not requested and remaining == 0:
+                        continue  # Whole transaction void retried: line already reversed
+                    return JsonResponse({
+                        'error': f'Invalid void quantity for {sale.good.name}. Remaining: {remaining}'
+                    }, status=400)
+
+                if quantity == remaining:
+                    # Last part of the line: reverse exactly what is left so it nets to zero
+                    refund = sale.total_price + previous['total']
+                else:
+                    refund = (sale.total_price * quantity / sale.quantity).quantize(Decimal('0.01'))
+                cost = void_cost(sale, quantity, previous['quantity'], previous['cost'])
+                returned.append((sale.good_id, quantity, cost))
+
+                compensating.append(Sale(
+                    good=sale.good,
+                    quantity=-quantity,
+                    total_price=-refund,
+                    cost=-cost,
+                    shop_id=sale.shop_id,
+                    timestamp=now,
+                    transaction_id=void_id,
+                    voided_sale=sale,
+                    worker_id=sale.worker_id
+                ))
+                restock[sale.good_id] = restock.get(sale.good_id, 0) + quantity
+
+            if not compensating:
+                return JsonResponse({
+                    'success': True,
+                    'message': 'Sale already voided',
+                    'request_id': void_id
+                })
+
+            Sale.objects.bulk_create(compensating)
+            record_sales(compensating)
+            return_to_stock(returned, now)
+
+            # Restore stock for every good in a single UPDATE
+            Good.add_to_stock(restock)
+
+        return JsonResponse({
+            'success': True,
+            'message': 'Sale voided successfully',
+            'request_id': void_id,
+            'voided_lines': len(compensating),
+            'refund_total': float(-sum(sale.total_price for sale in compensating))
+        })
+
+    except IntegrityError:
+        # A concurrent retry of the same void wrote its rows first (unique_void_line)
+        return duplicate
+    except Exception as e:
+        logger.error(f"Error voiding sale: {str(e)}")
+        return JsonResponse({'error': str(e)}, status=500)
+
+@login_required
+@reporting_view
 def finance_dashboard(request):
     shops = Shop.objects.all()
     categories = Category.objects.all()
 
-    shop_id = request.GET.get('shop')
-    category_id = request.GET.get('category')
-    barcode = request.GET.get('barcode')
-    date_filter = request.GET.get('date_filter', 'today')
-    start_date = request.GET.get('start_date')
-    end_date = request.GET.get('end_date')
-    start_time = request.GET.get('start_time')
-    end_time = request.GET.get('end_time')
-    worker_shift = request.GET.get('worker_shift')
-
     # Handle expense submission
     if request.method == 'POST' and 'expense_amount' in request.POST:
         if not request.user.is_superuser:  # Only workers can add expenses
@@ -213,248 +374,237 @@ def finance_dashboard(request):
                 expense_shop_id = request.POST.get('expense_shop')
                 
                 if expense_amount > 0 and expense_shop_id:
-                    Expense.objects.create(
-                        shop_id=expense_shop_id,
-                        amount=expense_amount,
-                        description=expense_description,
-                        created_by=request.user,
-                        expense_date=timezone.now().date()
-                    )
+                    with transaction.atomic():
+                        expense = Expense.objects.create(
+                            shop_id=expense_shop_id,
+                            amount=expense_amount,
+                            description=expense_description,
+                            created_by=request.user,
+                            expense_date=timezone.localdate(timezone=Shop.timezone_of(expense_shop_id))
+                        )
+                        record_expense(expense)
                     messages.success(request, 'Xərc uğurla əlavə edildi!')
             except (ValueError, Decimal.InvalidOperation):
                 messages.error(request, 'Xərc məbləği düzgün deyil!')
 
-    # Get regular sales
-    sales = Sale.objects.select_related('good', 'shop', 'good__category').all()
+    # Only the page shell is rendered here; the sections are loaded from /api/finance/
+    filters = ReportFilters.from_request(request)
 
-    if shop_id:
-        sales = sales.filter(shop_id=shop_id)
-    if category_id:
-        sales = sales.filter(good__category_id=category_id)
-    if barcode:
-        sales = sales.filter(good__barcode__icontains=barcode)
-
-    # Get ALL debts (including paid ones) for revenue calculation
-    # But only pending debts for current operations
-    all_debts = Debt.objects.select_related('shop').all()
-    pending_debts = all_debts.filter(status='pending')
-    
-    if shop_id:
-        all_debts = all_debts.filter(shop_id=shop_id)
-        pending_debts = pending_debts.filter(shop_id=shop_id)
-
-    # Use Django's timezone system instead of pytz
-    now = timezone.now()
-    azerbaijan_offset = timedelta(hours=4)
-    now_baku = now + azerbaijan_offset
-    today_baku = now_baku.date()
-
-    # Date filter for both sales and debts
-    if date_filter == 'today':
-        sales = sales.filter(timestamp__date=today_baku)
-        all_debts = all_debts.filter(created_at__date=today_baku)
-        pending_debts = pending_debts.filter(created_at__date=today_baku)
-    elif date_filter == 'week':
-        start_of_week = now_baku - timedelta(days=now_baku.weekday())
-        start_of_week_utc = start_of_week - azerbaijan_offset
-        sales = sales.filter(timestamp__gte=start_of_week_utc)
-        all_debts = all_debts.filter(created_at__gte=start_of_week_utc)
-        pending_debts = pending_debts.filter(created_at__gte=start_of_week_utc)
-    elif date_filter == 'month':
-        sales = sales.filter(
-            timestamp__year=now_baku.year,
-            timestamp__month=now_baku.month
-        )
-        all_debts = all_debts.filter(
-            created_at__year=now_baku.year,
-            created_at__month=now_baku.month
-        )
-        pending_debts = pending_debts.filter(
-            created_at__year=now_baku.year,
-            created_at__month=now_baku.month
-        )
-    elif date_filter == 'custom' and start_date and end_date:
-        try:
-            start_date_obj = datetime.strptime(start_date, '%Y-%m-%d').date()
-            end_date_obj = datetime.strptime(end_date, '%Y-%m-%d').date()
-            
-            if not start_time and not end_time:
-                sales = sales.filter(timestamp__date__gte=start_date_obj, timestamp__date__lte=end_date_obj)
-                all_debts = all_debts.filter(created_at__date__gte=start_date_obj, created_at__date__lte=end_date_obj)
-                pending_debts = pending_debts.filter(created_at__date__gte=start_date_obj, created_at__date__lte=end_date_obj)
-            else:
-                if start_time:
-                    start_dt = datetime.combine(start_date_obj, datetime.strptime(start_time, '%H:%M').time())
-                else:
-                    start_dt = datetime.combine(start_date_obj, dt_time.min)
-                
-                if end_time:
-                    end_dt = datetime.combine(end_date_obj, datetime.strptime(end_time, '%H:%M').time())
-                else:
-                    end_dt = datetime.combine(end_date_obj, dt_time.max)
-                
-                start_dt = timezone.make_aware(start_dt)
-                end_dt = timezone.make_aware(end_dt)
-                
-                sales = sales.filter(timestamp__gte=start_dt, timestamp__lte=end_dt)
-                all_debts = all_debts.filter(created_at__gte=start_dt, created_at__lte=end_dt)
-                pending_debts = pending_debts.filter(created_at__gte=start_dt, created_at__lte=end_dt)
-            
-        except Exception as e:
-            import traceback
-            traceback.print_exc()
+    context = {
+        'shops': shops,
+        'categories': categories,
+        'filters': filters.as_dict(),
+        'api_query': request.GET.urlencode(),
+        'current_baku_time': timezone.localtime().strftime('%Y-%m-%d %H:%M:%S'),
+    }
 
-    # Calculate expenses for the filtered period
-    expenses = Expense.objects.all()
-    if date_filter == 'today':
-        expenses = expenses.filter(expense_date=today_baku)
-    elif date_filter == 'week':
-        start_of_week_baku = now_baku - timedelta(days=now_baku.weekday())
-        expenses = expenses.filter(expense_date__gte=start_of_week_baku.date())
-    elif date_filter == 'month':
-        expenses = expenses.filter(expense_date__year=now_baku.year, expense_date__month=now_baku.month)
-    elif date_filter == 'custom' and start_date and end_date:
-        try:
-            start_date_obj = datetime.strptime(start_date, '%Y-%m-%d').date()
-            end_date_obj = datetime.strptime(end_date, '%Y-%m-%d').date()
-            expenses = expenses.filter(expense_date__gte=start_date_obj, expense_date__lte=end_date_obj)
-        except:
-            pass
+    return render(request, 'shop/finance.html', context)
 
-    if shop_id:
-        expenses = expenses.filter(shop_id=shop_id)
 
-    total_expenses = expenses.aggregate(total=Sum('amount'))['total'] or Decimal('0.00')
+# Metrics the finance page shows to superusers only
+PROFIT_FIELDS = ('total_profit', 'net_profit', 'stock_value')
 
-    # Calculate revenue from both sales and ALL debts (including paid ones)
-    sales_revenue = sales.aggregate(total=Sum('total_price'))['total'] or Decimal('0.00')
-    debts_revenue = all_debts.aggregate(total=Sum('total_amount'))['total'] or Decimal('0.00')
-    total_revenue = sales_revenue + debts_revenue
 
-    # Calculate items sold (from both sales and ALL debts)
-    sales_items_sold = sales.aggregate(total=Sum('quantity'))['total'] or 0
-    debts_items_sold = DebtItem.objects.filter(debt__in=all_debts).aggregate(total=Sum('quantity'))['total'] or 0
-    items_sold = sales_items_sold + debts_items_sold
+def _finance_section_response(request, section):
+    filters = ReportFilters.from_request(request)
+    entry = cached_section(filters, section)
+    data = entry['data']
+    if section == 'summary' and not request.user.is_superuser:
+        data = {field: value for field, value in data.items() if field not in PROFIT_FIELDS}
+    return JsonResponse({
+        section: data,
+        'computed_at': timezone.localtime(entry['computed_at']).strftime('%H:%M:%S'),
+        'age_seconds': int((timezone.now() - entry['computed_at']).total_seconds()),
+    })
 
-    # Calculate number of transactions (sales + ALL debts)
-    num_sales = sales.count() + all_debts.count()
 
-    # Calculate average sale
-    avg_sale = total_revenue / num_sales if num_sales > 0 else Decimal('0.00')
+@login_required
+@require_http_methods(["GET"])
+@reporting_view
+def finance_summary_api(request):
+    return _finance_section_response(request, 'summary')
 
-    # Calculate total profit (from both sales and ALL debts)
-    sales_profit_expr = ExpressionWrapper(
-        (F('good__price') - F('good__buy_price')) * F('quantity'),
-        output_field=FloatField()
-    )
-    sales_profit = sales.aggregate(total=Sum(sales_profit_expr))['total'] or 0
-
-    # For ALL debts, profit is (selling price - buy price) * quantity
-    debt_items = DebtItem.objects.filter(debt__in=all_debts).select_related('good')
-    debts_profit = Decimal('0.00')
-    for debt_item in debt_items:
-        item_profit = (debt_item.unit_price - debt_item.good.buy_price) * debt_item.quantity
-        debts_profit += item_profit
-
-    total_profit = Decimal(str(sales_profit)) + debts_profit
-
-    # Calculate net profit (profit - expenses)
-    net_profit = total_profit - total_expenses
-
-    # Today / week / month revenue with Azerbaijan time adjustment (including ALL debts)
-    today_sales = Sale.objects.filter(timestamp__date=today_baku)
-    today_all_debts = Debt.objects.filter(created_at__date=today_baku)
-    today_revenue = (today_sales.aggregate(total=Sum('total_price'))['total'] or Decimal('0.00')) + \
-                   (today_all_debts.aggregate(total=Sum('total_amount'))['total'] or Decimal('0.00'))
-
-    start_of_week_baku = now_baku - timedelta(days=now_baku.weekday())
-    start_of_week_utc = start_of_week_baku - azerbaijan_offset
-    week_sales = Sale.objects.filter(timestamp__gte=start_of_week_utc)
-    week_all_debts = Debt.objects.filter(created_at__gte=start_of_week_utc)
-    week_revenue = (week_sales.aggregate(total=Sum('total_price'))['total'] or Decimal('0.00')) + \
-                  (week_all_debts.aggregate(total=Sum('total_amount'))['total'] or Decimal('0.00'))
-
-    month_sales = Sale.objects.filter(
-        timestamp__year=now_baku.year,
-        timestamp__month=now_baku.month
-    )
-    month_all_debts = Debt.objects.filter(
-        created_at__year=now_baku.year,
-        created_at__month=now_baku.month
+
+@login_required
+@require_http_methods(["GET"])
+@reporting_view
+def finance_cards_api(request):
+    cards = summary_cards(ReportFilters.from_request(request))
+    if not request.user.is_superuser:
+        # Workers only see today's card on the page
+        cards = {'today_revenue': cards['today_revenue']}
+    return JsonResponse({'cards': cards})
+
+
+@login_required
+@require_http_methods(["GET"])
+@reporting_view
+def finance_sales_api(request):
+    """Sales/debt history; the first page is cached, ?cursor= reads the following ones"""
+    cursor = request.GET.get('cursor')
+    if not cursor:
+        return _finance_section_response(request, 'sales')
+    try:
+        page = history_page(ReportFilters.from_request(request), cursor)
+    except ValueError:
+        return JsonResponse({'error': 'Yanlış səhifə göstəricisi'}, status=400)
+    return JsonResponse({'sales': page})
+
+
+@login_required
+@require_http_methods(["GET"])
+@reporting_view
+def finance_expenses_api(request):
+    if not request.user.is_superuser:
+        return JsonResponse({'error': 'Bu məlumata giriş hüququnuz yoxdur'}, status=403)
+    return _finance_section_response(request, 'expenses')
+
+
+@login_required
+@require_http_methods(["GET"])
+@reporting_view
+def finance_shifts_api(request):
+    """Revenue, items, transactions and average basket per cashier and shift"""
+    if not request.user.is_superuser:
+        return JsonResponse({'error': 'Bu məlumata giriş hüququnuz yoxdur'}, status=403)
+    return JsonResponse({'rows': shift_report(ReportFilters.from_request(request))})
+
+
+@login_required
+@require_http_methods(["GET"])
+@reporting_view
+def finance_shops_api(request):
+    """All shops side by side: revenue, profit, items, transactions, expenses and pending debts"""
+    if not request.user.is_superuser:
+        return JsonResponse({'error': 'Bu məlumata giriş hüququnuz yoxdur'}, status=403)
+    return JsonResponse({'rows': shop_matrix(ReportFilters.from_request(request))})
+
+
+@login_required
+@require_http_methods(["GET"])
+@reporting_view
+def finance_comparison_api(request):
+    """Metrics against yesterday, last week, last month and the same weekday last week"""
+    comparisons = compare_periods(ReportFilters.from_request(request))
+    if not request.user.is_superuser:
+        comparisons = {
+            name: {metric: value for metric, value in pair.items() if metric not in PROFIT_FIELDS}
+            for name, pair in comparisons.items()
+        }
+    return JsonResponse({'comparisons': comparisons})
+
+
+@login_required
+@require_http_methods(["GET"])
+@reporting_view
+def finance_timeseries_api(request):
+    """Chart series: ?bucket=hour|day|week|month&group=shop|category plus the finance filters"""
+    filters = ReportFilters.from_request(request)
+    try:
+        data = timeseries(filters, request.GET.get('bucket', 'day'), request.GET.get('group', 'shop'))
+    except ValueError as e:
+        if str(e) == 'range':
+            return JsonResponse({'error': 'Saatlıq qrafik üçün tarix aralığı çox uzundur'}, status=400)
+        return JsonResponse({'error': 'Yanlış qruplaşdırma'}, status=400)
+    if not request.user.is_superuser:
+        data = dict(data, series=[
+            {key: value for key, value in item.items() if key != 'profit'} for item in data['series']
+        ])
+    return JsonResponse(data)
+
+
+@login_required
+@require_http_methods(["GET"])
+@reporting_view
+def finance_leaderboard_api(request):
+    """Best/worst sellers: ?metric=quantity|revenue|profit&level=good|category&order=top|worst&limit=10"""
+    filters = ReportFilters.from_request(request)
+    metric = request.GET.get('metric', 'quantity')
+    if metric == 'profit' and not request.user.is_superuser:
+        return JsonResponse({'error': 'Bu məlumata giriş hüququnuz yoxdur'}, status=403)
+    try:
+        rows = leaderboard(
+            filters, metric, request.GET.get('level', 'good'),
+            worst=request.GET.get('order') == 'worst', limit=request.GET.get('limit', 10)
+        )
+    except ValueError:
+        return JsonResponse({'error': 'Yanlış sıralama parametrləri'}, status=400)
+    if not request.user.is_superuser:
+        rows = [{key: value for key, value in row.items() if key != 'profit'} for row in rows]
+    return JsonResponse({'metric': metric, 'rows': rows})
+
+
+@login_required
+@require_http_methods(["GET"])
+@reporting_view
+def export_sales_csv(request):
+    """Sales and debt items of the finance filters as a streamed CSV file"""
+    filters = ReportFilters.from_request(request)
+    response = StreamingHttpResponse(
+        csv_lines(sales_export_rows(filters)),
+        content_type='text/csv; charset=utf-8'
     )
-    month_revenue = (month_sales.aggregate(total=Sum('total_price'))['total'] or Decimal('0.00')) + \
-                   (month_all_debts.aggregate(total=Sum('total_amount'))['total'] or Decimal('0.00'))
+    response['Content-Disposition'] = f'attachment; filename="satislar_{filters.today}.csv"'
+    return response
 
-    # Combine sales and pending debts for display (only show pending debts in the list)
-    combined_sales = []
-    
-    # Add regular sales
-    for sale in sales[:25]:  # Show first 25 sales
-        combined_sales.append({
-            'type': 'sale',
-            'timestamp': sale.timestamp,
-            'good_name': sale.good.name,
-            'category': sale.good.category.name,
-            'shop_name': sale.shop.name,
-            'quantity': sale.quantity,
-            'total_price': sale.total_price,
-            'is_debt': False
-        })
-    
-    # Add pending debts (limited to keep total around 50 items)
-    debt_count = min(25, pending_debts.count())
-    for debt in pending_debts[:debt_count]:
-        combined_sales.append({
-            'type': 'debt',
-            'timestamp': debt.created_at,
-            'good_name': f"BORC: {debt.customer_name}",
-            'category': 'Borc Satışı',
-            'shop_name': debt.shop.name,
-            'quantity': 1,  # Representing one debt transaction
-            'total_price': debt.total_amount,
-            'is_debt': True,
-            'customer_name': debt.customer_name
-        })
-    
-    # Sort by timestamp and take first 50
-    combined_sales.sort(key=lambda x: x['timestamp'], reverse=True)
-    combined_sales = combined_sales[:50]
 
-    context = {
-        'shops': shops,
-        'categories': categories,
-        'sales': combined_sales,
-        'expenses': expenses,
-        'total_revenue': total_revenue,
-        'sales_revenue': sales_revenue,
-        'debts_revenue': debts_revenue,
-        'total_profit': total_profit,
-        'net_profit': net_profit,
-        'total_expenses': total_expenses,
-        'items_sold': items_sold,
-        'num_sales': num_sales,
-        'avg_sale': avg_sale,
-        'today_revenue': today_revenue,
-        'week_revenue': week_revenue,
-        'month_revenue': month_revenue,
-        'filters': {
-            'shop': shop_id,
-            'category': category_id,
-            'barcode': barcode,
-            'date_filter': date_filter,
-            'start_date': start_date,
-            'end_date': end_date,
-            'start_time': start_time,
-            'end_time': end_time,
-            'worker_shift': worker_shift,
-        },
-        'current_baku_time': now_baku.strftime('%Y-%m-%d %H:%M:%S'),
-        'sales_count': sales.count(),
-        'debts_count': all_debts.count(),  # Count of ALL debts for revenue breakdown
-        'pending_debts_count': pending_debts.count()  # Count of pending debts for operations
+@login_required
+@require_http_methods(["GET"])
+@reporting_view
+def export_finance_xlsx(request):
+    """Sales history (default) or expenses of the finance filters as a streamed XLSX file"""
+    filters = ReportFilters.from_request(request)
+    if request.GET.get('kind') == 'expenses':
+        if not request.user.is_superuser:
+            return JsonResponse({'error': 'Bu məlumata giriş hüququnuz yoxdur'}, status=403)
+        rows = queryset_rows(expense_list(filters), EXPENSE_EXPORT_COLUMNS)
+        return xlsx_response(rows, f'xercler_{filters.today}.xlsx', 'Xərclər')
+    return xlsx_response(sales_export_rows(filters), f'satislar_{filters.today}.xlsx', 'Satışlar')
+
+# Rows shown on the inventory page; the class totals always cover the whole selection
+INVENTORY_PAGE_ROWS = 500
+
+
+@login_required
+@require_http_methods(["GET"])
+@reporting_view
+def inventory_report(request):
+    """Stock analytics from the nightly GoodStockSummary table: days of cover, turnover, ABC class"""
+    if not request.user.is_superuser:
+        messages.error(request, "Bu səhifəyə giriş hüququnuz yoxdur")
+        return redirect('shop:worker')
+
+    shop_id = request.GET.get('shop')
+    abc_class = request.GET.get('abc_class')
+    summaries = GoodStockSummary.objects.all()
+    if shop_id:
+        summaries = summaries.filter(shop_id=shop_id)
+
+    classes = {
+        row['abc_class']: row
+        for row in summaries.values('abc_class').annotate(
+            goods=Count('id'), revenue=Sum('revenue'), stock_value=Sum('stock_value')
+        ).order_by()
     }
+    if abc_class:
+        summaries = summaries.filter(abc_class=abc_class)
+    # Least covered first; goods that did not sell have no cover and come last
+    rows = summaries.select_related('good', 'shop').order_by(
+        F('days_of_cover').asc(nulls_last=True), '-revenue'
+    )[:INVENTORY_PAGE_ROWS]
 
-    return render(request, 'shop/finance.html', context)
+    context = {
+        'rows': rows,
+        'classes': [
+            (code, classes.get(code, {'goods': 0, 'revenue': 0, 'stock_value': 0}))
+            for code, label in GoodStockSummary.ABC_CLASSES
+        ],
+        'computed_on': summaries.values_list('computed_on', flat=True).first(),
+        'shops': Shop.objects.all(),
+        'filters': {'shop': shop_id, 'abc_class': abc_class},
+        'page_rows': INVENTORY_PAGE_ROWS,
+    }
+    return render(request, 'shop/inventory.html', context)
 
 @login_required
 def create_debt_page(request):
@@ -462,6 +612,7 @@ def create_debt_page(request):
     return render(request, 'shop/create_debt.html', {'shops': shops})
 
 @login_required
+@reporting_view
 def debt_list(request):
     debts = Debt.objects.select_related('shop').all()
     
@@ -474,24 +625,26 @@ def debt_list(request):
     if status:
         debts = debts.filter(status=status)
 
-    # Statistics
-    total_debts = debts.aggregate(total=Sum('total_amount'))['total'] or Decimal('0.00')
-    total_paid = debts.aggregate(total=Sum('paid_amount'))['total'] or Decimal('0.00')
-    total_remaining = debts.aggregate(total=Sum('remaining_amount'))['total'] or Decimal('0.00')
-    
-    today = timezone.now().date()
-    overdue_debts = debts.filter(due_date__lt=today, status='pending')
-    total_overdue = overdue_debts.aggregate(total=Sum('remaining_amount'))['total'] or Decimal('0.00')
+    # Overdue is judged on the shop's calendar
+    today = timezone.localdate(timezone=Shop.timezone_of(shop_id) if shop_id else None)
+    stats = debt_stats(debts, today)
+    try:
+        page, next_cursor = debt_page(debts, request.GET.get('cursor'))
+    except ValueError:
+        # A malformed cursor shows the first page
+        page, next_cursor = debt_page(debts)
 
     context = {
-        'debts': debts,
+        'debts': page,
+        'next_cursor': next_cursor,
+        'is_first_page': not request.GET.get('cursor'),
         'shops': Shop.objects.all(),
         'today': today,
-        'total_debts': total_debts,
-        'total_paid': total_paid,
-        'total_remaining': total_remaining,
-        'total_overdue': total_overdue,
-        'overdue_count': overdue_debts.count(),
+        'total_debts': stats['total_debts'] or Decimal('0.00'),
+        'total_paid': stats['total_paid'] or Decimal('0.00'),
+        'total_remaining': stats['total_remaining'] or Decimal('0.00'),
+        'total_overdue': stats['total_overdue'] or Decimal('0.00'),
+        'overdue_count': stats['overdue_count'],
         'filters': {
             'shop': shop_id,
             'status': status,
@@ -518,55 +671,64 @@ def create_debt(request):
     try:
         shop = Shop.objects.get(id=shop_id)
         due_date_obj = datetime.strptime(due_date, '%Y-%m-%d').date()
-        
-        # Calculate total amount and check stock
-        total_amount = Decimal('0.00')
-        debt_items_data = []
-        
-        # First, check all items have sufficient stock
-        for item in items:
-            good = Good.objects.get(id=item['id'], shop=shop)
-            if good.stock_count < item['quantity']:
-                return JsonResponse({
-                    'error': f'{good.name} üçün kifayət qədər stok yoxdur. Stok: {good.stock_count}, Tələb olunan: {item["quantity"]}'
-                }, status=400)
-            
-            item_total = good.price * item['quantity']
-            total_amount += item_total
-            
-            debt_items_data.append({
-                'good': good,
-                'quantity': item['quantity'],
-                'unit_price': good.price,
-                'total_price': item_total
-            })
 
-        # Create debt
-        debt = Debt.objects.create(
-            customer_name=customer_name,
-            customer_phone=customer_phone,
-            shop=shop,
-            total_amount=total_amount,
-            remaining_amount=total_amount,
-            due_date=due_date_obj,
-            description=description,
-            created_by=request.user
-        )
+        # Stock checks, the debt, its items and the stock decrement succeed or fail together
+        with transaction.atomic():
+            # Lock the whole cart in one query so concurrent sales cannot oversell it
+            goods = Good.objects.select_for_update().filter(shop=shop).in_bulk([item['id'] for item in items])
+            requested = defaultdict(int)
+            lines = []
+            for item in items:
+                good = goods.get(int(item['id']))
+                if good is None:
+                    raise Good.DoesNotExist('Good matching query does not exist.')
+                quantity = int(item['quantity'])
+                if quantity <= 0:
+                    return JsonResponse({'error': f'{good.name} üçün miqdar düzgün deyil'}, status=400)
+                requested[good.id] += quantity
+                lines.append((good, quantity))
 
-        # Create debt items and reduce stock
-        for item_data in debt_items_data:
-            DebtItem.objects.create(
-                debt=debt,
-                good=item_data['good'],
-                quantity=item_data['quantity'],
-                unit_price=item_data['unit_price'],
-                total_price=item_data['total_price']
+            for good_id, quantity in requested.items():
+                good = goods[good_id]
+                if good.stock_count < quantity:
+                    return JsonResponse({
+                        'error': f'{good.name} üçün kifayət qədər stok yoxdur. Stok: {good.stock_count}, Tələb olunan: {quantity}'
+                    }, status=400)
+
+            # bulk_create skips DebtItem.save(): totals are computed here
+            debt_items = [
+                DebtItem(good=good, quantity=quantity, unit_price=good.price, total_price=good.price * quantity)
+                for good, quantity in lines
+            ]
+            # The cost layers stay locked until the debt and its items are written
+            costs = consume(lines)
+            for debt_item, cost in zip(debt_items, costs):
+                debt_item.cost = cost
+            total_amount = sum((debt_item.total_price for debt_item in debt_items), Decimal('0.00'))
+
+            customer = Customer.for_debt(customer_name, customer_phone)
+            debt = Debt.objects.create(
+                customer_name=customer_name,
+                customer_phone=customer_phone,
+                customer=customer,
+                shop=shop,
+                total_amount=total_amount,
+                remaining_amount=total_amount,
+                profit=sum((debt_item.total_price - debt_item.cost for debt_item in debt_items), Decimal('0.00')),
+                items_quantity=sum(quantity for good, quantity in lines),
+                due_date=due_date_obj,
+                description=description,
+                created_by=request.user
             )
-            
-            # Reduce stock - IMPORTANT: Stock decreases when debt is created
-            good = item_data['good']
-            good.stock_count -= item_data['quantity']
-            good.save()
+            for debt_item in debt_items:
+                debt_item.debt = debt
+            debt_items = DebtItem.objects.bulk_create(debt_items)
+
+            # Stock decreases when the debt is created: one UPDATE for the whole cart
+            Good.add_to_stock({good_id: -quantity for good_id, quantity in requested.items()})
+
+            record_debt(debt, debt_items)
+            Customer.add_to_balance(customer.id, total_amount)
 
         return JsonResponse({
             'success': True,
@@ -602,21 +764,24 @@ def pay_debt(request):
         if amount <= 0:
             return JsonResponse({'error': 'Məbləğ müsbət olmalıdır'}, status=400)
 
-        debt = Debt.objects.get(id=debt_id)
-        
-        if debt.status != 'pending':
-            return JsonResponse({'error': 'Bu borc artıq ödənilib və ya ləğv edilib'}, status=400)
-
         # Round to 2 decimal places to avoid floating point issues
         amount = amount.quantize(Decimal('0.01'))
-        
-        if amount > debt.remaining_amount:
-            return JsonResponse({
-                'error': f'Ödəniş məbləği qalan məbləğdən çox ola bilməz. Qalan: {debt.remaining_amount:.2f} AZN'
-            }, status=400)
 
-        debt.paid_amount += amount
-        debt.save()
+        # The debt stays locked until the payment and the customer's balance are written
+        with transaction.atomic():
+            debt = Debt.objects.select_for_update().get(id=debt_id)
+
+            if debt.status != 'pending':
+                return JsonResponse({'error': 'Bu borc artıq ödənilib və ya ləğv edilib'}, status=400)
+
+            if amount > debt.remaining_amount:
+                return JsonResponse({
+                    'error': f'Ödəniş məbləği qalan məbləğdən çox ola bilməz. Qalan: {debt.remaining_amount:.2f} AZN'
+                }, status=400)
+
+            debt.paid_amount += amount
+            debt.save()
+            Customer.add_to_balance(debt.customer_id, -amount)
 
         return JsonResponse({
             'success': True,
@@ -640,21 +805,29 @@ def cancel_debt(request):
         return JsonResponse({'error': 'Borc ID tələb olunur'}, status=400)
 
     try:
-        debt = Debt.objects.get(id=debt_id)
-        
-        if debt.status != 'pending':
-            return JsonResponse({'error': 'Yalnız gözləyən borclar ləğv edilə bilər'}, status=400)
+        with transaction.atomic():
+            # Locked so a concurrent payment or cancel waits for this one
+            debt = Debt.objects.select_for_update().get(id=debt_id)
+
+            if debt.status != 'pending':
+                return JsonResponse({'error': 'Yalnız gözləyən borclar ləğv edilə bilər'}, status=400)
 
-        # Restore stock for all items in this debt
-        debt_items = DebtItem.objects.filter(debt=debt)
-        for debt_item in debt_items:
-            good = debt_item.good
-            good.stock_count += debt_item.quantity
-            good.save()
+            # Restore stock for all items in this debt: one UPDATE, like create_debt
+            debt_items = list(DebtItem.objects.filter(debt=debt))
+            returned = defaultdict(int)
+            for debt_item in debt_items:
+                returned[debt_item.good_id] += debt_item.quantity
+            Good.add_to_stock(returned)
 
-        # Update debt status
-        debt.status = 'cancelled'
-        debt.save()
+            # Update debt status
+            debt.status = 'cancelled'
+            debt.save()
+            # Same time as the rebuild's replay of the cancellation (costing._history)
+            return_to_stock([(item.good_id, item.quantity, item.cost) for item in debt_items], debt.updated_at)
+
+            # Cancelled debts no longer count towards revenue, nor towards the customer's balance
+            record_debt(debt, debt_items, sign=-1)
+            Customer.add_to_balance(debt.customer_id, -debt.remaining_amount)
 
         return JsonResponse({
             'success': True,
@@ -667,6 +840,17 @@ def cancel_debt(request):
         return JsonResponse({'error': str(e)}, status=500)
 
 
+@login_required
+@require_http_methods(["GET"])
+def search_customers_api(request):
+    """Customers whose phone or name starts with ?q=, with their outstanding balance"""
+    results = [
+        dict(customer, balance=float(customer['balance']))
+        for customer in search_customers(request.GET.get('q', '').strip())
+    ]
+    return JsonResponse({'results': results})
+
+
 @login_required
 def worker_open_pack(request):
     """Worker view to open cigarette packs - accessible by workers and admin"""
@@ -912,7 +1096,7 @@ def search_goods_for_stock(request):
             Q(name__icontains=query) | Q(barcode__icontains=query),
             shop_id=shop_id
             # No stock_count__gt=0 filter here
-        )[:10]
+        ).select_related('category')[:10]
         
         results = []
         for good in goods:
@@ -986,9 +1170,12 @@ def stock_receipt(request):
                 messages.error(request, f"JSON məlumatları düzgün deyil: {str(je)}")
                 return redirect('shop:stock_receipt')
             
-            success_count = 0
-            total_cost = Decimal('0.00')
+            receipts = []
             error_messages = []
+            # All goods of the receipt in one query
+            goods = Good.objects.filter(shop=target_shop).in_bulk(
+                [item['id'] for item in items if str(item.get('id', '')).isdigit()]
+            )
             
             for index, item in enumerate(items):
                 try:
@@ -1004,7 +1191,9 @@ def stock_receipt(request):
                         error_messages.append(f"Item {index + 1}: ID boşdur")
                         continue
                     
-                    good = Good.objects.get(id=item_id, shop=target_shop)
+                    good = goods.get(int(item_id)) if str(item_id).isdigit() else None
+                    if good is None:
+                        raise Good.DoesNotExist
                     print(f"DEBUG: Found good: {good.name} (ID: {good.id})")
                     
                     # Ensure proper data types
@@ -1014,8 +1203,8 @@ def stock_receipt(request):
                     
                     print(f"DEBUG: quantity={quantity}, unit_cost={unit_cost}")
                     
-                    # Create stock receipt
-                    StockReceipt.objects.create(
+                    # Stock receipts are created together below
+                    receipts.append(StockReceipt(
                         good=good,
                         quantity=quantity,
                         receipt_type=receipt_type,
@@ -1024,10 +1213,7 @@ def stock_receipt(request):
                         notes=notes,
                         created_by=request.user,
                         shop=target_shop
-                    )
-                    success_count += 1
-                    total_cost += unit_cost * quantity
-                    print(f"DEBUG: Created receipt for {good.name}")
+                    ))
                     
                 except Good.DoesNotExist:
                     error_msg = f"{item.get('name', f'Item {index + 1}')} - Məhsul tapılmadı"
@@ -1043,6 +1229,11 @@ def stock_receipt(request):
                     print(f"DEBUG: Item error: {e}")
                     import traceback
                     traceback.print_exc()
+
+            # One stock and average cost update per good
+            StockReceipt.bulk_receive(receipts)
+            success_count = len(receipts)
+            total_cost = sum((receipt.total_cost for receipt in receipts), Decimal('0.00'))
             
             if success_count > 0:
                 success_msg = f"✅ {success_count} məhsulun stoku uğurla əlavə edildi! Ümumi dəyər: {total_cost:.2f} AZN"
@@ -89,6 +89,31 @@ if 'DATABASE_URL' in os.environ:
         conn_health_checks=True,
     )
 
+# Optional read replica for the reporting views (finance page, exports, debt list).
+# Locally a copy of the SQLite file can stand in for it: REPLICA_DATABASE_URL=sqlite:///db-replica.sqlite3
+if 'REPLICA_DATABASE_URL' in os.environ:
+    DATABASES['replica'] = dj_database_url.config(
+        env='REPLICA_DATABASE_URL',
+        conn_max_age=600,
+        conn_health_checks=True,
+        # Tests run against one database: the replica alias reads the test primary
+        test_options={'MIRROR': 'default'},
+    )
+
+DATABASE_ROUTERS = ['shop.routers.ReplicaRouter']
+
+# Finance report caches (generations, stale-while-revalidate sections and their
+# refresh locks) must be shared by every gunicorn worker: use Redis when REDIS_URL
+# is set. Without it each process keeps its own local memory cache, which only
+# suits a single-process development server (`manage.py check --deploy` warns).
+if 'REDIS_URL' in os.environ:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': os.environ['REDIS_URL'],
+        }
+    }
+
 
 # Password validation
 # https://docs.djangoproject.com/en/4.2/ref/settings/#auth-password-validators
@@ -158,6 +183,15 @@ if not os.path.exists(staticfiles_dir):
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
+# Cost of goods sold: 'fifo' or 'average' (weighted average of the open cost layers).
+# Run `python manage.py rebuild_costs` after changing it.
+COST_METHOD = os.environ.get('COST_METHOD', 'fifo')
+
+# In development, log requests running more SQL queries than this (see shop/query_budget.py)
+QUERY_BUDGET_WARNING = int(os.environ.get('QUERY_BUDGET_WARNING', 30))
+if DEBUG:
+    MIDDLEWARE.append('shop.query_budget.QueryBudgetMiddleware')
+
 # Security settings for production
 if not DEBUG:
     # FIX: Let Railway handle SSL redirects to prevent loops